@@ -29,10 +29,10 @@ import sys
 import model.model as model
 import time
 import os
-import tarfile
-import tempfile
-import pickle
 import backend.backendcontroller as backendcontroller
+from backend.sharedstore import open_shared_store, get_shared_store
+from model.tracing import get_tracer
+from model.stalldetector import get_stall_detector
 
 
 class MainApplicationController(Gtk.Application):
@@ -48,6 +48,9 @@ class MainApplicationController(Gtk.Application):
         
         self.construct_application_menu()
         self.construct_worksheet_menu()
+        self.kernel_statistics_dialog = None
+        self.memory_dialog = None
+        if os.environ.get('GSNB_DETECT_STALLS', '') != '': get_stall_detector().start()
         
         # init compute queue
         self.backend_controller_sagemath = backendcontroller.BackendControllerSageMath()
@@ -144,6 +147,7 @@ class MainApplicationController(Gtk.Application):
     def observe_notebook(self):
         self.notebook.register_observer(self)
         self.notebook.register_observer(self.backend_controller_sagemath)
+        self.notebook.register_observer(self.backend_controller_markdown)
         
     def observe_main_window(self):
         hb_left = self.main_window.headerbar.hb_left
@@ -225,12 +229,18 @@ class MainApplicationController(Gtk.Application):
             
     def update_hamburger_menu(self):
         worksheet = self.notebook.get_active_worksheet()
+        self.change_backend_action.set_state(GLib.Variant('s', worksheet.get_backend()))
+        self.track_memory_action.set_state(GLib.Variant('b', worksheet.get_memory_tracking()))
         if isinstance(worksheet, model.NormalWorksheet):
             self.delete_ws_action.set_enabled(True)
             self.rename_ws_action.set_enabled(True)
+            self.change_backend_action.set_enabled(True)
+            self.track_memory_action.set_enabled(True)
         elif isinstance(worksheet, model.DocumentationWorksheet):
             self.delete_ws_action.set_enabled(False)
             self.rename_ws_action.set_enabled(False)
+            self.change_backend_action.set_enabled(False)
+            self.track_memory_action.set_enabled(False)
             
     def update_up_down_buttons(self):
         worksheet = self.notebook.get_active_worksheet()
@@ -256,6 +266,8 @@ class MainApplicationController(Gtk.Application):
             subtitle = 'evaluating ' + str(busy_cell_count) + ' cell' + plural + '.'
         elif worksheet.get_kernel_state() == 'starting':
             subtitle = 'starting kernel.'
+        elif worksheet.get_kernel_state() == 'failed':
+            subtitle = 'kernel failed to start.'
         else:
             subtitle = 'idle.'
 
@@ -369,32 +381,10 @@ class MainApplicationController(Gtk.Application):
         dialog = view.dialogs.ImportWorksheet(self.main_window)
         response = dialog.run()
         if response == Gtk.ResponseType.OK:
-            filename = dialog.get_filename()
-            tar = tarfile.open(filename, 'r:bz2')
-            more_to_import = True
-            count = 0
-            while more_to_import:
-                try: tar.getmember(str(count))
-                except KeyError: more_to_import = False
-                else:
-                    td_path = tempfile.mkdtemp()
-                    tar.extractall(td_path)
-                    worksheet = model.NormalWorksheet(self.notebook)
-                    worksheet.set_id(self.notebook.find_unused_ws_id())
-                    pathname = self.notebook.get_pathname() + '/' + str(worksheet.get_id())
-                    os.rename(td_path + '/' + str(count), pathname)
-                    worksheet.set_pathname(pathname)
-                    try: meta_filehandle = open(worksheet.pathname + '/worksheet_conf.pickle', 'rb')
-                    except IOError: pass
-                    else: 
-                        meta = pickle.load(meta_filehandle)
-                        worksheet.set_name(meta['name'])
-                    worksheet.save_meta_to_disk()
-                    self.notebook.add_worksheet(worksheet)
-                    row_index = self.main_window.sidebar.worksheet_list_view.get_row_index_by_worksheet(worksheet)
-                    row = self.main_window.sidebar.worksheet_list_view.get_row_at_index(row_index)
-                    self.main_window.sidebar.worksheet_list_view.select_row(row)
-                    count += 1
+            for worksheet in self.notebook.import_gsnb(dialog.get_filename()):
+                row_index = self.main_window.sidebar.worksheet_list_view.get_row_index_by_worksheet(worksheet)
+                row = self.main_window.sidebar.worksheet_list_view.get_row_at_index(row_index)
+                self.main_window.sidebar.worksheet_list_view.select_row(row)
 
         dialog.destroy()
         
@@ -479,6 +469,13 @@ class MainApplicationController(Gtk.Application):
         if not (isinstance(active_cell, model.MarkdownCell) and active_cell.get_result() != None):
             active_cell.evaluate()
         
+    def on_eval_profile_button_click(self, button_object=None, parameter=None):
+        ''' signal handler, evaluate active cell under the profiler '''
+
+        active_cell = self.notebook.active_worksheet.active_cell
+        if isinstance(active_cell, model.CodeCell):
+            active_cell.evaluate_with_profiler()
+        
     def on_eval_nc_button_click(self, button_object=None):
         ''' signal handler, evaluate active cell, go to next cell '''
 
@@ -656,9 +653,42 @@ class MainApplicationController(Gtk.Application):
     '''
     
     def construct_worksheet_menu(self):
+        self.evaluate_with_profiler_action = Gio.SimpleAction.new('evaluate_with_profiler', None)
+        self.evaluate_with_profiler_action.connect('activate', self.on_eval_profile_button_click)
+        self.add_action(self.evaluate_with_profiler_action)
+        self.evaluate_all_action = Gio.SimpleAction.new('evaluate_all', None)
+        self.evaluate_all_action.connect('activate', self.on_wsmenu_evaluate_all)
+        self.add_action(self.evaluate_all_action)
         self.restart_kernel_action = Gio.SimpleAction.new('restart_kernel', None)
         self.restart_kernel_action.connect('activate', self.on_wsmenu_restart_kernel)
         self.add_action(self.restart_kernel_action)
+        self.show_kernel_statistics_action = Gio.SimpleAction.new('show_kernel_statistics', None)
+        self.show_kernel_statistics_action.connect('activate', self.on_wsmenu_show_kernel_statistics)
+        self.add_action(self.show_kernel_statistics_action)
+        self.show_slowest_cells_action = Gio.SimpleAction.new('show_slowest_cells', None)
+        self.show_slowest_cells_action.connect('activate', self.on_wsmenu_show_slowest_cells)
+        self.add_action(self.show_slowest_cells_action)
+        self.show_evaluation_latency_action = Gio.SimpleAction.new('show_evaluation_latency', None)
+        self.show_evaluation_latency_action.connect('activate', self.on_wsmenu_show_evaluation_latency)
+        self.add_action(self.show_evaluation_latency_action)
+        self.record_trace_action = Gio.SimpleAction.new_stateful('record_trace', None, GLib.Variant('b', get_tracer().is_enabled()))
+        self.record_trace_action.connect('activate', self.on_wsmenu_record_trace)
+        self.add_action(self.record_trace_action)
+        self.show_memory_by_cell_action = Gio.SimpleAction.new('show_memory_by_cell', None)
+        self.show_memory_by_cell_action.connect('activate', self.on_wsmenu_show_memory_by_cell)
+        self.add_action(self.show_memory_by_cell_action)
+        self.track_memory_action = Gio.SimpleAction.new_stateful('track_memory', None, GLib.Variant('b', False))
+        self.track_memory_action.connect('activate', self.on_wsmenu_track_memory)
+        self.add_action(self.track_memory_action)
+        self.show_main_loop_stalls_action = Gio.SimpleAction.new('show_main_loop_stalls', None)
+        self.show_main_loop_stalls_action.connect('activate', self.on_wsmenu_show_main_loop_stalls)
+        self.add_action(self.show_main_loop_stalls_action)
+        self.show_shared_objects_action = Gio.SimpleAction.new('show_shared_objects', None)
+        self.show_shared_objects_action.connect('activate', self.on_wsmenu_show_shared_objects)
+        self.add_action(self.show_shared_objects_action)
+        self.change_backend_action = Gio.SimpleAction.new_stateful('change_backend', GLib.VariantType.new('s'), GLib.Variant('s', 'sage'))
+        self.change_backend_action.connect('activate', self.on_wsmenu_change_backend)
+        self.add_action(self.change_backend_action)
         self.rename_ws_action = Gio.SimpleAction.new('rename_worksheet', None)
         self.rename_ws_action.connect('activate', self.on_wsmenu_rename)
         self.add_action(self.rename_ws_action)
@@ -683,11 +713,186 @@ class MainApplicationController(Gtk.Application):
             show_shortcuts_window_action.connect('activate', self.on_appmenu_show_shortcuts_window)
             self.add_action(show_shortcuts_window_action)
         
+    def on_wsmenu_evaluate_all(self, action=None, parameter=None):
+        ''' signal handler, queue all code cells of active worksheet '''
+
+        self.notebook.active_worksheet.evaluate_all()
+        
     def on_wsmenu_restart_kernel(self, action=None, parameter=None):
         ''' signal handler, restart kernel for active worksheet '''
 
         self.notebook.active_worksheet.restart_kernel()
         
+    def on_wsmenu_show_kernel_statistics(self, action=None, parameter=None):
+        ''' signal handler, show statistics of the active worksheet's kernel '''
+
+        def on_response(dialog, response_id):
+            if response_id == Gtk.ResponseType.APPLY:
+                dialog.set_message('Waiting for kernel ...')
+                dialog.worksheet.request_kernel_statistics()
+            else:
+                dialog.destroy()
+                self.kernel_statistics_dialog = None
+
+        if self.kernel_statistics_dialog != None:
+            self.kernel_statistics_dialog.destroy()
+        worksheet = self.notebook.get_active_worksheet()
+        self.kernel_statistics_dialog = view.dialogs.KernelStatistics(self.main_window, worksheet)
+        self.kernel_statistics_dialog.connect('response', on_response)
+        self.kernel_statistics_dialog.show_all()
+        worksheet.request_kernel_statistics()
+        
+    def update_kernel_statistics_dialog(self, worksheet):
+        if self.kernel_statistics_dialog != None and self.kernel_statistics_dialog.worksheet == worksheet:
+            self.kernel_statistics_dialog.set_statistics(worksheet.get_kernel_statistics())
+        
+    def on_wsmenu_track_memory(self, action, parameter=None):
+        ''' signal handler, turn tracemalloc snapshots around evaluations on or off '''
+
+        worksheet = self.notebook.get_active_worksheet()
+        if isinstance(worksheet, model.NormalWorksheet):
+            worksheet.set_memory_tracking(not worksheet.get_memory_tracking())
+            worksheet.save_meta_to_disk()
+            action.set_state(GLib.Variant('b', worksheet.get_memory_tracking()))
+        
+    def on_wsmenu_show_memory_by_cell(self, action=None, parameter=None):
+        ''' signal handler, show memory the active worksheet's cells left allocated in the kernel '''
+
+        def on_response(dialog, response_id):
+            if response_id == Gtk.ResponseType.ACCEPT:
+                (first_position, first_cell), (second_position, second_cell) = sorted(dialog.get_selected_cells(), key=lambda selected: selected[0])
+                if first_cell in dialog.worksheet.cells and second_cell in dialog.worksheet.cells:
+                    dialog.show_sites('Comparing ...', None)
+                    dialog.worksheet.request_memory_diff(first_cell, second_cell)
+            elif response_id == Gtk.ResponseType.APPLY:
+                dialog.set_cells(dialog.worksheet.get_memory_report())
+            else:
+                dialog.destroy()
+                self.memory_dialog = None
+
+        if self.memory_dialog != None:
+            self.memory_dialog.destroy()
+        worksheet = self.notebook.get_active_worksheet()
+        self.memory_dialog = view.dialogs.MemoryByCell(self.main_window, worksheet)
+        self.memory_dialog.set_cells(worksheet.get_memory_report())
+        self.memory_dialog.connect('response', on_response)
+        self.memory_dialog.show_all()
+        
+    def update_memory_dialog(self, worksheet):
+        if self.memory_dialog != None and self.memory_dialog.worksheet == worksheet:
+            self.memory_dialog.set_diff(worksheet.get_memory_diff())
+        
+    def on_wsmenu_show_slowest_cells(self, action=None, parameter=None):
+        ''' signal handler, list code cells of the active worksheet by time their last evaluation took '''
+
+        def get_cells():
+            cells = list()
+            for position, cell in enumerate(worksheet.cells):
+                if isinstance(cell, model.CodeCell) and cell.get_resource_usage() != None:
+                    cells.append((position, cell.get_text(cell.get_start_iter(), cell.get_end_iter(), False), cell.get_resource_usage(), cell))
+            return cells
+
+        def on_row_activated(tree_view, path, column):
+            cell = dialog.list_store[path][6]
+            if cell in worksheet.cells:
+                worksheet.set_active_cell(cell)
+                cell.place_cursor(cell.get_start_iter())
+                self.scroll_to_cursor(cell, check_if_position_changed=False)
+
+        worksheet = self.notebook.get_active_worksheet()
+        dialog = view.dialogs.SlowestCells(self.main_window, worksheet)
+        dialog.set_cells(get_cells())
+        dialog.tree_view.connect('row-activated', on_row_activated)
+        dialog.show_all()
+        while dialog.run() == Gtk.ResponseType.APPLY:
+            dialog.set_cells(get_cells())
+        dialog.destroy()
+        
+    def on_wsmenu_show_evaluation_latency(self, action=None, parameter=None):
+        ''' signal handler, show latency breakdown of the active worksheet's evaluations '''
+
+        worksheet = self.notebook.get_active_worksheet()
+        dialog = view.dialogs.EvaluationLatency(self.main_window, worksheet)
+        dialog.set_report(worksheet.get_latency_report())
+        dialog.show_all()
+        while True:
+            response = dialog.run()
+            if response == Gtk.ResponseType.ACCEPT:
+                file_dialog = view.dialogs.ExportLatencyCSV(self.main_window)
+                if file_dialog.run() == Gtk.ResponseType.OK:
+                    worksheet.export_latency_csv(file_dialog.get_filename())
+                file_dialog.destroy()
+            elif response != Gtk.ResponseType.APPLY:
+                break
+            dialog.set_report(worksheet.get_latency_report())
+        dialog.destroy()
+        
+    def on_wsmenu_record_trace(self, action, parameter=None):
+        ''' signal handler, start or stop recording a trace of the event pipeline '''
+
+        tracer = get_tracer()
+        if not tracer.is_enabled():
+            trace_directory = os.path.expanduser('~/.sage/gsnb_traces')
+            if not os.path.exists(trace_directory): os.makedirs(trace_directory)
+            tracer.start(trace_directory + '/trace-' + time.strftime('%Y%m%d-%H%M%S') + '.json')
+            action.set_state(GLib.Variant('b', True))
+        else:
+            pathname = tracer.stop()
+            action.set_state(GLib.Variant('b', False))
+            dialog = Gtk.MessageDialog(self.main_window, 0, Gtk.MessageType.INFO, Gtk.ButtonsType.OK, 'Trace saved')
+            dialog.format_secondary_text('The trace was written to ' + pathname + '. Open it in Perfetto (ui.perfetto.dev) or chrome://tracing.')
+            dialog.run()
+            dialog.destroy()
+        
+    def on_wsmenu_show_main_loop_stalls(self, action=None, parameter=None):
+        ''' signal handler, show where the gtk main loop got stuck, worst call sites first '''
+
+        def on_switch_activated(switch, parameter):
+            if switch.get_active():
+                stall_detector.start()
+            else:
+                stall_detector.stop()
+
+        stall_detector = get_stall_detector()
+        dialog = view.dialogs.MainLoopStalls(self.main_window, stall_detector.threshold)
+        dialog.switch.set_active(stall_detector.is_running())
+        dialog.switch.connect('notify::active', on_switch_activated)
+        dialog.set_report(stall_detector.get_statistics(), stall_detector.get_report())
+        dialog.show_all()
+        while True:
+            response = dialog.run()
+            if response == Gtk.ResponseType.REJECT:
+                stall_detector.reset()
+            elif response != Gtk.ResponseType.APPLY:
+                break
+            dialog.set_report(stall_detector.get_statistics(), stall_detector.get_report())
+        dialog.destroy()
+        
+    def on_wsmenu_show_shared_objects(self, action=None, parameter=None):
+        ''' signal handler, list objects kernels published in the shared store '''
+
+        shared_store = get_shared_store()
+        dialog = view.dialogs.SharedObjects(self.main_window)
+        dialog.set_objects(shared_store.list_objects())
+        dialog.show_all()
+        while True:
+            response = dialog.run()
+            if response == Gtk.ResponseType.REJECT and dialog.get_selected_name() != None:
+                shared_store.remove(dialog.get_selected_name())
+            elif response != Gtk.ResponseType.APPLY:
+                break
+            dialog.set_objects(shared_store.list_objects())
+        dialog.destroy()
+        
+    def on_wsmenu_change_backend(self, action, parameter):
+        ''' signal handler, switch kernel of active worksheet (sage / python3) '''
+
+        worksheet = self.notebook.get_active_worksheet()
+        action.set_state(parameter)
+        if isinstance(worksheet, model.NormalWorksheet):
+            worksheet.set_backend(parameter.get_string())
+            worksheet.save_meta_to_disk()
+        
     def on_wsmenu_gsnb_export(self, action=None, parameter=None):
         ''' signal handler, export worksheet in gsnb format '''
         
@@ -908,6 +1113,28 @@ class MainApplicationController(Gtk.Application):
     
     def observe_keyboard_keypress_events(self, main_window, event):
 
+        # keys go to the completion list while it is shown
+        worksheet = self.notebook.active_worksheet
+        cell = worksheet.get_active_cell() if worksheet != None else None
+        if isinstance(cell, model.CodeCell) and self.cell_controllers[cell].cell_view.is_showing_completions():
+            return False
+
+        # help popover goes away on the next key
+        if isinstance(cell, model.CodeCell) and self.cell_controllers[cell].cell_view.introspection_popover.get_visible():
+            self.cell_controllers[cell].cell_view.introspection_popover.popdown()
+            if event.keyval == Gdk.keyval_from_name('Escape'):
+                return True
+
+        # complete name left of the cursor with tab
+        if event.keyval == Gdk.keyval_from_name('Tab') and event.state == 0:
+            if isinstance(cell, model.CodeCell) and cell.request_completions():
+                return True
+
+        # signature and docs of the name at the cursor with shift+tab
+        if event.keyval == Gdk.keyval_from_name('ISO_Left_Tab') and event.state == Gdk.ModifierType.SHIFT_MASK:
+            if isinstance(cell, model.CodeCell) and cell.request_introspection():
+                return True
+
         # switch cells with arrow keys: upward
         if event.keyval == Gdk.keyval_from_name('Up') and event.state == 0:
             worksheet = self.notebook.active_worksheet
@@ -996,6 +1223,18 @@ class MainApplicationController(Gtk.Application):
             self.on_eval_nc_button_click()
             return True
             
+        # evaluate cell in a copy of the kernel with ctrl+shift+enter
+        if event.keyval == Gdk.keyval_from_name('Return') and event.state == (Gdk.ModifierType.CONTROL_MASK | Gdk.ModifierType.SHIFT_MASK):
+            active_cell = self.notebook.active_worksheet.active_cell
+            if isinstance(active_cell, model.CodeCell):
+                active_cell.try_evaluate()
+            return True
+            
+        # evaluate cell under the profiler with ctrl+alt+enter
+        if event.keyval == Gdk.keyval_from_name('Return') and event.state == (Gdk.ModifierType.CONTROL_MASK | Gdk.ModifierType.MOD1_MASK):
+            self.on_eval_profile_button_click()
+            return True
+            
         # add code cell below with alt+enter
         if event.keyval == Gdk.keyval_from_name('Return') and event.state == Gdk.ModifierType.MOD1_MASK:
             self.on_add_codecell_button_click()
@@ -1082,6 +1321,7 @@ class MainApplicationController(Gtk.Application):
 
     def do_startup(self):
         Gtk.Application.do_startup(self)
+        open_shared_store()
 
 
 GLib.threads_init()
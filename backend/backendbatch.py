@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (C) 2017, 2018 Robert Griesel
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>
+
+import asyncio
+import multiprocessing
+import os, os.path
+import time
+import traceback
+from model.model_headless import HeadlessWorksheet
+from backend.kernelpexpect import InterfacePexpect
+
+
+def evaluate_worksheet(job):
+    ''' load worksheet, run all code cells top to bottom in a fresh kernel,
+        write results back. this function runs in a pool worker process. '''
+
+    return asyncio.run(evaluate_worksheet_async(job))
+
+
+async def evaluate_worksheet_async(job):
+    pathname = job['pathname']
+    report = {'pathname': pathname, 'name': None, 'status': 'ok', 'cells': 0,
+              'failed_cells': [], 'timings': {}, 'error': None}
+    interface = InterfacePexpect()
+    worksheet = HeadlessWorksheet(pathname)
+    time_start = time.time()
+
+    try:
+        worksheet.populate_meta()
+        worksheet.populate_cells()
+        if job.get('backend') != None:
+            worksheet.meta['backend'] = job['backend']
+        report['name'] = worksheet.get_name()
+        report['backend'] = worksheet.get_backend()
+        report['timings']['load'] = time.time() - time_start
+
+        time_kernel = time.time()
+        await interface.get_process(worksheet)
+        report['timings']['kernel_start'] = time.time() - time_kernel
+
+        time_evaluate = time.time()
+        cell_timings = list()
+        for key, cell in enumerate(worksheet.cells):
+            if cell.get_type() != 'code' or cell.get_text().strip() == '': continue
+            time_cell = time.time()
+            result_blob = await interface.run(cell.get_text(), worksheet)
+            cell_timings.append({'cell': key, 'seconds': time.time() - time_cell, 'usage': result_blob['usage'] if result_blob != None else None})
+            cell.set_result_from_blob(result_blob)
+            report['cells'] += 1
+            if result_blob != None and is_error_output(result_blob['text']):
+                report['failed_cells'].append({'cell': key, 'message': result_blob['text'].strip().split('\n')[-1]})
+        report['timings']['evaluate'] = time.time() - time_evaluate
+        report['timings']['cells'] = cell_timings
+
+        if job.get('save', True):
+            time_save = time.time()
+            worksheet.save_to_disk()
+            report['timings']['save'] = time.time() - time_save
+    except Exception as e:
+        report['status'] = 'error'
+        report['error'] = traceback.format_exception_only(type(e), e)[-1].strip()
+    finally:
+        interface.stop_process(worksheet)
+
+    if report['status'] == 'ok' and len(report['failed_cells']) > 0:
+        report['status'] = 'failed'
+    report['timings']['total'] = time.time() - time_start
+    return report
+
+
+def is_error_output(text):
+    ''' tracebacks are printed as plain output by the kernel. '''
+
+    if 'Traceback (most recent call last)' in text: return True
+    lines = text.strip().split('\n')
+    last_line = lines[-1] if len(lines) > 0 else ''
+    return last_line.split(':')[0].endswith('Error') and not ' ' in last_line.split(':')[0]
+
+
+def find_worksheet_paths(pathname):
+    ''' pathname is either a worksheet folder or a notebook folder
+        containing worksheet folders. '''
+
+    if os.path.isfile(pathname + '/worksheet.html'):
+        return [pathname]
+    worksheet_paths = list()
+    for filename in sorted(os.listdir(pathname)):
+        if os.path.isfile(pathname + '/' + filename + '/worksheet.html'):
+            worksheet_paths.append(pathname + '/' + filename)
+    return worksheet_paths
+
+
+class BatchRunner(object):
+    ''' Evaluates worksheets without gtk, spread over a pool of worker
+        processes. Every worker drives its own kernel. '''
+
+    def __init__(self, concurrency=None, save=True, backend=None):
+        self.concurrency = concurrency if concurrency != None else multiprocessing.cpu_count()
+        self.save = save
+        self.backend = backend
+
+    def run(self, pathnames):
+        worksheet_paths = list()
+        for pathname in pathnames:
+            worksheet_paths += find_worksheet_paths(os.path.abspath(pathname))
+        jobs = [{'pathname': pathname, 'save': self.save, 'backend': self.backend} for pathname in worksheet_paths]
+
+        time_start = time.time()
+        reports = list()
+        if len(jobs) > 0:
+            pool = multiprocessing.Pool(processes=min(self.concurrency, len(jobs)))
+            try:
+                for report in pool.imap_unordered(evaluate_worksheet, jobs):
+                    reports.append(report)
+            finally:
+                pool.close()
+                pool.join()
+        reports.sort(key=lambda report: report['pathname'])
+
+        summary = {'worksheets': len(reports), 'concurrency': self.concurrency,
+                   'failed': len([report for report in reports if report['status'] != 'ok']),
+                   'seconds': time.time() - time_start}
+        return {'summary': summary, 'worksheets': reports}
@@ -15,9 +15,10 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>
 
-import _thread as thread, queue
+import time
 from backend.backendsagemath import SageMathQuery, ComputeQueue as ComputeQueueSagemath
 from backend.backendmarkdown import MarkdownQuery, ComputeQueue as ComputeQueueMarkdown
+from model.metrics import get_metrics
 
 
 class BackendControllerMarkdown():
@@ -26,6 +27,7 @@ class BackendControllerMarkdown():
     def __init__(self):
         self.compute_queue = ComputeQueueMarkdown()
         self.compute_queue.register_observer(self)
+        get_metrics().add_collector(self.compute_queue.get_metric_samples)
         
     def change_notification(self, change_code, notifying_object, parameter):
         
@@ -38,13 +40,22 @@ class BackendControllerMarkdown():
         if change_code == 'cell_state_change' and parameter == 'evaluation_to_stop':
             cell = notifying_object
             self.compute_queue.stop_evaluation_by_cell(cell)
+            
+        if change_code == 'cell_removed':
+            cell = notifying_object
+            self.compute_queue.release_cell(cell)
+            
+        if change_code == 'worksheet_removed':
+            worksheet = parameter
+            self.compute_queue.release_worksheet(worksheet)
         
-        if change_code == 'query_queued':
+        # notifications of cancelled queries arrive late, ignore them
+        if change_code == 'query_queued' and self.compute_queue.is_current(parameter):
             query = parameter
             cell = query.get_cell()
             cell.change_state('queued_for_evaluation')
     
-        if change_code == 'evaluation_started':
+        if change_code == 'evaluation_started' and self.compute_queue.is_current(parameter):
             query = parameter
             cell = query.get_cell()
             cell.change_state('evaluation_in_progress')
@@ -53,7 +64,7 @@ class BackendControllerMarkdown():
             cell = parameter
             cell.change_state('edit')
 
-        if change_code == 'evaluation_finished':
+        if change_code == 'evaluation_finished' and self.compute_queue.is_current(parameter):
             result_blob = parameter
             result_blob['cell'].change_state('edit')
             result_blob['cell'].set_result_blob(result_blob['result_blob'])
@@ -67,24 +78,61 @@ class BackendControllerSageMath():
     def __init__(self):
         self.compute_queue = ComputeQueueSagemath()
         self.compute_queue.register_observer(self)
+        get_metrics().add_collector(self.compute_queue.get_metric_samples)
     
     def change_notification(self, change_code, notifying_object, parameter):
         
         if change_code == 'changed_active_worksheet':
             worksheet = parameter
-            thread.start_new_thread(self.compute_queue.start_process, (worksheet,))
+            self.compute_queue.start_process(worksheet)
             worksheet.set_kernel_state('starting')
             
         if change_code == 'kernel_started':
             worksheet = parameter
             worksheet.set_kernel_state('running')
             
+        if change_code == 'kernel_start_failed':
+            worksheet = parameter['worksheet']
+            worksheet.set_kernel_state('failed')
+            
         if change_code == 'kernel_to_restart':
             worksheet = notifying_object
             worksheet.stop_evaluation()
-            thread.start_new_thread(self.compute_queue.restart_process, (worksheet,))
+            self.compute_queue.restart_process(worksheet)
             worksheet.set_kernel_state('starting')
         
+        if change_code == 'kernel_statistics_requested':
+            worksheet = notifying_object
+            self.compute_queue.request_kernel_statistics(worksheet)
+            
+        if change_code == 'kernel_statistics_received':
+            parameter['worksheet'].set_kernel_statistics(parameter['statistics'])
+            
+        if change_code == 'memory_diff_requested':
+            worksheet = notifying_object
+            self.compute_queue.request_memory_diff(worksheet, parameter['first'], parameter['second'])
+            
+        if change_code == 'memory_diff_received':
+            parameter['worksheet'].set_memory_diff(parameter['first'], parameter['second'], parameter['diff'])
+            
+        if change_code == 'completions_requested':
+            cell = notifying_object
+            self.compute_queue.request_completions(cell, parameter)
+            
+        if change_code == 'completions_received':
+            parameter['cell'].set_completions(parameter['prefix'], parameter['completions'], parameter['source'])
+            
+        if change_code == 'introspection_requested':
+            cell = notifying_object
+            self.compute_queue.request_introspection(cell, parameter)
+            
+        if change_code == 'introspection_prefetch_requested':
+            cell = notifying_object
+            self.compute_queue.prefetch_introspections(cell.get_worksheet(), parameter)
+            
+        if change_code == 'introspection_received':
+            parameter['cell'].set_introspection(parameter['name'], parameter['introspection'])
+            
         if change_code == 'ws_evaluation_to_stop':
             worksheet = notifying_object
             self.compute_queue.stop_evaluation_by_worksheet(worksheet)
@@ -92,29 +140,47 @@ class BackendControllerSageMath():
         if change_code == 'cell_state_change' and parameter == 'ready_for_evaluation':
             cell = notifying_object
             query_string = cell.get_text(cell.get_start_iter(), cell.get_end_iter(), False)
-            query = SageMathQuery(cell.worksheet, cell, query_string)
+            priority = 'interactive' if cell.is_active_cell() else 'bulk'
+            query = SageMathQuery(cell.worksheet, cell, query_string, priority, cell.get_evaluation_mode(), cell.worksheet.get_memory_tracking())
             self.compute_queue.add_query(query)
             
         if change_code == 'cell_state_change' and parameter == 'evaluation_to_stop':
             cell = notifying_object
             self.compute_queue.stop_evaluation_by_cell(cell)
+            
+        if change_code == 'cell_removed':
+            cell = notifying_object
+            self.compute_queue.release_cell(cell)
+            
+        if change_code == 'worksheet_removed':
+            worksheet = parameter
+            self.compute_queue.release_worksheet(worksheet)
         
-        if change_code == 'query_queued':
+        # notifications of cancelled queries arrive late, ignore them
+        if change_code == 'query_queued' and self.compute_queue.is_current(parameter):
             query = parameter
             cell = query.get_cell()
             cell.change_state('queued_for_evaluation')
     
-        if change_code == 'evaluation_started':
+        if change_code == 'evaluation_started' and self.compute_queue.is_current(parameter):
             query = parameter
             cell = query.get_cell()
             cell.change_state('evaluation_in_progress')
 
+        if change_code == 'query_schedule_changed':
+            for item in parameter:
+                cell = item['query'].get_cell()
+                if cell.state == 'queued_for_evaluation':
+                    cell.set_queue_position(item['position'], item['estimated_wait'])
+
         if change_code == 'cell_evaluation_stopped':
             cell = parameter
             cell.change_state('idle')
 
-        if change_code == 'evaluation_finished':
+        if change_code == 'evaluation_finished' and self.compute_queue.is_current(parameter):
             result_blob = parameter
+            result_blob['timestamps']['dispatched'] = time.time()
+            result_blob['cell'].add_evaluation_timestamps(result_blob['timestamps'])
             result_blob['cell'].change_state('idle')
             if result_blob['result_blob'] != None:
                 result_blob['cell'].set_result_blob(result_blob['result_blob'])
@@ -16,64 +16,89 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>
 
 import gi
-from gi.repository import GLib, GObject
+from gi.repository import GLib
+import asyncio
 import markdown
-import time
-import _thread as thread, queue
-import bleach
+import html
+import html.parser
+import re
+import threading
+import queue
+from backend.eventloop import get_backend_event_loop
+from backend.queryqueue import QueryQueue
+from backend.cancellation import CellGenerations
+from model.tracing import get_tracer, traced
+from model.metrics import get_metrics
+
+tracer = get_tracer()
+change_code_counter = get_metrics().counter('gsnb_backend_notifications_total', 'Notifications compute queues sent to the gtk thread.', ('queue', 'code'))
 
 
 class ComputeQueue(object):
+    ''' Renders markdown in one compute task on the backend event loop.
+        Queries are rendered one at a time in a worker thread, so large
+        cells don't hold up kernel i/o of other worksheets. Locking and
+        notifications work like in backendsagemath.ComputeQueue. '''
 
     def __init__(self):
         self.observers = set()
+        self.lock = threading.RLock()
         self.state = 'idle'
-        self.query_queue = queue.Queue() # put computation tasks on here
-        self.query_ignore_counter = dict()
+        self.query_queue = QueryQueue() # put computation tasks on here
+        self.generations = CellGenerations() # cancellation tokens
+        self.block_caches = dict() # MarkdownQuery block cache by cell, from its last evaluation
         self.active_query = None
-        self.result_blobs_queue = queue.Queue() # computation results are put on here
-        self.change_code_queue = queue.Queue() # change code for observers are put on here
-        thread.start_new_thread(self.compute_loop, ())
-        GObject.timeout_add(50, self.results_loop)
-        GObject.timeout_add(50, self.change_code_loop)
+        self.wakeup = None # asyncio.Event, backend thread only
+        self.event_loop = get_backend_event_loop()
+        self.event_loop.call_soon(self.start_compute_loop)
         
-    def compute_loop(self):
-        ''' wait for queries, run them and put results on the queue.
-            this method runs in thread. '''
+    async def compute_loop(self):
+        ''' wait for queries, run them and send results to observers.
+            this coroutine runs in the backend event loop. '''
 
         while True:
-            time.sleep(0.05)
-            
-            # if query complete set state idle
-            if self.state == 'busy':
-                self.state = self.active_query.get_state()
             
             # check for tasks, start computation
-            if self.state == 'idle':
+            with self.lock:
                 try:
-                    self.active_query = self.query_queue.get(block=False)
+                    query = self.query_queue.get(block=False)
                 except queue.Empty:
-                    pass
+                    query = None
                 else:
-                    cell = self.active_query.get_cell()
-                    if self.active_query.ignore_counter >= self.query_ignore_counter.get(cell, 0):
-                        self.state = 'busy'
-                        self.add_change_code('evaluation_started', self.active_query)
-                        result_blob = self.active_query.evaluate()
-                        self.add_result_blob(result_blob)
-                    else: pass
-                        
-    def change_code_loop(self):
-        ''' notify observers '''
-
-        try:
-            change_code = self.change_code_queue.get(block=False)
-        except queue.Empty:
-            pass
-        else:
-            for observer in self.observers:
-                observer.change_notification(change_code['change_code'], self, change_code['parameter'])
-        return True
+                    if not self.generations.is_current(query.get_cell(), query.generation): continue
+                    self.state = 'busy'
+                    self.active_query = query
+                    query.set_block_cache(self.block_caches.get(query.get_cell(), dict()))
+                    self.add_change_code('evaluation_started', query)
+            
+            if query == None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            try:
+                result_blob = await asyncio.get_event_loop().run_in_executor(None, query.evaluate)
+            except Exception as e:
+                result_blob = query.get_error_result(str(e))
+
+            # query complete, set state idle
+            with self.lock:
+                self.state = 'idle'
+                self.active_query = None
+                if self.generations.is_current(query.get_cell(), query.generation):
+                    self.block_caches[query.get_cell()] = query.get_block_cache()
+                self.add_change_code('evaluation_finished', result_blob)
+
+    def start_compute_loop(self):
+        ''' runs in backend thread. '''
+        
+        self.wakeup = asyncio.Event()
+        asyncio.ensure_future(self.compute_loop())
+        
+    def wake_compute_loop(self):
+        ''' runs in backend thread. '''
+        
+        self.wakeup.set()
     
     def register_observer(self, observer):
         ''' Observer call this method to register themselves with observable
@@ -84,151 +109,348 @@ class ComputeQueue(object):
         self.observers.add(observer)
 
     def add_change_code(self, change_code, parameter):
-        self.change_code_queue.put({'change_code': change_code, 'parameter': parameter})
-                
-    def results_loop(self):
-        ''' wait for results and add them to their cells '''
-
-        try:
-            result_blob = self.result_blobs_queue.get(block=False)
-        except queue.Empty:
-            pass
-        else:
-            self.add_change_code('evaluation_finished', result_blob)
-        return True
+        ''' notify observers in the gtk thread, callable from any thread. '''
+        
+        GLib.idle_add(self.notify_observers, change_code, parameter)
+        
+    def notify_observers(self, change_code, parameter):
+        change_code_counter.inc('markdown', change_code)
+        with tracer.span(change_code, 'backend_notification'):
+            for observer in self.observers:
+                observer.change_notification(change_code, self, parameter)
+        return False
+    
+    def get_metric_samples(self):
+        ''' gauges for Metrics.add_collector(). '''
+        
+        with self.lock:
+            depth = self.query_queue.qsize()
+            busy = 1 if self.active_query != None else 0
+        return [('gsnb_queue_depth', 'gauge', 'Queries waiting in a compute queue.', [({'queue': 'markdown'}, depth)]),
+                ('gsnb_queue_busy', 'gauge', '1 while a compute queue runs a query.', [({'queue': 'markdown'}, busy)])]
+    
+    def is_current(self, query):
+        ''' False if query (or result blob) belongs to a cancelled evaluation. '''
+        
+        if isinstance(query, dict):
+            return self.generations.is_current(query['cell'], query['generation'])
+        return self.generations.is_current(query.get_cell(), query.generation)
     
+    @traced('backend_queue')
     def add_query(self, query):
-        query.ignore_counter = self.query_ignore_counter.get(query.get_cell(), 0) + 1
-        self.query_queue.put(query)
+        with self.lock:
+            query.generation = self.generations.issue_token(query.get_cell())
+            self.query_queue.put(query)
+        self.event_loop.call_soon(self.wake_compute_loop)
         self.add_change_code('query_queued', query)
         
     def stop_evaluation_by_cell(self, cell):
-        self.query_ignore_counter[cell] = 1 + self.query_ignore_counter.get(cell, 0)
-        if self.state == 'busy' and self.active_query.get_cell() == cell:
-            self.active_query.stop_evaluation()
-            self.state = 'idle'
+        with self.lock:
+            self.generations.cancel(cell)
+            self.query_queue.remove_by_cell(cell)
+            if self.active_query != None and self.active_query.get_cell() == cell:
+                self.active_query.stop_evaluation()
         self.add_change_code('cell_evaluation_stopped', cell)
         
-    def add_result_blob(self, result):
-        self.result_blobs_queue.put(result)
+    def release_cell(self, cell):
+        ''' forget everything about a deleted cell (evaluation was stopped before). '''
+        
+        with self.lock:
+            self.query_queue.remove_by_cell(cell)
+            self.generations.release(cell)
+            self.block_caches.pop(cell, None)
+        
+    def release_worksheet(self, worksheet):
+        with self.lock:
+            for cell in self.query_queue.get_cells():
+                if cell.get_worksheet() == worksheet:
+                    self.generations.cancel(cell)
+                    self.query_queue.remove_by_cell(cell)
+            self.generations.release_worksheet(worksheet)
+            for cell in [cell for cell in self.block_caches if cell.get_worksheet() == worksheet]:
+                del(self.block_caches[cell])
         
     def stop_computation(self):
-        while not self.query_queue.empty():
-            self.query_queue.get(block=False)
-        if self.state == 'busy':
-            self.active_query.stop_evaluation()
-            self.state = 'idle'
+        with self.lock:
+            for query in self.query_queue.remove_all():
+                self.generations.cancel(query.get_cell())
+            if self.active_query != None:
+                self.generations.cancel(self.active_query.get_cell())
+                self.active_query.stop_evaluation()
     
 
 class MarkdownQuery():
+    ''' Renders a markdown cell to a list of blocks, one for each
+        paragraph or header: [style class, pango markup], e.g.
+        ['h2', 'Groups'] or ['p', 'over <i>any</i> ring']. Lists and code
+        blocks become paragraphs, quotes are flattened. The blocks are
+        emitted by a single walk over the element tree Python-Markdown
+        parses the cell to, unsupported elements are reduced to their
+        text.
+        
+        Cells are rendered in chunks that markdown handles independently.
+        With a block cache from the evaluation before (see ComputeQueue),
+        only chunks that changed are rendered again. '''
+
+    header_tags = ['h1', 'h2', 'h3', 'h4', 'h5', 'h6']
+    inline_tags = {'em': 'i', 'i': 'i', 'strong': 'b', 'b': 'b', 'code': 'tt', 'tt': 'tt'}
+    
+    # lines that may continue a block after a blank line: indented, list items, quotes
+    continuation_pattern = re.compile(r'[ \t]|[*+-][ \t]|\d+[.)][ \t]|>')
+    
+    # link references can be used anywhere, raw html blocks may contain blank lines
+    unchunkable_pattern = re.compile(r'^ {0,3}(\[[^\]]+\]:|<)', re.MULTILINE)
+    
+    # labels open links with any program, only these are links, others are shown as text
+    link_pattern = re.compile(r'(https?|mailto):', re.IGNORECASE)
+    
+    # inline html with these tags is rendered (links with href and title),
+    # other tags are shown as text
+    html_tags = dict(inline_tags, a='a')
 
     def __init__(self, worksheet, cell, query_string = ''):
         self.set_query_string(query_string)
         self.worksheet = worksheet
         self.cell = cell
         self.state = 'idle'
-        self.ignore_counter = 0
-        
-        # wrapper
-        self.wrapper_start = '''<interface>
-    <object class="GtkBox" id="buildablewrap">
-        <property name="orientation">vertical</property>
-        <property name="can_focus">False</property>
-'''
-        self.wrapper_end= '''
-    </object>
-</interface>'''
-
-        # paragraphs
-        self.p_start = '''        SPLITMARKER<child>
-            <object class="GtkLabel" id="label-POSITION">
-                <property name="can_focus">False</property>
-                <property name="use_markup">True</property>
-                <property name="track_visited_links">False</property>
-                <property name="wrap">True</property>
-                <property name="wrap_mode">2</property>
-                <property name="xalign">0</property>
-                <property name="single_line_mode">False</property>
-                <property name="label" translatable="no">SPLITMARKER'''
-        self.p_end = '''SPLITMARKER</property>
-                <style>
-                    <class name="p"/>
-                </style>
-            </object>
-            <packing>
-                <property name="expand">True</property>
-                <property name="fill">True</property>
-                <property name="position">POSITION</property>
-            </packing>
-        </child>SPLITMARKER'''
-        self.header_start = '''        SPLITMARKER<child>
-            <object class="GtkLabel" id="label-POSITION">
-                <property name="can_focus">False</property>
-                <property name="use_markup">True</property>
-                <property name="track_visited_links">False</property>
-                <property name="wrap">True</property>
-                <property name="wrap_mode">2</property>
-                <property name="xalign">0</property>
-                <property name="label" translatable="no">SPLITMARKER'''
-        self.header_end = '''SPLITMARKER</property>
-                <style>
-                    <class name="h[[[LEVEL]]]"/>
-                </style>
-            </object>
-            <packing>
-                <property name="expand">False</property>
-                <property name="fill">False</property>
-                <property name="position">POSITION</property>
-            </packing>
-        </child>SPLITMARKER'''
+        self.generation = None
+        self.markdown = None
+        self.block_cache = None # blocks by chunk
+        
+        # scheduling, markdown queries are all served in order
+        self.priority = 'bulk'
+        self.cell_position = 0
 
     def set_query_string(self, query_string):
         self.query_string = query_string
         
+    @traced('markdown')
     def evaluate(self):
-        ''' evaluates markdown cell, paragraph text is handled seperately
-            because gtk.builder doesn't seem to work with pango markup. 
-            it is later inserted in the built gtk widget. in future it would
-            probably be good to have a distinct markdown widget to
-            handle this. '''
+        ''' evaluates markdown cell, the view builds a label for every block. '''
             
         self.state = 'busy'
-        result_blob = markdown.markdown(self.query_string)
-        
-        # remove unsupported tags with bleach
-        supported_tags = ['h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'p', 'a']
-        supported_tags += ['em', 'strong', 'code', 'i', 'b', 'tt']
-        supported_attributes = {'a': ['href', 'title']}
-        result_blob = bleach.clean(result_blob, tags=supported_tags, attributes=supported_attributes)
-        
-        # markup
-        result_blob = result_blob.replace('<em>', '<i>')
-        result_blob = result_blob.replace('</em>', '</i>')
-        result_blob = result_blob.replace('<strong>', '<b>')
-        result_blob = result_blob.replace('</strong>', '</b>')
-        result_blob = result_blob.replace('<code>', '<tt>')
-        result_blob = result_blob.replace('</code>', '</tt>')
-        
-        # paragraphs
-        p_count = 0
-        result_blob = result_blob.replace('<p>', self.p_start)
-        result_blob = result_blob.replace('</p>', self.p_end)
-        
-        for level in range(6):
-            result_blob = result_blob.replace('<h' + str(level+1) + '>', self.header_start)
-            header_end = self.header_end.replace('[[[LEVEL]]]', str(level+1))
-            result_blob = result_blob.replace('</h' + str(level+1) + '>', header_end)
-        
-        p_count = 0
-        while result_blob.find('POSITION') != -1:
-            result_blob = result_blob.replace('POSITION',  str(p_count), 2)
-            p_count += 1
-            
-        # wrapper
-        result_blob = self.wrapper_start + result_blob + 'SPLITMARKER' + self.wrapper_end
+        result_blob = self.query_string
+        for name, stage in self.get_stages():
+            result_blob = stage(result_blob)
 
         self.state = 'idle'
-        return {'worksheet': self.worksheet, 'cell': self.cell, 'result_blob': result_blob}
+        return {'worksheet': self.worksheet, 'cell': self.cell, 'generation': self.generation, 'result_blob': result_blob}
+    
+    def get_stages(self):
+        ''' (name, function) for each step of evaluate(), every function
+            takes the output of the one before. '''
+        
+        return [('chunks', self.get_chunks), ('blocks', self.render_chunks)]
+    
+    def set_block_cache(self, block_cache):
+        self.block_cache = block_cache
+        
+    def get_block_cache(self):
+        return self.block_cache
+    
+    def get_chunks(self, query_string):
+        ''' the cell split at blank lines that aren't followed by a line
+            continuing the block before. '''
+        
+        if self.unchunkable_pattern.search(query_string): return [query_string]
+        chunks = list()
+        lines = list()
+        after_blank_line = False
+        for line in query_string.split('\n'):
+            is_blank = (line.strip() == '')
+            if after_blank_line and not is_blank and not self.continuation_pattern.match(line):
+                chunks.append('\n'.join(lines))
+                lines = list()
+            lines.append(line)
+            after_blank_line = is_blank
+        chunks.append('\n'.join(lines))
+        return chunks
+    
+    def render_chunks(self, chunks):
+        ''' blocks of all chunks, taken from the block cache if possible.
+            the cache is replaced by one for these chunks. '''
+        
+        blocks = list()
+        block_cache = dict()
+        for chunk in chunks:
+            if chunk not in block_cache:
+                if self.block_cache != None and chunk in self.block_cache:
+                    block_cache[chunk] = self.block_cache[chunk]
+                else:
+                    block_cache[chunk] = self.get_blocks(self.parse(chunk))
+            blocks += block_cache[chunk]
+        if self.block_cache != None: self.block_cache = block_cache
+        return blocks
+    
+    def parse(self, query_string):
+        ''' element tree of the cell, what markdown.markdown() does short
+            of serializing it to html. '''
+        
+        if self.markdown == None: self.markdown = markdown.Markdown()
+        self.markdown.reset()
+        if query_string.strip() == '': return None
+        lines = query_string.split('\n')
+        for preprocessor in self.get_processors(self.markdown.preprocessors):
+            lines = preprocessor.run(lines)
+        root = self.markdown.parser.parseDocument(lines).getroot()
+        for treeprocessor in self.get_processors(self.markdown.treeprocessors):
+            new_root = treeprocessor.run(root)
+            if new_root is not None: root = new_root
+        return root
+    
+    def get_processors(self, registry):
+        ''' python-markdown 2 keeps processors in an ordered dict, 3 in a registry. '''
+        
+        return list(registry.values()) if isinstance(registry, dict) else list(registry)
+    
+    def get_blocks(self, root):
+        blocks = list()
+        if root is not None: self.add_blocks(root, blocks)
+        return blocks
+    
+    def add_blocks(self, element, blocks):
+        for child in element:
+            if not isinstance(child.tag, str): continue
+            if child.tag in self.header_tags:
+                blocks.append([child.tag, self.get_markup(child).strip()])
+            elif child.tag in ['ul', 'ol']:
+                for number, item in enumerate(child):
+                    bullet = '• ' if child.tag == 'ul' else str(number + 1) + '. '
+                    blocks.append(['p', bullet + self.get_markup(item).strip()])
+            elif child.tag == 'pre':
+                blocks.append(['p', '<tt>' + self.escape(''.join(child.itertext())).rstrip('\n') + '</tt>'])
+            elif child.tag in ['blockquote', 'div']:
+                self.add_blocks(child, blocks)
+            elif child.tag != 'hr':
+                blocks.append(['p', self.get_markup(child).strip()])
+    
+    def get_markup(self, element):
+        ''' pango markup of the inline content of element. '''
+        
+        markup = list()
+        self.html_stack = list() # [pango tag or None, element level] of open inline html tags
+        self.element_level = 0
+        self.add_markup(element, markup, 0)
+        self.close_html_tags(markup)
+        return ''.join(markup)
+    
+    def add_markup(self, element, markup, depth):
+        if element.text: self.add_text(element.text, markup)
+        for child in element:
+            if not isinstance(child.tag, str):
+                pass
+            elif child.tag in self.inline_tags:
+                markup.append('<' + self.inline_tags[child.tag] + '>')
+                self.add_element_markup(child, markup, depth)
+                markup.append('</' + self.inline_tags[child.tag] + '>')
+            elif child.tag == 'a':
+                href = self.get_text(child.get('href', '')).strip()
+                if self.link_pattern.match(href) == None:
+                    self.add_markup(child, markup, depth)
+                else:
+                    self.add_link_start(href, self.get_text(child.get('title')) if child.get('title') != None else None, markup)
+                    self.add_element_markup(child, markup, depth)
+                    markup.append('</a>')
+            elif child.tag == 'br':
+                if not (child.tail or '').startswith('\n'): markup.append('\n')
+            elif child.tag == 'img':
+                markup.append(self.escape(child.get('alt', ''), True))
+            elif child.tag in ['ul', 'ol']:
+                for number, item in enumerate(child):
+                    bullet = '• ' if child.tag == 'ul' else str(number + 1) + '. '
+                    self.add_line_break(markup)
+                    markup.append('    ' * (depth + 1) + bullet)
+                    self.add_markup(item, markup, depth + 1)
+            elif child.tag == 'p':
+                if len(markup) > 0:
+                    self.add_line_break(markup)
+                    markup.append('\n')
+                self.add_markup(child, markup, depth)
+            else:
+                self.add_markup(child, markup, depth)
+            if child.tail: self.add_text(child.tail, markup)
+    
+    def add_element_markup(self, element, markup, depth):
+        ''' markup of an element that is wrapped in a pango tag, inline html
+            tags opened inside are closed before that tag. '''
+        
+        self.element_level += 1
+        self.add_markup(element, markup, depth)
+        self.close_html_tags(markup)
+        self.element_level -= 1
+    
+    def add_link_start(self, href, title, markup):
+        markup.append('<a href="' + html.escape(href, True) + '"')
+        if title != None: markup.append(' title="' + html.escape(title, True) + '"')
+        markup.append('>')
+    
+    def add_text(self, text, markup):
+        ''' text of the element tree with inline html, see InlineHTMLParser. '''
+        
+        text = self.get_raw_text(text)
+        if '<' in text:
+            parser = InlineHTMLParser(self, markup)
+            parser.feed(text)
+            parser.close()
+        else:
+            markup.append(html.escape(html.unescape(text), False))
+    
+    def open_html_tag(self, tag, attributes, text, markup):
+        if tag not in self.html_tags:
+            markup.append(html.escape(text, False))
+        elif tag == 'a':
+            href = (attributes.get('href') or '').strip()
+            if self.link_pattern.match(href) == None:
+                self.html_stack.append([None, self.element_level])
+            else:
+                self.add_link_start(href, attributes.get('title'), markup)
+                self.html_stack.append(['a', self.element_level])
+        else:
+            markup.append('<' + self.html_tags[tag] + '>')
+            self.html_stack.append([self.html_tags[tag], self.element_level])
+    
+    def close_html_tag(self, tag, markup):
+        ''' end tags that don't close the innermost open tag are left out,
+            pango needs properly nested markup. '''
+        
+        if tag not in self.html_tags:
+            markup.append(html.escape('</' + tag + '>', False))
+        elif len(self.html_stack) > 0 and self.html_stack[-1][1] == self.element_level:
+            pango_tag = 'a' if tag == 'a' else self.html_tags[tag]
+            if self.html_stack[-1][0] in (pango_tag, None):
+                if self.html_stack.pop()[0] != None: markup.append('</' + pango_tag + '>')
+    
+    def close_html_tags(self, markup):
+        ''' close inline html tags left open at the current element level. '''
+        
+        while len(self.html_stack) > 0 and self.html_stack[-1][1] == self.element_level:
+            pango_tag = self.html_stack.pop()[0]
+            if pango_tag != None: markup.append('</' + pango_tag + '>')
+    
+    def add_line_break(self, markup):
+        if len(markup) > 0 and not markup[-1].endswith('\n'): markup.append('\n')
+    
+    def escape(self, text, quote=False):
+        ''' text of the element tree to pango markup. '''
+        
+        return html.escape(self.get_text(text), quote)
+    
+    def get_text(self, text):
+        ''' text of the element tree still has placeholders for raw html
+            and entities, these are shown as text. '''
+        
+        return html.unescape(self.get_raw_text(text))
+    
+    def get_raw_text(self, text):
+        ''' text of the element tree with raw html and entities put back. '''
+        
+        for postprocessor in self.get_processors(self.markdown.postprocessors):
+            text = postprocessor.run(text)
+        return text
+    
+    def get_error_result(self, message):
+        self.state = 'idle'
+        return {'worksheet': self.worksheet, 'cell': self.cell, 'generation': self.generation, 'result_blob': list()}
     
     def stop_evaluation(self):
         if self.state == 'busy':
@@ -239,3 +461,27 @@ class MarkdownQuery():
         
     def get_state(self):
         return self.state
+
+
+class InlineHTMLParser(html.parser.HTMLParser):
+    ''' Inline html of a markdown cell to pango markup, the way the bleach
+        whitelist of earlier versions let it through: tags of
+        MarkdownQuery.html_tags are rendered, other tags are shown as text,
+        comments are left out. '''
+
+    def __init__(self, query, markup):
+        html.parser.HTMLParser.__init__(self, convert_charrefs=True)
+        self.query = query
+        self.markup = markup
+
+    def handle_starttag(self, tag, attributes):
+        self.query.open_html_tag(tag, dict(attributes), self.get_starttag_text(), self.markup)
+
+    def handle_startendtag(self, tag, attributes):
+        self.markup.append(html.escape(self.get_starttag_text(), False))
+
+    def handle_endtag(self, tag):
+        self.query.close_html_tag(tag, self.markup)
+
+    def handle_data(self, data):
+        self.markup.append(html.escape(data, False))
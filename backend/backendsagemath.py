@@ -16,68 +16,144 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>
 
 import gi
-from gi.repository import GLib, GObject
-import pexpect
-import os
-import sys
-import tempfile
-import shutil
+from gi.repository import GLib
+import asyncio
 import time
-import _thread as thread, queue
-from os.path import expanduser
+import threading
+import queue
+from backend.eventloop import get_backend_event_loop
+from backend.sessionreplay import create_interface
+from backend.completion import StaticCompletionIndex
+from backend.introspection import IntrospectionCache
+from backend.queryqueue import QueryQueue
+from backend.cancellation import CellGenerations
+from model.tracing import get_tracer, traced
+from model.metrics import get_metrics
+
+tracer = get_tracer()
+change_code_counter = get_metrics().counter('gsnb_backend_notifications_total', 'Notifications compute queues sent to the gtk thread.', ('queue', 'code'))
 
 
 class ComputeQueue(object):
+    ''' Runs queries, one compute task per worksheet on the backend event
+        loop, so many kernels are driven from one thread without polling.
+
+        Shared state (states, active_queries, query_queues, restarting) is
+        only touched while holding self.lock. states and active_queries are
+        written by the compute task of the worksheet only, the gtk thread
+        reads them and cancels through self.generations and the query
+        queues. A query that was started always produces exactly one
+        'evaluation_finished', observers use is_current() to tell if it
+        has been cancelled in the meantime. Observers are notified in the
+        gtk thread through GLib.idle_add(). '''
 
     def __init__(self):
         self.observers = set()
+        self.lock = threading.RLock()
         self.states = dict()
         self.query_queues = dict() # put computation tasks on here
-        self.query_ignore_counter = dict()
+        self.generations = CellGenerations() # cancellation tokens
         self.active_queries = dict()
-        self.result_blobs_queue = queue.Queue() # computation results are put on here
-        self.change_code_queue = queue.Queue() # change code for observers are put on here
-        self.interface = InterfacePexpect()
-        GObject.timeout_add(50, self.results_loop)
-        GObject.timeout_add(50, self.change_code_loop)
-        
-    def compute_loop(self, worksheet):
-        ''' wait for queries, run them and put results on the queue.
-            this method runs in thread. '''
+        self.restarting = set() # worksheets waiting for a kernel restart
+        self.wakeups = dict() # asyncio.Event by worksheet, backend thread only
+        self.changed_schedules = set() # worksheets with queue changes not yet shown
+        self.schedule_update_pending = False
+        self.notifications_pending = 0
+        self.interface = create_interface()
+        self.static_completion_indexes = dict() # by backend, backend thread only
+        self.introspection_caches = dict() # by worksheet, backend thread only
+        self.event_loop = get_backend_event_loop()
+        
+    async def compute_loop(self, worksheet):
+        ''' wait for queries, run them and send results to observers.
+            this coroutine runs in the backend event loop. '''
 
+        wakeup = self.wakeups[worksheet]
         while True:
-            time.sleep(0.05)
-            
-            # if query complete set state idle
-            if self.get_state(worksheet) == 'busy':
-                self.states[worksheet] = self.active_queries[worksheet].get_state()
-            
+        
             # check for tasks, start computation
-            if self.get_state(worksheet) == 'idle':
-                try:
-                    self.active_queries[worksheet] = self.query_queues[worksheet].get(block=False)
-                except queue.Empty:
-                    pass
-                else:
-                    cell = self.active_queries[worksheet].get_cell()
-                    if self.active_queries[worksheet].ignore_counter >= self.query_ignore_counter.get(cell, 0):
+            with self.lock:
+                if worksheet not in self.query_queues:
+                    del(self.wakeups[worksheet])
+                    return
+                restart = worksheet in self.restarting
+                query = None
+                if not restart:
+                    try:
+                        query = self.query_queues[worksheet].get(block=False)
+                    except queue.Empty:
+                        pass
+                    else:
+                        if not self.generations.is_current(query.get_cell(), query.generation): continue
+                        query.timestamps['started'] = time.time()
                         self.states[worksheet] = 'busy'
-                        self.add_change_code('evaluation_started', self.active_queries[worksheet])
-                        result_blob = self.active_queries[worksheet].evaluate(self.interface)
-                        self.add_result_blob(result_blob)
-                    else: pass
-                        
-    def change_code_loop(self):
-        ''' notify observers '''
+                        self.active_queries[worksheet] = query
+                        self.mark_schedule_changed(worksheet)
+                        self.add_change_code('evaluation_started', query)
 
-        try:
-            change_code = self.change_code_queue.get(block=False)
-        except queue.Empty:
-            pass
-        else:
-            for observer in self.observers:
-                observer.change_notification(change_code['change_code'], self, change_code['parameter'])
-        return True
+            if restart:
+                await self.restart_kernel(worksheet)
+                continue
+            if query == None:
+                wakeup.clear()
+                await wakeup.wait()
+                continue
+
+            time_start = time.time()
+            try:
+                with tracer.async_span('evaluate', 'backend_queue', {'cell': query.cell_position}):
+                    result_blob = await query.evaluate(self.interface)
+            except Exception as e:
+                result_blob = query.get_error_result('Kernel error: ' + str(e))
+            self.get_introspection_cache(worksheet).invalidate()
+
+            # query complete, set state idle
+            query.timestamps['finished'] = time.time()
+            with self.lock:
+                if worksheet in self.query_queues:
+                    self.query_queues[worksheet].add_duration(time.time() - time_start)
+                    self.states[worksheet] = 'idle'
+                    self.active_queries[worksheet] = None
+                self.add_change_code('evaluation_finished', result_blob)
+
+    def start_compute_loop(self, worksheet):
+        ''' runs in backend thread. '''
+        
+        if worksheet not in self.wakeups:
+            self.wakeups[worksheet] = asyncio.Event()
+            asyncio.ensure_future(self.compute_loop(worksheet))
+
+    def wake_compute_loop(self, worksheet):
+        ''' runs in backend thread. '''
+        
+        if worksheet in self.wakeups:
+            self.wakeups[worksheet].set()
+        
+    def mark_schedule_changed(self, worksheet):
+        ''' send queue positions of waiting cells, at most every 250ms. '''
+        
+        with self.lock:
+            self.changed_schedules.add(worksheet)
+            if not self.schedule_update_pending:
+                self.schedule_update_pending = True
+                GLib.timeout_add(250, self.send_schedules)
+    
+    def send_schedules(self):
+        schedules = list()
+        with self.lock:
+            for worksheet in self.changed_schedules:
+                if worksheet in self.query_queues:
+                    active_query = self.active_queries.get(worksheet)
+                    if active_query != None and 'started' in active_query.timestamps:
+                        running_seconds = time.time() - active_query.timestamps['started']
+                    else:
+                        running_seconds = None
+                    schedules.append(self.query_queues[worksheet].get_schedule(running_seconds))
+            self.changed_schedules = set()
+            self.schedule_update_pending = False
+        for schedule in schedules:
+            self.add_change_code_now('query_schedule_changed', schedule)
+        return False
     
     def register_observer(self, observer):
         ''' Observer call this method to register themselves with observable
@@ -88,245 +164,285 @@ class ComputeQueue(object):
         self.observers.add(observer)
 
     def add_change_code(self, change_code, parameter):
-        self.change_code_queue.put({'change_code': change_code, 'parameter': parameter})
+        ''' notify observers in the gtk thread, callable from any thread. '''
+        
+        with self.lock:
+            self.notifications_pending += 1
+        GLib.idle_add(self.notify_observers, change_code, parameter)
+        
+    def notify_observers(self, change_code, parameter):
+        with self.lock:
+            self.notifications_pending -= 1
+        self.add_change_code_now(change_code, parameter)
+        return False
                 
     def add_change_code_now(self, change_code, parameter):
-        for observer in self.observers:
+        change_code_counter.inc('sagemath', change_code)
+        with tracer.span(change_code, 'backend_notification'):
+            for observer in self.observers:
                 observer.change_notification(change_code, self, parameter)
                 
-    def results_loop(self):
-        ''' wait for results and add them to their cells '''
-
-        try:
-            result_blob = self.result_blobs_queue.get(block=False)
-        except queue.Empty:
-            pass
-        else:
-            self.add_change_code('evaluation_finished', result_blob)
-        return True
-        
     def get_state(self, worksheet):
-        if not worksheet in self.states.keys():
-            self.states[worksheet] = 'idle'
-        return self.states[worksheet]
+        with self.lock:
+            return self.states.get(worksheet, 'idle')
         
     def get_active_query(self, worksheet):
-        if not worksheet in self.active_queries.keys():
-            self.active_queries[worksheet] = None
-        return self.active_queries[worksheet]
+        with self.lock:
+            return self.active_queries.get(worksheet, None)
         
     def get_query_queue(self, worksheet):
-        if not worksheet in self.query_queues.keys():
-            self.query_queues[worksheet] = queue.Queue()
-            thread.start_new_thread(self.compute_loop, (worksheet,))
-        return self.query_queues[worksheet]
+        with self.lock:
+            if not worksheet in self.query_queues.keys():
+                self.query_queues[worksheet] = QueryQueue()
+                self.event_loop.call_soon(self.start_compute_loop, worksheet)
+            return self.query_queues[worksheet]
+    
+    def is_current(self, query):
+        ''' False if query (or result blob) belongs to a cancelled evaluation. '''
+        
+        if isinstance(query, dict):
+            return self.generations.is_current(query['cell'], query['generation'])
+        return self.generations.is_current(query.get_cell(), query.generation)
+    
+    def get_metric_samples(self):
+        ''' gauges for Metrics.add_collector(), queues by worksheet and
+            kernels. called from the metrics thread. '''
+        
+        with self.lock:
+            queues = [({'queue': 'sagemath', 'worksheet': worksheet.get_name()}, query_queue.qsize(), 1 if worksheet in self.active_queries else 0)
+                      for worksheet, query_queue in self.query_queues.items()]
+        kernels = list()
+        for worksheet, process in self.interface.get_kernels():
+            usage = process.get_resource_usage()
+            if usage != None:
+                kernels.append(({'worksheet': worksheet.get_name(), 'kernel': process.name, 'pid': usage['pid']}, usage))
+        return [('gsnb_queue_depth', 'gauge', 'Queries waiting in a compute queue.', [(labels, depth) for labels, depth, busy in queues]),
+                ('gsnb_queue_busy', 'gauge', '1 while a compute queue runs a query.', [(labels, busy) for labels, depth, busy in queues]),
+                ('gsnb_kernels', 'gauge', 'Running kernel processes.', [({}, len(kernels))]),
+                ('gsnb_kernel_resident_memory_bytes', 'gauge', 'Resident memory of a kernel process.', [(labels, usage['rss']) for labels, usage in kernels]),
+                ('gsnb_kernel_cpu_seconds_total', 'counter', 'CPU time a kernel process used.', [(labels, usage['cpu']) for labels, usage in kernels])]
     
+    @traced('backend_queue')
     def add_query(self, query):
-        queue = self.get_query_queue(query.worksheet)
-        query.ignore_counter = self.query_ignore_counter.get(query.get_cell(), 0) + 1
-        queue.put(query)
+        with self.lock:
+            queue = self.get_query_queue(query.worksheet)
+            query.generation = self.generations.issue_token(query.get_cell())
+            query.timestamps['queued'] = time.time()
+            queue.put(query)
+            self.mark_schedule_changed(query.worksheet)
+        self.event_loop.call_soon(self.wake_compute_loop, query.worksheet)
         self.add_change_code('query_queued', query)
         
+    @traced('backend_queue')
     def stop_evaluation_by_cell(self, cell):
         worksheet = cell.get_worksheet()
-        queue = self.get_query_queue(worksheet)
-        self.query_ignore_counter[cell] = 1 + self.query_ignore_counter.get(cell, 0)
-        if self.get_state(worksheet) == 'busy' and self.get_active_query(worksheet).get_cell() == cell:
-            self.active_queries[worksheet].stop_evaluation()
-            self.states[worksheet] = 'idle'
+        with self.lock:
+            self.generations.cancel(cell)
+            if worksheet in self.query_queues:
+                if len(self.query_queues[worksheet].remove_by_cell(cell)) > 0:
+                    self.mark_schedule_changed(worksheet)
+            active_query = self.active_queries.get(worksheet, None)
+            if active_query != None and active_query.get_cell() == cell:
+                self.event_loop.call_soon(active_query.stop_evaluation)
         self.add_change_code_now('cell_evaluation_stopped', cell)
         
+    @traced('backend_queue')
     def stop_evaluation_by_worksheet(self, worksheet):
-        queue = self.get_query_queue(worksheet)
+        stopped_cells = list()
+        with self.lock:
+            if worksheet in self.query_queues:
+                for query in self.query_queues[worksheet].remove_all():
+                    self.generations.cancel(query.get_cell())
+                    stopped_cells.append(query.get_cell())
+            active_query = self.active_queries.get(worksheet, None)
+            if active_query != None:
+                self.generations.cancel(active_query.get_cell())
+                self.event_loop.call_soon(active_query.stop_evaluation)
+                stopped_cells.append(active_query.get_cell())
 
-        while not queue.empty():
-            query = queue.get(block=False)
-            cell = query.get_cell()
+        for cell in stopped_cells:
             self.add_change_code_now('cell_evaluation_stopped', cell)
-            
-        if self.get_state(worksheet) == 'busy':
-            cell = self.get_active_query(worksheet).get_cell()
-            self.get_active_query(worksheet).stop_evaluation()
-            self.add_change_code_now('cell_evaluation_stopped', cell)
-
-        self.states[worksheet] = 'idle'
         
-    def add_result_blob(self, result):
-        self.result_blobs_queue.put(result)
-            
+    def release_cell(self, cell):
+        ''' forget everything about a deleted cell (evaluation was stopped before). '''
+        
+        worksheet = cell.get_worksheet()
+        with self.lock:
+            if worksheet in self.query_queues:
+                self.query_queues[worksheet].remove_by_cell(cell)
+            self.generations.release(cell)
+        
+    def release_worksheet(self, worksheet):
+        ''' stop and forget a deleted worksheet, ends its compute task. '''
+        
+        self.stop_evaluation_by_worksheet(worksheet)
+        with self.lock:
+            self.query_queues.pop(worksheet, None)
+            self.states.pop(worksheet, None)
+            self.active_queries.pop(worksheet, None)
+            self.restarting.discard(worksheet)
+            self.changed_schedules.discard(worksheet)
+            self.generations.release_worksheet(worksheet)
+        self.event_loop.call_soon(self.wake_compute_loop, worksheet)
+        self.event_loop.call_soon(self.interface.stop_process, worksheet)
+        self.event_loop.call_soon(self.introspection_caches.pop, worksheet, None)
+        
     def start_process(self, worksheet):
-        self.interface.get_process(worksheet)
-        self.add_change_code('kernel_started', worksheet)
+        ''' start kernel in the background, observers get 'kernel_started'
+            or 'kernel_start_failed'. '''
+        
+        self.event_loop.run_coroutine(self.start_kernel(worksheet))
+        
+    async def start_kernel(self, worksheet):
+        try:
+            await self.interface.get_process(worksheet)
+        except Exception as e:
+            self.add_change_code('kernel_start_failed', {'worksheet': worksheet, 'message': str(e)})
+        else:
+            self.add_change_code('kernel_started', worksheet)
+    
+    def request_kernel_statistics(self, worksheet):
+        ''' observers get 'kernel_statistics_received' once the kernel
+            answered, after the running query if there is one. '''
+        
+        self.event_loop.run_coroutine(self.send_kernel_statistics(worksheet))
+        
+    async def send_kernel_statistics(self, worksheet):
+        statistics = await self.interface.get_statistics(worksheet)
+        self.add_change_code('kernel_statistics_received', {'worksheet': worksheet, 'statistics': statistics})
+    
+    def request_memory_diff(self, worksheet, first, second):
+        ''' observers get 'memory_diff_received' with the allocation sites
+            that changed between two memory snapshots of the kernel. '''
+        
+        self.event_loop.run_coroutine(self.send_memory_diff(worksheet, first, second))
+        
+    async def send_memory_diff(self, worksheet, first, second):
+        diff = await self.interface.get_memory_diff(worksheet, first, second)
+        self.add_change_code('memory_diff_received', {'worksheet': worksheet, 'first': first, 'second': second, 'diff': diff})
+    
+    def request_completions(self, cell, prefix):
+        ''' observers get 'completions_received'. the kernel answers even
+            while it is running a query, if it doesn't answer within a few
+            milliseconds the static index is used. '''
+        
+        self.event_loop.run_coroutine(self.send_completions(cell, prefix))
+        
+    async def send_completions(self, cell, prefix):
+        worksheet = cell.get_worksheet()
+        completions = await self.interface.get_completions(worksheet, prefix)
+        source = 'kernel'
+        if completions == None:
+            backend = worksheet.get_backend()
+            if backend not in self.static_completion_indexes:
+                kernel_class = self.interface.kernel_classes.get(backend, self.interface.kernel_classes['sage'])
+                self.static_completion_indexes[backend] = StaticCompletionIndex(kernel_class.get_static_completion_index_pathname())
+            completions = self.static_completion_indexes[backend].complete(prefix)
+            source = 'static'
+        self.add_change_code('completions_received', {'cell': cell, 'prefix': prefix, 'completions': completions, 'source': source})
+    
+    def get_introspection_cache(self, worksheet):
+        ''' runs in backend thread. '''
+        
+        if worksheet not in self.introspection_caches:
+            self.introspection_caches[worksheet] = IntrospectionCache()
+        return self.introspection_caches[worksheet]
+    
+    def request_introspection(self, cell, name):
+        ''' observers get 'introspection_received' with signature, docstring
+            and source location of name (None if the kernel doesn't know it).
+            answered by the kernel on the completion side channel, so
+            queued evaluations aren't disturbed. '''
+        
+        self.event_loop.run_coroutine(self.send_introspection(cell, name))
+        
+    async def send_introspection(self, cell, name):
+        worksheet = cell.get_worksheet()
+        cache = self.get_introspection_cache(worksheet)
+        await self.fetch_introspections(worksheet, [name])
+        introspection = cache.get(name)[1]
+        self.add_change_code('introspection_received', {'cell': cell, 'name': name, 'introspection': introspection})
+    
+    def prefetch_introspections(self, worksheet, names):
+        ''' look up names ahead of time, e.g. all names in the active cell. '''
+        
+        self.event_loop.run_coroutine(self.fetch_introspections(worksheet, names))
+        
+    async def fetch_introspections(self, worksheet, names):
+        cache = self.get_introspection_cache(worksheet)
+        missing_names = cache.get_missing(names)
+        if len(missing_names) == 0: return
+        epoch = cache.epoch
+        introspections = await self.interface.get_introspections(worksheet, missing_names)
+        if introspections == None: return
+        for name in missing_names:
+            cache.add(name, introspections.get(name, None), epoch)
     
     def restart_process(self, worksheet):
-        while len(worksheet.busy_cells) > 0:
-            time.sleep(0.05)
+        ''' kernel is restarted by the compute task as soon as the running
+            query (if any) returns, new queries wait for the new kernel. '''
+        
+        with self.lock:
+            self.restarting.add(worksheet)
+            self.get_query_queue(worksheet)
+        self.event_loop.call_soon(self.wake_compute_loop, worksheet)
+        
+    @traced('backend_queue')
+    async def restart_kernel(self, worksheet):
         self.interface.stop_process(worksheet)
-        thread.start_new_thread(self.start_process, (worksheet,))
+        self.get_introspection_cache(worksheet).invalidate()
+        try:
+            await self.start_kernel(worksheet)
+        finally:
+            with self.lock:
+                self.restarting.discard(worksheet)
     
 
 class SageMathQuery():
 
-    def __init__(self, worksheet, cell, query_string = ''):
+    def __init__(self, worksheet, cell, query_string = '', priority = 'bulk', mode = 'normal', track_memory = False):
         self.set_query_string(query_string)
+        self.mode = mode # 'normal', 'trial' or 'profile', see KernelProcess.run()
+        self.track_memory = track_memory # take tracemalloc snapshots
+        self.timestamps = dict() # of evaluation stages, see CodeCell.get_latency_breakdown()
         self.worksheet = worksheet
         self.cell = cell
         self.state = 'idle'
         self.interface = None
-        self.ignore_counter = 0
+        self.generation = None
+        
+        # scheduling: 'interactive' queries overtake 'bulk' ones for cells below them
+        self.priority = priority
+        self.cell_position = cell.get_worksheet_position()
 
     def set_query_string(self, query_string):
         self.query_string = query_string
         
-    def evaluate(self, interface, sage_mode = True):
+    async def evaluate(self, interface, sage_mode = True):
         self.interface = interface
         self.state = 'busy'
-        query_string = self.query_string
-        result_blob = interface.run(self.query_string, self.worksheet, sage_mode)
+        result_blob = await interface.run(self.query_string, self.worksheet, sage_mode, self.mode, self.track_memory)
+        if result_blob != None:
+            self.timestamps.update(result_blob.pop('timestamps', {}))
+            if self.mode == 'trial': result_blob['trial'] = True
         
         self.state = 'idle'
-        return {'worksheet': self.worksheet, 'cell': self.cell, 'result_blob': result_blob}
+        return {'worksheet': self.worksheet, 'cell': self.cell, 'generation': self.generation, 'result_blob': result_blob, 'timestamps': self.timestamps}
+    
+    def get_error_result(self, message):
+        self.state = 'idle'
+        result_blob = {'text': message, 'files': [], 'path': ''}
+        return {'worksheet': self.worksheet, 'cell': self.cell, 'generation': self.generation, 'result_blob': result_blob, 'timestamps': self.timestamps}
     
     def stop_evaluation(self):
+        ''' runs in backend thread, only interrupts the kernel.
+            evaluate() then returns in the compute task. '''
+        
         if self.state == 'busy':
-            self.interface.stop_computation()
-            self.state = 'idle'
+            self.interface.stop_computation_by_worksheet(self.worksheet)
     
     def get_cell(self):
         return self.cell
         
     def get_state(self):
         return self.state
-
-
-class SageMathProcess():
-
-    def __init__(self):
-
-        self.state = 'not started'
-
-    def start(self):
-        ''' initialize python process '''
-        
-        #os.environ['SAGE_LOCAL'] = '/usr/share/sagemath/'
-        self.process = pexpect.spawn('sage --python')
-        self.process.expect('>>> ', timeout=None)
-        self.process.sendline('import sys')
-        self.process.expect('>>> ', timeout=None)
-        self.process.sendline('import tempfile')
-        self.process.expect('>>> ', timeout=None)
-        self.process.sendline('import shutil')
-        self.process.expect('>>> ', timeout=None)
-        self.process.sendline('import os; import base64')
-        self.process.expect('>>> ', timeout=None)
-        self.process.sendline('import sagenb.misc.support as _support_')
-        self.process.expect('>>> ', timeout=None)
-        self.process.sendline('from sage.all_notebook import *')
-        self.process.expect('>>> ', timeout=None)
-        self.process.sendline('from sage.misc.displayhook import DisplayHook')
-        self.process.expect('>>> ', timeout=None)
-        self.process.sendline('sys.displayhook = DisplayHook()')
-        self.process.expect('>>> ', timeout=None)
-        self.process.sendline('sage.plot.plot.EMBEDDED_MODE = True')
-        self.process.expect('>>> ', timeout=None)
-        
-        self.expect_result = True
-
-        # list of temporary directory paths
-        self.temporary_directory_paths = []
-
-        # create permanent directory
-        self.permanent_directory_path = expanduser('~/.sage/sc_store/' )
-        if not os.path.exists(self.permanent_directory_path):
-            os.mkdir(self.permanent_directory_path)
-            
-        self.state = 'started'
-    
-    def run(self, query_string, sage_mode = True):
-
-        self.expect_result = True
-
-        # move to temporary directory
-        self.process.sendline('print tempfile.mkdtemp()')
-        self.process.expect('>>> ', timeout=None)
-        td_path = str(self.process.before).split('\\r\\n')
-        td_path = td_path[1]
-        self.temporary_directory_paths.append(td_path)
-        self.process.sendline('os.chdir(\'' + td_path + '\')')
-        self.process.expect('>>> ', timeout=None)
-        
-        # run query
-        if sage_mode == True:
-            self.process.sendline('exec(_support_.preparse_worksheet_cell('+repr(query_string.strip())+', globals()))')
-        else:
-            self.process.sendline(query_string)
-            
-        # return results
-        self.process.expect('>>> ', timeout=None)
-        if self.expect_result == True:
-            results_text = '\n'.join(str(self.process.before).split('\\r\\n')[1:-1])
-            results_files = os.listdir(td_path)
-            result_blob = {'text' : results_text, 'files' : results_files, 'path' : td_path + '/'}
-            self.process.sendline('os.chdir(\'' + self.permanent_directory_path + '\')')
-            self.process.expect('>>> ', timeout=None)
-            return result_blob
-        else:
-            return None
-    
-    def delete_temporary_directories(self):
-        for td_path in self.temporary_directory_paths:
-            self.process.sendline('shutil.rmtree(\'' + td_path + '\')')
-            self.process.expect('>>> ', timeout=None)
-        
-    def stop_computation(self):
-        self.expect_result = False
-        self.process.sendline(chr(3)) # ctrl-c
-        self.process.expect('>>> ', timeout=None)
-
-    def __del__(self):
-        self.delete_temporary_directories()
-        self.process.kill(1)
-
-
-class InterfacePexpect():
-
-    def __init__(self):
-        
-        self.sagemath_processes = {}
-    
-    def get_process(self, worksheet):
-        ''' Returns present or new sagemath process. '''
-        
-        if not worksheet in self.sagemath_processes.keys():
-            self.sagemath_processes[worksheet] = SageMathProcess()
-            self.sagemath_processes[worksheet].start()
-        else:
-            while self.sagemath_processes[worksheet].state == 'not started':
-                time.sleep(0.05)
-            return self.sagemath_processes[worksheet]
-        
-    def stop_process(self, worksheet):
-        ''' Kills sagemath process if present. '''
-
-        if worksheet in self.sagemath_processes.keys():
-            del(self.sagemath_processes[worksheet])
-
-    def run(self, query_string, worksheet, sage_mode = True):
-        process = self.get_process(worksheet)
-        process.stop_computation()
-        return process.run(query_string, sage_mode)
-        
-    def stop_computation_by_worksheet(self, worksheet):
-        process = self.get_process(worksheet)
-        process.stop_computation()
-        
-    def stop_computation(self):
-        for process in self.sagemath_processes:
-            if self.sagemath_processes[process].state == 'started':
-                self.sagemath_processes[process].stop_computation()
-        
-    def __del__(self):
-        ''' destructor, unlinks all processes '''
-        self.sagemath_processes = {}
-        
-
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (C) 2017, 2018 Robert Griesel
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>
+
+import threading
+
+
+class CellGenerations(object):
+    ''' Cancellation tokens for queries.
+
+        Every cell that has queries has a generation number, a query
+        remembers the generation of its cell when it is queued. Cancelling
+        a cell increments the generation, which invalidates all of the
+        cell's queries at once, including one a compute thread has just
+        taken off the queue. Entries are released when cells or worksheets
+        are removed, so no references to deleted cells are kept. Safe to use
+        from the gtk thread and compute threads. '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.generations = dict()
+
+    def issue_token(self, cell):
+        ''' generation to store in a new query for this cell. '''
+
+        with self.lock:
+            return self.generations.setdefault(cell, 0)
+
+    def cancel(self, cell):
+        with self.lock:
+            if cell in self.generations:
+                self.generations[cell] += 1
+
+    def is_current(self, cell, generation):
+        with self.lock:
+            return self.generations.get(cell) == generation
+
+    def release(self, cell):
+        with self.lock:
+            self.generations.pop(cell, None)
+
+    def release_worksheet(self, worksheet):
+        with self.lock:
+            for cell in [cell for cell in self.generations if cell.get_worksheet() == worksheet]:
+                del(self.generations[cell])
+
+    def __len__(self):
+        with self.lock:
+            return len(self.generations)
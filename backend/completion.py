@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (C) 2017, 2018 Robert Griesel
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>
+
+import bisect
+import builtins
+import keyword
+import os.path
+
+
+def complete_from_sorted_names(names, prefix, limit):
+    ''' names starting with prefix, private names only if prefix starts with _. '''
+
+    completions = list()
+    index = bisect.bisect_left(names, prefix)
+    while index < len(names) and len(completions) < limit and names[index].startswith(prefix):
+        if prefix.startswith('_') or not names[index].startswith('_'):
+            completions.append(names[index])
+        index += 1
+    return completions
+
+
+class StaticCompletionIndex(object):
+    ''' Completion without a kernel: python keywords and builtins plus the
+        global names a kernel wrote to pathname when it last started (for
+        sage that is sage.all). Used while the kernel is busy or down. '''
+
+    def __init__(self, pathname):
+        self.pathname = pathname
+        self.base_names = set(keyword.kwlist) | set(dir(builtins))
+        self.names = sorted(self.base_names)
+        self.mtime = None
+
+    def update(self):
+        ''' reread names if the kernel wrote a new index file. '''
+
+        try:
+            mtime = os.path.getmtime(self.pathname)
+        except OSError:
+            return
+        if mtime != self.mtime:
+            self.mtime = mtime
+            try:
+                with open(self.pathname, 'r') as filehandle:
+                    names = set(filehandle.read().split())
+            except (IOError, UnicodeDecodeError):
+                return
+            self.names = sorted(names | self.base_names)
+
+    def complete(self, prefix, limit=100):
+        if '.' in prefix: return list()
+        self.update()
+        return complete_from_sorted_names(self.names, prefix, limit)
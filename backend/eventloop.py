@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (C) 2017, 2018 Robert Griesel
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>
+
+import asyncio
+import threading
+
+
+class BackendEventLoop(object):
+    ''' One asyncio event loop in one thread, drives all kernels and the
+        markdown renderer. The gtk thread hands work over with call_soon()
+        and run_coroutine(), results go back with GLib.idle_add(). '''
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run, name='backend', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def call_soon(self, callback, *args):
+        ''' run callback(*args) in the backend thread. '''
+
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def run_coroutine(self, coroutine):
+        ''' schedule coroutine in the backend thread, returns a
+            concurrent.futures.Future. '''
+
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def is_backend_thread(self):
+        return threading.current_thread() == self.thread
+
+    def stop(self):
+        ''' cancel all tasks (compute loops, kernel starts) and end the
+            thread, so nothing is left pending when the program exits.
+            call from another thread. '''
+
+        self.run_coroutine(self.cancel_tasks()).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    async def cancel_tasks(self):
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+backend_event_loop = None
+
+def get_backend_event_loop():
+    ''' the event loop shared by all compute queues, started on first use. '''
+
+    global backend_event_loop
+    if backend_event_loop == None:
+        backend_event_loop = BackendEventLoop()
+    return backend_event_loop
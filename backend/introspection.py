@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (C) 2017, 2018 Robert Griesel
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>
+
+
+import collections
+
+
+class IntrospectionCache(object):
+    ''' Signatures, docstrings and source locations the kernel sent, by name.
+        Names may be bound to other objects after an evaluation, so the
+        compute queue invalidates the cache whenever the kernel ran code.
+        The kernel keeps its own cache by object identity, this one only
+        saves the round trip for names looked up again. '''
+
+    def __init__(self, max_entries=256):
+        self.entries = collections.OrderedDict()
+        self.max_entries = max_entries
+        self.epoch = 0 # answers requested before an invalidation are dropped
+
+    def get(self, name):
+        ''' (True, introspection) if name is cached, (False, None) otherwise. '''
+
+        if name not in self.entries:
+            return (False, None)
+        self.entries.move_to_end(name)
+        return (True, self.entries[name])
+
+    def add(self, name, introspection, epoch):
+        if epoch != self.epoch: return
+        self.entries.pop(name, None)
+        self.entries[name] = introspection
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get_missing(self, names):
+        return [name for name in names if name not in self.entries]
+
+    def invalidate(self):
+        self.entries.clear()
+        self.epoch += 1
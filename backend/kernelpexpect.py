@@ -0,0 +1,1120 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (C) 2017, 2018 Robert Griesel
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>
+
+import ast
+import asyncio
+import json
+import pexpect
+import os
+import shutil
+import sys
+import tempfile
+import time
+from os.path import expanduser
+from backend.sharedstore import get_shared_store
+from backend.sessionlog import get_session_recorder
+from model.tracing import traced
+
+session_recorder = get_session_recorder()
+
+
+class KernelProcess():
+    ''' Python interpreter driven through pexpect. Subclasses define how the
+        interpreter is started and how cells are handed over to it, results
+        are collected the same way for all kernels.
+
+        pexpect only spawns the interpreter, output is read without blocking
+        on an asyncio event loop (see backend.eventloop): start(), run() and
+        synchronize() are coroutines and must run in that loop. '''
+
+    # printed before each query, everything up to it is discarded
+    sync_marker = 'GSNB_SYNC_'
+
+    # kernel side cache of compiled cells keyed by a hash of the source,
+    # least recently used entries are dropped. python 2 and 3.
+    code_cache = '''class _GSNBCodeCache(object):
+    def __init__(self, max_entries):
+        import collections
+        self.entries = collections.OrderedDict()
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.compile_seconds = 0.0
+    def get(self, source, prepare):
+        import hashlib, time
+        source_bytes = source if isinstance(source, bytes) else source.encode('utf-8')
+        key = hashlib.sha1(source_bytes).hexdigest()
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            time_start = time.time()
+            entry = prepare(source)
+            self.compile_seconds += time.time() - time_start
+            while len(self.entries) >= self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        else:
+            self.hits += 1
+        self.entries[key] = entry
+        return entry
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': len(self.entries), 'max_entries': self.max_entries, 'compile_seconds': self.compile_seconds}
+'''
+    code_cache_size = 256
+
+    # answers completion requests on a unix socket from a thread, so it
+    # works while a cell is running. the sorted index of global names and
+    # builtins is patched with the names added or removed since the last
+    # request. completion and introspection look attributes up statically,
+    # no property, __getattr__ or __dir__ of the running code is called
+    # from this thread. attribute names are cached by object identity
+    # until the global names change, for objects that can be weakly
+    # referenced. python 2 and 3.
+    completion_server = '''class _GSNBCompletionServer(object):
+    def __init__(self, namespace, socket_path, index_path):
+        import socket, threading, keyword
+        try:
+            import builtins
+        except ImportError:
+            import __builtin__ as builtins
+        self.namespace = namespace
+        self.builtins_module = builtins
+        self.builtin_names = set(dir(builtins)) | set(keyword.kwlist)
+        self.introspector = _GSNBIntrospector(self.resolve_static, 128)
+        self.names = []
+        self.name_set = set()
+        self.attribute_cache = {}
+        self.lock = threading.Lock()
+        self.refresh()
+        try:
+            with open(index_path, 'w') as filehandle:
+                filehandle.write('\\n'.join(self.names))
+        except (IOError, OSError):
+            pass
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(socket_path)
+        self.server.listen(4)
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+    def refresh(self):
+        import bisect
+        try:
+            keys = set(list(self.namespace)) | self.builtin_names
+        except RuntimeError:
+            return
+        if keys == self.name_set:
+            return
+        with self.lock:
+            for name in self.name_set - keys:
+                del self.names[bisect.bisect_left(self.names, name)]
+            for name in keys - self.name_set:
+                bisect.insort(self.names, name)
+            self.name_set = keys
+            self.attribute_cache = {}
+    def resolve_static(self, name):
+        parts = name.split('.')
+        obj = self.namespace[parts[0]] if parts[0] in self.namespace else self.builtins_module.__dict__[parts[0]]
+        for part in parts[1:]:
+            obj = self.getattr_static(obj, part)
+        return obj
+    def getattr_static(self, obj, name):
+        try:
+            from inspect import getattr_static
+        except ImportError:
+            getattr_static = None
+        if getattr_static is not None:
+            return getattr_static(obj, name)
+        try:
+            instance_dict = object.__getattribute__(obj, '__dict__')
+        except (AttributeError, TypeError):
+            instance_dict = {}
+        if name in instance_dict:
+            return instance_dict[name]
+        for base in getattr(obj if isinstance(obj, type) else type(obj), '__mro__', ()):
+            if name in base.__dict__:
+                return base.__dict__[name]
+        raise AttributeError(name)
+    def dir_static(self, obj):
+        cls = type(obj)
+        classes = list(type.__getattribute__(cls, '__mro__'))
+        if issubclass(cls, type):
+            classes += list(type.__getattribute__(obj, '__mro__'))
+        names = set()
+        try:
+            names.update(object.__getattribute__(obj, '__dict__'))
+        except (AttributeError, TypeError):
+            pass
+        for base in classes:
+            names.update(type.__getattribute__(base, '__dict__'))
+        return sorted(name for name in names if isinstance(name, str))
+    def get_attributes(self, base):
+        import weakref
+        try:
+            obj = self.resolve_static(base)
+        except Exception:
+            return []
+        key = (id(obj), type(obj))
+        entry = self.attribute_cache.get(key, None)
+        if entry is not None and entry[0]() is obj:
+            return entry[1]
+        try:
+            names = self.dir_static(obj)
+        except Exception:
+            return []
+        try:
+            reference = weakref.ref(obj)
+        except TypeError:
+            return names
+        if len(self.attribute_cache) > 64:
+            self.attribute_cache = {}
+        self.attribute_cache[key] = (reference, names)
+        return names
+    def complete(self, prefix, limit):
+        self.refresh()
+        if '.' in prefix:
+            base, partial = prefix.rsplit('.', 1)
+            names, prefix_length = self.get_attributes(base), len(base) + 1
+        else:
+            partial, names, prefix_length = prefix, self.names, 0
+        completions = []
+        with self.lock:
+            import bisect
+            index = bisect.bisect_left(names, partial)
+            while index < len(names) and len(completions) < limit and names[index].startswith(partial):
+                if partial.startswith('_') or not names[index].startswith('_'):
+                    completions.append(prefix[:prefix_length] + names[index])
+                index += 1
+        return completions
+    def serve(self):
+        import json
+        while True:
+            connection = self.server.accept()[0]
+            try:
+                data = b''
+                while not data.endswith(b'\\n'):
+                    chunk = connection.recv(4096)
+                    if not chunk:
+                        break
+                    data += chunk
+                request = json.loads(data.decode('utf-8'))
+                if request['type'] == 'complete':
+                    response = {'completions': self.complete(request['prefix'], request.get('limit', 100))}
+                elif request['type'] == 'introspect':
+                    response = {'introspections': dict((name, self.introspector.introspect(name)) for name in request['names'][:50])}
+                elif request['type'] == 'memory_diff':
+                    response = {'diff': self.namespace['_gsnb_memory_'].diff(request['first'], request['second'], request.get('limit', 20))}
+                connection.sendall((json.dumps(response) + '\\n').encode('utf-8'))
+            except Exception:
+                pass
+            connection.close()
+'''
+
+    # signature, docstring and source location of objects, cached by
+    # object identity and version of the object's package. only objects
+    # that can be weakly referenced are cached, the cache mustn't keep
+    # user data alive. python 2 and 3.
+    introspector = '''class _GSNBIntrospector(object):
+    def __init__(self, resolve, max_entries):
+        import collections
+        self.resolve = resolve
+        self.entries = collections.OrderedDict()
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+    def get_key(self, obj):
+        import sys
+        module_name = getattr(obj, '__module__', None)
+        if not isinstance(module_name, str):
+            module_name = ''
+        package = sys.modules.get(module_name.split('.')[0], None)
+        return (id(obj), type(obj).__name__, module_name, str(getattr(package, '__version__', '')))
+    def introspect(self, name):
+        import weakref
+        try:
+            obj = self.resolve(name)
+        except Exception:
+            return None
+        key = self.get_key(obj)
+        entry = self.entries.pop(key, None)
+        if entry is not None and entry[0]() is not obj:
+            entry = None
+        if entry is None:
+            self.misses += 1
+            description = self.describe(obj)
+            try:
+                entry = (weakref.ref(obj), description)
+            except TypeError:
+                entry = None
+            if entry is not None:
+                while len(self.entries) >= self.max_entries:
+                    self.entries.popitem(last=False)
+                self.entries[key] = entry
+        else:
+            self.hits += 1
+            description = entry[1]
+            self.entries[key] = entry
+        result = dict(description)
+        result['name'] = name
+        return result
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'max_entries': self.max_entries}
+    def describe(self, obj):
+        import inspect
+        try:
+            from sage.misc.sageinspect import sage_getdoc as getdoc, sage_getargspec as getargspec, sage_getfile as getfile, sage_getsourcelines as getsourcelines
+        except ImportError:
+            getdoc, getfile, getsourcelines = inspect.getdoc, inspect.getsourcefile, inspect.getsourcelines
+            getargspec = None
+        description = {'type': type(obj).__name__, 'signature': None, 'docstring': None, 'file': None, 'line': None}
+        try:
+            description['signature'] = str(inspect.signature(obj))
+        except Exception:
+            try:
+                description['signature'] = inspect.formatargspec(*getargspec(obj))
+            except Exception:
+                pass
+        try:
+            description['docstring'] = (getdoc(obj) or '')[:20000]
+        except Exception:
+            pass
+        try:
+            description['file'] = getfile(obj)
+            description['line'] = getsourcelines(obj)[1]
+        except Exception:
+            pass
+        return description
+'''
+
+    # wall time, user/sys cpu time and growth of the peak rss of a query,
+    # written as json to usage_filename in the query's directory. cpu time
+    # includes child processes that finished meanwhile. python 2 and 3.
+    usage_filename = '.gsnb_usage.json'
+    resource_meter = '''def _gsnb_measure_(run):
+    import json, os, resource, sys, time
+    directory = os.getcwd()
+    rss_unit = 1 if sys.platform == 'darwin' else 1024
+    self_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    wall_start = time.time()
+    try:
+        run()
+    finally:
+        wall = time.time() - wall_start
+        self_after = resource.getrusage(resource.RUSAGE_SELF)
+        children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        usage = {'wall': wall,
+            'user': self_after.ru_utime - self_before.ru_utime + children_after.ru_utime - children_before.ru_utime,
+            'sys': self_after.ru_stime - self_before.ru_stime + children_after.ru_stime - children_before.ru_stime,
+            'max_rss': self_after.ru_maxrss * rss_unit,
+            'max_rss_delta': (self_after.ru_maxrss - self_before.ru_maxrss) * rss_unit}
+        with open(os.path.join(directory, USAGE_FILENAME), 'w') as filehandle:
+            filehandle.write(json.dumps(usage))
+'''
+
+    # profiles a query with cProfile. the raw stats go to
+    # profile_filename + '.prof' (pstats format of the kernel's python),
+    # functions, caller -> callee edges and the time of functions called
+    # by these helpers (the roots) to profile_filename + '.json'. frames
+    # of the helpers themselves are left out.
+    # python 2 and 3.
+    profile_filename = '.gsnb_profile'
+    profiler = '''def _gsnb_profile_(run):
+    import cProfile, json, os, pstats
+    directory = os.getcwd()
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        run()
+    finally:
+        profile.disable()
+        profile.dump_stats(os.path.join(directory, PROFILE_FILENAME + '.prof'))
+        stats = pstats.Stats(profile).stats
+        is_helper = lambda function: function[0] in ('<string>', '<stdin>') or function[2].startswith("<method 'disable' of '_lsprof")
+        functions = sorted([function for function in stats if not is_helper(function)], key=lambda function: stats[function][3], reverse=True)[:MAX_FUNCTIONS]
+        index = dict((function, position) for position, function in enumerate(functions))
+        rows, calls, roots = [], [], []
+        for function in functions:
+            primitive_calls, total_calls, own_time, cumulative_time, callers = stats[function]
+            rows.append([function[0], function[1], function[2], primitive_calls, total_calls, own_time, cumulative_time])
+            for caller, caller_stats in callers.items():
+                if caller in index:
+                    calls.append([index[caller], index[function], caller_stats[3]])
+            root_time = sum(caller_stats[3] for caller, caller_stats in callers.items() if is_helper(caller)) if len(callers) > 0 else cumulative_time
+            if root_time > 0:
+                roots.append([index[function], root_time])
+        with open(os.path.join(directory, PROFILE_FILENAME + '.json'), 'w') as filehandle:
+            filehandle.write(json.dumps({'functions': rows, 'calls': calls, 'roots': roots}))
+'''
+    profile_max_functions = 500
+
+    # tracemalloc snapshots before and after a query. the top allocation
+    # sites and the net memory the query retained are written as json to
+    # memory_filename, the snapshot after the query is kept (the last
+    # max_snapshots of them) for diffs between cells, see diff(). tracing
+    # starts with the first tracked query and stops with the first one
+    # that isn't tracked. python 3 only, reports nothing on python 2.
+    memory_filename = '.gsnb_memory.json'
+    memory_tracker = '''class _GSNBMemoryTracker(object):
+    def __init__(self, max_snapshots):
+        import threading
+        self.max_snapshots = max_snapshots
+        self.snapshots = {}
+        self.snapshot_ids = []
+        self.count = 0
+        self.lock = threading.Lock()
+    def track(self, run, enabled):
+        import json, os
+        try:
+            import tracemalloc
+        except ImportError:
+            return run()
+        if not enabled:
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+                with self.lock:
+                    self.snapshots, self.snapshot_ids = {}, []
+            return run()
+        directory = os.getcwd()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        before = self.take_snapshot(tracemalloc)
+        try:
+            run()
+        finally:
+            after = self.take_snapshot(tracemalloc)
+            statistics = after.compare_to(before, 'lineno')
+            report = {'snapshot': self.add_snapshot(after), 'net': sum(statistic.size_diff for statistic in statistics),
+                'traced': tracemalloc.get_traced_memory()[0], 'top': self.get_top(statistics, 10)}
+            with open(os.path.join(directory, MEMORY_FILENAME), 'w') as filehandle:
+                filehandle.write(json.dumps(report))
+    def take_snapshot(self, tracemalloc):
+        exclude = [tracemalloc.Filter(False, filename) for filename in (tracemalloc.__file__, '<string>', '<stdin>', '<unknown>')]
+        return tracemalloc.take_snapshot().filter_traces(exclude)
+    def add_snapshot(self, snapshot):
+        import os
+        with self.lock:
+            self.count += 1
+            snapshot_id = str(os.getpid()) + '-' + str(self.count)
+            self.snapshots[snapshot_id] = snapshot
+            self.snapshot_ids.append(snapshot_id)
+            while len(self.snapshot_ids) > self.max_snapshots:
+                del self.snapshots[self.snapshot_ids.pop(0)]
+        return snapshot_id
+    def get_top(self, statistics, limit):
+        top = []
+        for statistic in statistics:
+            if len(top) >= limit:
+                break
+            if statistic.size_diff != 0:
+                frame = statistic.traceback[0]
+                top.append([frame.filename, frame.lineno, statistic.size_diff, statistic.count_diff, statistic.size])
+        return top
+    def diff(self, first, second, limit):
+        with self.lock:
+            if first not in self.snapshots or second not in self.snapshots:
+                return None
+            first, second = self.snapshots[first], self.snapshots[second]
+        statistics = second.compare_to(first, 'lineno')
+        return {'net': sum(statistic.size_diff for statistic in statistics), 'top': self.get_top(statistics, limit)}
+'''
+    memory_max_snapshots = 16
+
+    # prints tracebacks without the frames of the prompt line and of the
+    # helpers above that wrap every query, user code is compiled as
+    # '<cell>', syntax errors in a cell come without traceback. installed
+    # as sys.excepthook, python 2 and 3.
+    exception_printer = '''def _gsnb_print_exception_(exception_type, value, tb):
+    import traceback
+    if isinstance(value, SyntaxError) and value.filename == '<cell>':
+        tb = None
+    while tb != None and tb.tb_frame.f_code.co_filename in ('<stdin>', '<string>'):
+        tb = tb.tb_next
+    traceback.print_exception(exception_type, value, tb)
+'''
+
+    # runs a query in a copy-on-write fork of the kernel. the fork writes
+    # to the same terminal, so output is collected like for normal queries,
+    # and exits afterwards. an interrupt reaches both processes (same
+    # process group), the kernel then kills the fork. python 2 and 3.
+    trial_runner = '''def _gsnb_try_(run):
+    import os, signal, sys
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            run()
+        except BaseException:
+            _gsnb_print_exception_(*sys.exc_info())
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(0)
+    try:
+        os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        raise
+'''
+
+    # notebook wide store of named arrays and buffers, see
+    # backend.sharedstore. objects are mapped read-only without copying.
+    # directory is None in kernels outside the notebook. python 2 and 3.
+    shared_store = '''class _GSNBSharedStore(object):
+    \'\'\' publish(name, obj) shares a numpy array or buffer with the
+        kernels of all worksheets, get(name) or shared_store[name] maps it
+        read-only without copying. \'\'\'
+    def __init__(self, directory):
+        self.directory = directory
+    def get_pathname(self, name, extension):
+        import re, os.path
+        if self.directory is None:
+            raise RuntimeError('the shared store is only available in the notebook')
+        if not re.match(r'^[A-Za-z_][\\w.-]*$', name):
+            raise ValueError('invalid name for shared object: ' + repr(name))
+        return os.path.join(self.directory, name + extension)
+    def write_atomically(self, pathname, write):
+        import os
+        temporary_pathname = pathname + '.tmp-' + str(os.getpid())
+        with open(temporary_pathname, 'wb') as filehandle:
+            write(filehandle)
+        os.rename(temporary_pathname, pathname)
+    def publish(self, name, obj):
+        import json, os, time
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        if numpy != None and isinstance(obj, numpy.ndarray):
+            if obj.dtype.hasobject:
+                raise TypeError('arrays of python objects can\\'t be shared')
+            array = numpy.ascontiguousarray(obj)
+            description = {'kind': 'ndarray', 'dtype': array.dtype.str, 'shape': list(array.shape), 'nbytes': int(array.nbytes)}
+            write = lambda filehandle: array.tofile(filehandle)
+        else:
+            try:
+                data = memoryview(obj).tobytes()
+            except TypeError:
+                data = None
+            if data is None:
+                raise TypeError('only numpy arrays and buffers can be shared, e.g. use matrix.numpy()')
+            description = {'kind': 'buffer', 'dtype': 'B', 'shape': [len(data)], 'nbytes': len(data)}
+            write = lambda filehandle: filehandle.write(data)
+        description.update({'name': name, 'published': time.time(), 'pid': os.getpid()})
+        self.write_atomically(self.get_pathname(name, '.data'), write)
+        self.write_atomically(self.get_pathname(name, '.json'), lambda filehandle: filehandle.write(json.dumps(description).encode('utf-8')))
+    def get(self, name):
+        import json, mmap, os, time
+        for attempt in range(5):
+            try:
+                with open(self.get_pathname(name, '.json'), 'rb') as filehandle:
+                    description = json.loads(filehandle.read().decode('utf-8'))
+                filehandle = open(self.get_pathname(name, '.data'), 'rb')
+            except IOError:
+                raise KeyError(name)
+            with filehandle:
+                if os.fstat(filehandle.fileno()).st_size != description['nbytes']:
+                    mapping = None # republished meanwhile
+                elif description['nbytes'] == 0:
+                    mapping = b''
+                else:
+                    mapping = mmap.mmap(filehandle.fileno(), 0, access=mmap.ACCESS_READ)
+            if mapping is not None:
+                break
+            time.sleep(0.01 * (attempt + 1))
+        else:
+            raise KeyError(name + " (data and description don't match, republish it)")
+        if description['kind'] == 'ndarray':
+            import numpy
+            return numpy.frombuffer(mapping, dtype=description['dtype']).reshape(description['shape'])
+        try:
+            return memoryview(mapping)
+        except TypeError:
+            return mapping
+    def __getitem__(self, name):
+        return self.get(name)
+    def remove(self, name):
+        import os
+        for extension in ['.json', '.data']:
+            try:
+                os.unlink(self.get_pathname(name, extension))
+            except OSError:
+                pass
+    def names(self):
+        import os
+        if self.directory is None:
+            return []
+        return sorted(filename[:-5] for filename in os.listdir(self.directory) if filename.endswith('.json'))
+    def __repr__(self):
+        return 'shared store with ' + str(len(self.names())) + ' objects: ' + ', '.join(self.names())
+'''
+
+    # name used for the static completion index of this kernel
+    name = 'python'
+
+    # interpreter started by spawn()
+    command = 'python'
+
+    def __init__(self):
+
+        self.state = 'not started'
+        self.sync_count = 0
+        self.output = ''
+        self.expect_result = True
+        self.process = None
+        self.completion_directory = None
+        self.memory_tracking = False # tracemalloc running, see memory_tracker
+        self.session_key = None # worksheet in the session log, see SessionRecorder
+
+        # list of temporary directory paths
+        self.temporary_directory_paths = []
+
+    def spawn(self):
+        ''' start interpreter, return pexpect process. '''
+        
+        return pexpect.spawn(self.command)
+
+    def get_setup_lines(self):
+        ''' lines sent to the interpreter right after it started. '''
+        
+        setup_lines = ['import sys', 'import tempfile', 'import shutil', 'import os; import base64']
+        setup_lines.append('exec(' + repr(self.code_cache) + ')')
+        setup_lines.append('_gsnb_code_cache_ = _GSNBCodeCache(' + str(self.code_cache_size) + ')')
+        setup_lines.append('exec(' + repr(self.shared_store) + ')')
+        setup_lines.append('exec(' + repr(self.exception_printer) + ')')
+        setup_lines.append('sys.excepthook = _gsnb_print_exception_')
+        setup_lines.append('exec(' + repr(self.trial_runner) + ')')
+        setup_lines.append('exec(' + repr(self.resource_meter.replace('USAGE_FILENAME', repr(self.usage_filename))) + ')')
+        setup_lines.append('exec(' + repr(self.memory_tracker.replace('MEMORY_FILENAME', repr(self.memory_filename))) + ')')
+        setup_lines.append('_gsnb_memory_ = _GSNBMemoryTracker(' + str(self.memory_max_snapshots) + ')')
+        setup_lines.append('exec(' + repr(self.profiler.replace('PROFILE_FILENAME', repr(self.profile_filename)).replace('MAX_FUNCTIONS', str(self.profile_max_functions))) + ')')
+        shared_store = get_shared_store()
+        setup_lines.append('shared_store = _GSNBSharedStore(' + repr(shared_store.directory if shared_store != None else None) + ')')
+        return setup_lines
+
+    def get_print_command(self, expression):
+        return 'print(' + expression + ')'
+
+    def get_query_command(self, query_string, sage_mode = True):
+        return query_string
+
+    def get_measured_command(self, query_command):
+        ''' run query_command with resource accounting, see resource_meter. '''
+        
+        return '_gsnb_measure_(lambda: ' + query_command + ')'
+
+    def get_profiled_command(self, query_command):
+        ''' run query_command under cProfile, see profiler. '''
+        
+        return '_gsnb_profile_(lambda: ' + query_command + ')'
+
+    def get_memory_tracked_command(self, query_command, track_memory):
+        ''' run query_command between tracemalloc snapshots, or stop
+            tracemalloc if track_memory is False. see memory_tracker. '''
+        
+        return '_gsnb_memory_.track(lambda: ' + query_command + ', ' + str(track_memory) + ')'
+
+    def get_trial_command(self, query_command):
+        ''' run query_command in a fork of the kernel, see trial_runner. '''
+        
+        return '_gsnb_try_(lambda: ' + query_command + ')'
+
+    @traced('kernel_io')
+    async def start(self):
+        ''' initialize python process '''
+        
+        time_start = time.time()
+        self.io_lock = asyncio.Lock() # one command at a time
+        self.completion_directory = tempfile.mkdtemp(prefix='gsnb-')
+        self.completion_socket_path = self.completion_directory + '/completion'
+        self.process = self.spawn()
+        await self.expect('>>> ')
+        for line in self.get_setup_lines() + self.get_completion_setup_lines():
+            self.process.sendline(line)
+            await self.expect('>>> ')
+
+        # create permanent directory
+        self.permanent_directory_path = expanduser('~/.sage/sc_store/' )
+        if not os.path.exists(self.permanent_directory_path):
+            os.makedirs(self.permanent_directory_path)
+            
+        self.state = 'started'
+        if session_recorder.is_enabled():
+            session_recorder.add_event('start', self.session_key, time_start, kernel=self.name, seconds=time.time() - time_start)
+    
+    async def expect(self, pattern):
+        ''' wait until pattern shows up in the kernel's output, return the
+            output before it. does not block the event loop. '''
+        
+        while True:
+            index = self.output.find(pattern)
+            if index >= 0:
+                before = self.output[:index]
+                self.output = self.output[index + len(pattern):]
+                return before
+            await self.wait_readable()
+            try:
+                data = os.read(self.process.child_fd, 65536)
+            except OSError:
+                data = b''
+            if data == b'':
+                self.state = 'stopped'
+                raise pexpect.EOF('kernel exited')
+            self.output += data.decode('utf-8', 'replace')
+
+    def wait_readable(self):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        def on_readable():
+            loop.remove_reader(self.process.child_fd)
+            if not future.done(): future.set_result(None)
+        loop.add_reader(self.process.child_fd, on_readable)
+        future.add_done_callback(lambda future: loop.remove_reader(self.process.child_fd))
+        return future
+
+    @traced('kernel_io')
+    async def run(self, query_string, sage_mode = True, mode = 'normal', track_memory = False):
+        ''' returns None if stop_computation() was called in the meantime.
+            queries in mode 'trial' run in a fork that is thrown away
+            afterwards, so they don't change the kernel's state. in mode
+            'profile' the result blob has the profile and the pathname of
+            the raw stats, see read_profile(). with track_memory it has a
+            memory report, see memory_tracker. '''
+
+        async with self.io_lock:
+            time_start = time.time()
+            result_blob = await self.run_unlocked(query_string, sage_mode, mode, track_memory)
+            if session_recorder.is_enabled():
+                self.record_run(query_string, mode, time_start, result_blob)
+            return result_blob
+
+    def record_run(self, query_string, mode, time_start, result_blob):
+        ''' log the query for replay, see SessionRecorder. '''
+        
+        time_end = time.time()
+        fields = {'mode': mode, 'query_bytes': len(query_string), 'interrupted': result_blob == None}
+        if result_blob == None:
+            fields.update({'setup_seconds': 0, 'seconds': time_end - time_start, 'output_bytes': 0, 'output_lines': 0, 'files': 0})
+        else:
+            timestamps = result_blob['timestamps']
+            fields.update({'setup_seconds': timestamps['sent'] - time_start, 'seconds': timestamps['received'] - timestamps['sent'],
+                           'output_bytes': len(result_blob['text']), 'output_lines': result_blob['text'].count('\n') + 1 if result_blob['text'] != '' else 0,
+                           'files': len(result_blob['files'])})
+        if session_recorder.record_content:
+            fields['query'] = query_string
+            if result_blob != None: fields['output'] = result_blob['text']
+        session_recorder.add_event('run', self.session_key, time_start, **fields)
+
+    async def run_unlocked(self, query_string, sage_mode = True, mode = 'normal', track_memory = False):
+        timestamps = {'kernel_setup': time.time()}
+        self.expect_result = True
+        await self.synchronize()
+
+        # move to temporary directory
+        self.process.sendline(self.get_print_command('tempfile.mkdtemp()'))
+        td_path = await self.expect('>>> ')
+        if self.expect_result == False: return None
+        td_path = td_path.split('\r\n')[1]
+        self.temporary_directory_paths.append(td_path)
+        self.process.sendline('os.chdir(\'' + td_path + '\')')
+        await self.expect('>>> ')
+        if self.expect_result == False: return None
+        
+        # run query
+        query_command = self.get_query_command(query_string, sage_mode)
+        if mode == 'profile': query_command = self.get_profiled_command(query_command)
+        # trial runs end with their fork, so do their snapshots
+        if mode != 'trial' and (track_memory or self.memory_tracking):
+            query_command = self.get_memory_tracked_command(query_command, track_memory)
+            self.memory_tracking = track_memory
+        if sage_mode: query_command = self.get_measured_command(query_command)
+        if mode == 'trial': query_command = self.get_trial_command(query_command)
+        timestamps['sent'] = time.time()
+        self.process.sendline(query_command)
+            
+        # return results
+        output = await self.expect('>>> ')
+        timestamps['received'] = time.time()
+        if self.expect_result == True:
+            results_text = '\n'.join(output.split('\r\n')[1:-1])
+            results_files = os.listdir(td_path)
+            usage = None
+            if self.usage_filename in results_files:
+                results_files.remove(self.usage_filename)
+                usage = self.read_usage(td_path + '/' + self.usage_filename)
+            result_blob = {'text' : results_text, 'files' : results_files, 'path' : td_path + '/', 'usage': usage, 'timestamps': timestamps}
+            if self.memory_filename in results_files:
+                results_files.remove(self.memory_filename)
+                result_blob['memory'] = self.read_memory_report(td_path + '/' + self.memory_filename)
+            if self.profile_filename + '.json' in results_files:
+                results_files.remove(self.profile_filename + '.json')
+                result_blob['profile'] = self.read_profile(td_path + '/' + self.profile_filename + '.json')
+                if self.profile_filename + '.prof' in results_files:
+                    results_files.remove(self.profile_filename + '.prof')
+                    result_blob['profile_pathname'] = td_path + '/' + self.profile_filename + '.prof'
+            self.process.sendline('os.chdir(\'' + self.permanent_directory_path + '\')')
+            await self.expect('>>> ')
+            timestamps['kernel_done'] = time.time()
+            return result_blob
+        else:
+            return None
+    
+    def read_usage(self, pathname):
+        ''' dict with 'wall', 'user', 'sys' (seconds), 'max_rss' and
+            'max_rss_delta' (bytes) or None. '''
+        
+        try:
+            with open(pathname, 'r') as filehandle:
+                return json.loads(filehandle.read())
+        except (IOError, ValueError):
+            return None
+    
+    def read_memory_report(self, pathname):
+        ''' dict with 'snapshot' (id for get_memory_diff()), 'net' and
+            'traced' (bytes) and 'top', a list of [filename, line, size
+            difference, count difference, size], or None. '''
+        
+        try:
+            with open(pathname, 'r') as filehandle:
+                return json.loads(filehandle.read())
+        except (IOError, ValueError):
+            return None
+    
+    def read_profile(self, pathname):
+        ''' dict with 'functions', a list of [filename, line, name,
+            primitive calls, calls, own time, cumulative time], 'calls', a
+            list of [caller, callee, cumulative time] and 'roots', a list of
+            [function, cumulative time] for the functions the cell called
+            directly, with positions in 'functions'. None if the file
+            can't be read. '''
+        
+        try:
+            with open(pathname, 'r') as filehandle:
+                return json.loads(filehandle.read())
+        except (IOError, ValueError):
+            return None
+    
+    def get_completion_setup_lines(self):
+        ''' start completion server, after all other setup lines. '''
+        
+        setup_lines = ['exec(' + repr(self.introspector) + ')']
+        setup_lines.append('exec(' + repr(self.completion_server) + ')')
+        setup_lines.append('_gsnb_completion_ = _GSNBCompletionServer(globals(), ' + repr(self.completion_socket_path) + ', ' + repr(self.get_static_completion_index_pathname()) + ')')
+        return setup_lines
+
+    @classmethod
+    def get_static_completion_index_pathname(cls):
+        return expanduser('~/.sage/completion_index_' + cls.name + '.txt')
+        
+    async def get_completions(self, prefix, limit=100, timeout=0.05):
+        ''' ask the completion server of the kernel, works while a query is
+            running. None if it doesn't answer within timeout seconds. '''
+        
+        response = await self.request_side_channel({'type': 'complete', 'prefix': prefix, 'limit': limit}, timeout)
+        return response['completions'] if response != None else None
+
+    async def get_introspections(self, names, timeout=2):
+        ''' dict name: signature, docstring, source location (or None if
+            the name doesn't exist). None if the kernel doesn't answer. '''
+        
+        response = await self.request_side_channel({'type': 'introspect', 'names': names}, timeout)
+        return response['introspections'] if response != None else None
+
+    async def get_memory_diff(self, first, second, timeout=10):
+        ''' top allocation sites between the snapshots taken after two
+            tracked queries, like memory reports. None if the snapshots
+            are gone (kernel restarted, too old) or the kernel doesn't
+            answer. '''
+        
+        response = await self.request_side_channel({'type': 'memory_diff', 'first': first, 'second': second}, timeout)
+        return response['diff'] if response != None else None
+
+    @traced('kernel_io')
+    async def request_side_channel(self, request, timeout):
+        ''' send request to the completion server, return its response or
+            None if it doesn't answer within timeout seconds. '''
+        
+        time_start = time.time()
+        response = await self.send_side_channel_request(request, timeout)
+        if session_recorder.is_enabled():
+            fields = {'request': request['type'], 'seconds': time.time() - time_start, 'request_bytes': len(json.dumps(request)),
+                      'response_bytes': len(json.dumps(response)) if response != None else 0, 'answered': response != None}
+            if session_recorder.record_content and response != None: fields['response'] = response
+            session_recorder.add_event('side_channel', self.session_key, time_start, **fields)
+        return response
+        
+    async def send_side_channel_request(self, request, timeout):
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_unix_connection(self.completion_socket_path), timeout)
+        except (OSError, asyncio.TimeoutError):
+            return None
+        try:
+            writer.write(json.dumps(request).encode('utf-8') + b'\n')
+            line = await asyncio.wait_for(reader.readline(), timeout)
+            return json.loads(line.decode('utf-8'))
+        except (OSError, asyncio.TimeoutError, ValueError):
+            return None
+        finally:
+            writer.close()
+
+    @traced('kernel_io')
+    async def get_statistics(self):
+        ''' kernel side statistics, waits for the running query. None if
+            they can't be read (kernel interrupted meanwhile). '''
+        
+        async with self.io_lock:
+            await self.synchronize()
+            self.process.sendline(self.get_print_command('(_gsnb_code_cache_.stats(), _gsnb_completion_.introspector.stats())'))
+            output = await self.expect('>>> ')
+        try:
+            code_cache, introspection = ast.literal_eval(output.split('\r\n')[1])
+            return {'code_cache': code_cache, 'introspection': introspection}
+        except (IndexError, SyntaxError, ValueError):
+            return None
+
+    @traced('kernel_io')
+    async def synchronize(self):
+        ''' skip output and prompts left over from interrupts. if the
+            marker line itself gets interrupted, a new marker is sent. '''
+        
+        while True:
+            self.sync_count += 1
+            marker = self.sync_marker + str(self.sync_count)
+            self.process.sendline(self.get_print_command('\'' + self.sync_marker + '\' + \'' + str(self.sync_count) + '\''))
+            try:
+                await asyncio.wait_for(self.expect(marker + '\r\n>>> '), 5)
+            except asyncio.TimeoutError:
+                pass
+            else:
+                return
+
+    def delete_temporary_directories(self):
+        for td_path in self.temporary_directory_paths:
+            shutil.rmtree(td_path, ignore_errors=True)
+        self.temporary_directory_paths = []
+        
+    def stop_computation(self):
+        ''' interrupt running query, does not wait for the prompt: run()
+            does that. '''
+        
+        self.expect_result = False
+        self.process.send(chr(3)) # ctrl-c
+        if session_recorder.is_enabled():
+            session_recorder.add_event('interrupt', self.session_key, time.time())
+
+    def get_resource_usage(self):
+        ''' resident memory (bytes) and cpu time (seconds) the kernel
+            process used so far, read from /proc. callable from any thread,
+            None if the kernel isn't running or there is no /proc. '''
+        
+        if self.process == None or self.state != 'started': return None
+        try:
+            with open('/proc/' + str(self.process.pid) + '/stat', 'r') as filehandle:
+                fields = filehandle.read().rsplit(')', 1)[1].split()
+            with open('/proc/' + str(self.process.pid) + '/statm', 'r') as filehandle:
+                resident_pages = int(filehandle.read().split()[1])
+        except (IOError, IndexError, ValueError):
+            return None
+        clock_ticks = os.sysconf('SC_CLK_TCK')
+        return {'pid': self.process.pid, 'rss': resident_pages * os.sysconf('SC_PAGE_SIZE'),
+                'cpu': (int(fields[11]) + int(fields[12])) / clock_ticks}
+
+    def kill(self):
+        self.delete_temporary_directories()
+        if self.completion_directory != None:
+            shutil.rmtree(self.completion_directory, ignore_errors=True)
+        if self.process != None and self.process.isalive():
+            self.process.kill(1)
+        if session_recorder.is_enabled() and self.state == 'started':
+            session_recorder.add_event('kill', self.session_key, time.time())
+        self.state = 'stopped'
+
+    def __del__(self):
+        if self.state == 'started':
+            self.kill()
+
+
+class SageMathProcess(KernelProcess):
+
+    name = 'sage'
+
+    #os.environ['SAGE_LOCAL'] = '/usr/share/sagemath/'
+    command = 'sage --python'
+
+    # preparsing and compiling is skipped for cells run before
+    cell_runner = '''def _gsnb_run_cell_(source, namespace):
+    prepare = lambda source: compile(_support_.preparse_worksheet_cell(source, namespace), '<cell>', 'exec')
+    exec(_gsnb_code_cache_.get(source, prepare), namespace)
+'''
+
+    def get_setup_lines(self):
+        setup_lines = KernelProcess.get_setup_lines(self)
+        setup_lines.append('import sagenb.misc.support as _support_')
+        setup_lines.append('from sage.all_notebook import *')
+        setup_lines.append('from sage.misc.displayhook import DisplayHook')
+        setup_lines.append('sys.displayhook = DisplayHook()')
+        setup_lines.append('sage.plot.plot.EMBEDDED_MODE = True')
+        setup_lines.append('exec(' + repr(self.cell_runner) + ')')
+        return setup_lines
+
+    def get_print_command(self, expression):
+        return 'print ' + expression
+
+    def get_query_command(self, query_string, sage_mode = True):
+        if sage_mode == True:
+            return '_gsnb_run_cell_(' + repr(query_string.strip()) + ', globals())'
+        else:
+            return query_string
+
+
+class PythonProcess(KernelProcess):
+    ''' Plain python3 kernel, starts in a few milliseconds. Cells are run
+        through a small helper so multi-line code works at the prompt and
+        the value of a trailing expression is printed like in sage. Compiled
+        cells are cached like in sage. '''
+
+    name = 'python3'
+
+    command = sys.executable + ' -q -i'
+
+    cell_runner = '''def _gsnb_prepare_cell_(source):
+    import ast
+    tree = ast.parse(source, '<cell>', 'exec')
+    last_expression = None
+    if len(tree.body) > 0 and isinstance(tree.body[-1], ast.Expr):
+        last_expression = compile(ast.Interactive(body=[tree.body.pop()]), '<cell>', 'single')
+    return (compile(tree, '<cell>', 'exec'), last_expression)
+def _gsnb_run_cell_(source, namespace):
+    code, last_expression = _gsnb_code_cache_.get(source, _gsnb_prepare_cell_)
+    exec(code, namespace)
+    if last_expression != None:
+        exec(last_expression, namespace)
+'''
+
+    def spawn(self):
+        env = dict(os.environ, TERM='dumb', PYTHON_BASIC_REPL='1')
+        process = pexpect.spawn(self.command, env=env)
+        process.delaybeforesend = None
+        return process
+
+    def get_setup_lines(self):
+        setup_lines = KernelProcess.get_setup_lines(self)
+        setup_lines.append('exec(' + repr(self.cell_runner) + ')')
+        return setup_lines
+
+    def get_query_command(self, query_string, sage_mode = True):
+        return '_gsnb_run_cell_(' + repr(query_string.strip()) + ', globals())'
+
+
+class InterfacePexpect():
+    ''' Kernel processes by worksheet. All methods have to be called in the
+        backend event loop. '''
+
+    # kernel class by worksheet.meta['backend']
+    kernel_classes = {'sage': SageMathProcess, 'python3': PythonProcess}
+
+    def __init__(self):
+        
+        self.sagemath_processes = {}
+        self.start_tasks = {}
+    
+    async def get_process(self, worksheet):
+        ''' Returns present or new kernel process of the worksheet's backend.
+            Concurrent callers all wait for the same start. If the start
+            fails, its exception is raised and the next call starts a new
+            kernel. '''
+        
+        if not worksheet in self.sagemath_processes:
+            kernel_class = self.kernel_classes.get(worksheet.get_backend(), SageMathProcess)
+            process = kernel_class()
+            if session_recorder.is_enabled():
+                process.session_key = session_recorder.get_worksheet_key(worksheet)
+            self.sagemath_processes[worksheet] = process
+            self.start_tasks[worksheet] = asyncio.ensure_future(process.start())
+        process = self.sagemath_processes[worksheet]
+        start_task = self.start_tasks[worksheet]
+        try:
+            await asyncio.shield(start_task)
+        except Exception:
+            if self.start_tasks.get(worksheet) is start_task:
+                self.stop_process(worksheet)
+            raise
+        return process
+        
+    def stop_process(self, worksheet):
+        ''' Kills sagemath process if present. '''
+
+        process = self.sagemath_processes.pop(worksheet, None)
+        start_task = self.start_tasks.pop(worksheet, None)
+        if start_task != None and not start_task.done():
+            start_task.cancel()
+        if process != None:
+            process.kill()
+
+    async def run(self, query_string, worksheet, sage_mode = True, mode = 'normal', track_memory = False):
+        process = await self.get_process(worksheet)
+        return await process.run(query_string, sage_mode, mode, track_memory)
+        
+    async def get_statistics(self, worksheet):
+        ''' kernel statistics of worksheet, None if its kernel isn't running. '''
+        
+        process = self.sagemath_processes.get(worksheet, None)
+        if process == None or process.state != 'started':
+            return None
+        return await process.get_statistics()
+        
+    async def get_completions(self, worksheet, prefix, limit=100):
+        ''' completions from the worksheet's kernel, None if it isn't
+            running or doesn't answer in time. '''
+        
+        process = self.sagemath_processes.get(worksheet, None)
+        if process == None or process.state != 'started':
+            return None
+        return await process.get_completions(prefix, limit)
+        
+    async def get_introspections(self, worksheet, names):
+        process = self.sagemath_processes.get(worksheet, None)
+        if process == None or process.state != 'started':
+            return None
+        return await process.get_introspections(names)
+        
+    def get_kernels(self):
+        ''' (worksheet, process) for all kernels, callable from any thread. '''
+        
+        return list(self.sagemath_processes.items())
+        
+    async def get_memory_diff(self, worksheet, first, second):
+        process = self.sagemath_processes.get(worksheet, None)
+        if process == None or process.state != 'started':
+            return None
+        return await process.get_memory_diff(first, second)
+        
+    def stop_computation_by_worksheet(self, worksheet):
+        process = self.sagemath_processes.get(worksheet, None)
+        if process != None and process.state == 'started':
+            process.stop_computation()
+        
+    def stop_computation(self):
+        for process in self.sagemath_processes.values():
+            if process.state == 'started':
+                process.stop_computation()
+        
+    def __del__(self):
+        ''' destructor, unlinks all processes '''
+        self.sagemath_processes = {}
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (C) 2017, 2018 Robert Griesel
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>
+
+import collections
+import heapq
+import queue
+import threading
+
+
+class QueryQueue(object):
+    ''' Per worksheet queue of queries, replaces the plain fifo queue.Queue.
+
+        Interactive queries (evaluation of the active cell) are served before
+        bulk queries (run all), unless a bulk query for a cell above them is
+        still waiting: cells depend on the cells above them, so those run
+        first. After max_interactive_streak interactive queries in a row one
+        bulk query is served, so bulk work keeps progressing. '''
+
+    def __init__(self, max_interactive_streak=3):
+        self.lock = threading.RLock()
+        self.interactive_queries = collections.OrderedDict()
+        self.bulk_queries = collections.OrderedDict()
+        self.bulk_positions = list() # heap of (cell position, sequence number), cleaned lazily
+        self.sequence_numbers_by_cell = dict()
+        self.sequence_number = 0
+        self.interactive_streak = 0
+        self.max_interactive_streak = max_interactive_streak
+        self.average_duration = None # seconds, moving average of finished evaluations
+
+    def put(self, query):
+        with self.lock:
+            self.sequence_number += 1
+            query.sequence_number = self.sequence_number
+            self.sequence_numbers_by_cell.setdefault(query.get_cell(), set()).add(query.sequence_number)
+            if query.priority == 'interactive':
+                self.interactive_queries[query.sequence_number] = query
+            else:
+                self.bulk_queries[query.sequence_number] = query
+                heapq.heappush(self.bulk_positions, (query.cell_position, query.sequence_number))
+
+    def get(self, block=False):
+        ''' remove and return next query. non-blocking like
+            queue.Queue.get(block=False), raises queue.Empty. '''
+
+        with self.lock:
+            sequence_number = self.select_next(self.interactive_queries, self.bulk_queries, self.get_min_bulk_position(), self.interactive_streak)
+            if sequence_number == None:
+                raise queue.Empty
+            if sequence_number in self.interactive_queries:
+                self.interactive_streak += 1
+            else:
+                self.interactive_streak = 0
+            return self.pop(sequence_number)
+
+    def pop(self, sequence_number):
+        if sequence_number in self.interactive_queries:
+            query = self.interactive_queries.pop(sequence_number)
+        else:
+            query = self.bulk_queries.pop(sequence_number)
+        sequence_numbers = self.sequence_numbers_by_cell[query.get_cell()]
+        sequence_numbers.discard(sequence_number)
+        if len(sequence_numbers) == 0:
+            del(self.sequence_numbers_by_cell[query.get_cell()])
+        return query
+
+    def remove_by_cell(self, cell):
+        ''' remove all queries of cell, return them. '''
+
+        with self.lock:
+            sequence_numbers = list(self.sequence_numbers_by_cell.get(cell, ()))
+            return [self.pop(sequence_number) for sequence_number in sequence_numbers]
+
+    def get_cells(self):
+        ''' cells that have queries in the queue. '''
+
+        with self.lock:
+            return list(self.sequence_numbers_by_cell)
+
+    def remove_all(self):
+        ''' empty the queue, return removed queries in queue order. '''
+
+        with self.lock:
+            queries = list(self.interactive_queries.values()) + list(self.bulk_queries.values())
+            self.interactive_queries = collections.OrderedDict()
+            self.bulk_queries = collections.OrderedDict()
+            self.bulk_positions = list()
+            self.sequence_numbers_by_cell = dict()
+            return queries
+
+    def select_next(self, interactive_queries, bulk_queries, min_bulk_position, interactive_streak):
+        ''' sequence number of the query to run next, None if queue is empty. '''
+
+        if len(bulk_queries) > 0 and interactive_streak >= self.max_interactive_streak:
+            return next(iter(bulk_queries))
+        for sequence_number, query in interactive_queries.items():
+            if min_bulk_position == None or query.cell_position <= min_bulk_position:
+                return sequence_number
+        if len(bulk_queries) > 0:
+            return next(iter(bulk_queries))
+        return None
+
+    def get_min_bulk_position(self):
+        if len(self.bulk_positions) > 2 * len(self.bulk_queries) + 64:
+            self.bulk_positions = [entry for entry in self.bulk_positions if entry[1] in self.bulk_queries]
+            heapq.heapify(self.bulk_positions)
+        while len(self.bulk_positions) > 0 and self.bulk_positions[0][1] not in self.bulk_queries:
+            heapq.heappop(self.bulk_positions)
+        return self.bulk_positions[0][0] if len(self.bulk_positions) > 0 else None
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def qsize(self):
+        with self.lock:
+            return len(self.interactive_queries) + len(self.bulk_queries)
+
+    def add_duration(self, seconds):
+        ''' feed duration of a finished evaluation into the wait estimate. '''
+
+        with self.lock:
+            if self.average_duration == None:
+                self.average_duration = seconds
+            else:
+                self.average_duration = 0.7 * self.average_duration + 0.3 * seconds
+
+    def get_schedule(self, running_seconds=None):
+        ''' predicted run order: list of dicts with query, position (1 = next)
+            and estimated wait in seconds (None while there is no estimate).
+            running_seconds is how long the query the kernel is busy with
+            has been running, None if it is idle. Cell positions are read
+            from the cells, so inserted, moved and deleted cells are taken
+            into account, and stored for get(). Call from the gtk thread. '''
+
+        with self.lock:
+            queries = list(self.interactive_queries.values()) + list(self.bulk_queries.values())
+        positions = dict()
+        worksheets = set()
+        for query in queries:
+            worksheet = query.get_cell().get_worksheet()
+            if worksheet not in worksheets:
+                worksheets.add(worksheet)
+                positions.update((cell, position) for position, cell in enumerate(worksheet.cells))
+
+        with self.lock:
+            for query in queries:
+                query.cell_position = positions.get(query.get_cell(), query.cell_position)
+            self.bulk_positions = [(query.cell_position, sequence_number) for sequence_number, query in self.bulk_queries.items()]
+            heapq.heapify(self.bulk_positions)
+            interactive_queries = collections.OrderedDict(self.interactive_queries)
+            bulk_queries = collections.OrderedDict(self.bulk_queries)
+            bulk_positions = list(self.bulk_positions)
+            interactive_streak = self.interactive_streak
+            average_duration = self.average_duration
+
+        if average_duration != None and running_seconds != None:
+            remaining_seconds = max(0, average_duration - running_seconds)
+        else:
+            remaining_seconds = 0
+        schedule = list()
+        while len(interactive_queries) + len(bulk_queries) > 0:
+            while len(bulk_positions) > 0 and bulk_positions[0][1] not in bulk_queries:
+                heapq.heappop(bulk_positions)
+            min_bulk_position = bulk_positions[0][0] if len(bulk_positions) > 0 else None
+            sequence_number = self.select_next(interactive_queries, bulk_queries, min_bulk_position, interactive_streak)
+            if sequence_number in interactive_queries:
+                query = interactive_queries.pop(sequence_number)
+                interactive_streak += 1
+            else:
+                query = bulk_queries.pop(sequence_number)
+                interactive_streak = 0
+            position = len(schedule) + 1
+            estimated_wait = remaining_seconds + (position - 1) * average_duration if average_duration != None else None
+            schedule.append({'query': query, 'position': position, 'estimated_wait': estimated_wait})
+        return schedule
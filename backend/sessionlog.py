@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (C) 2017, 2018 Robert Griesel
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>
+
+import gzip
+import json
+import os
+import threading
+import time
+import weakref
+
+
+def open_session_log(pathname, mode):
+    ''' session logs are gzip compressed if their name ends with .gz. '''
+
+    if pathname.endswith('.gz'):
+        return gzip.open(pathname, mode + 't', encoding='utf-8')
+    return open(pathname, mode, encoding='utf-8')
+
+
+class SessionRecorder(object):
+    ''' Logs the traffic between GSNB and its kernels, one JSON object per
+        line: kernel starts, queries, interrupts, side channel requests and
+        kills, each with its worksheet (numbered by first appearance), the
+        time since recording started, how long it took and payload sizes.
+        Queries and outputs themselves are only logged with record_content,
+        so logs can be shared without sharing the worksheets. Off by
+        default, events are only recorded from the backend thread. '''
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.filehandle = None
+        self.record_content = False
+        self.time_origin = time.time()
+        self.worksheet_keys = weakref.WeakKeyDictionary()
+        self.worksheet_count = 0
+
+    def start(self, pathname, record_content=False):
+        with self.lock:
+            if self.enabled: return
+            self.filehandle = open_session_log(pathname, 'w')
+            self.record_content = record_content
+            self.time_origin = time.time()
+            self.worksheet_keys = weakref.WeakKeyDictionary()
+            self.worksheet_count = 0
+            self.enabled = True
+
+    def stop(self):
+        with self.lock:
+            if not self.enabled: return
+            self.enabled = False
+            self.filehandle.close()
+            self.filehandle = None
+
+    def is_enabled(self):
+        return self.enabled
+
+    def get_worksheet_key(self, worksheet):
+        with self.lock:
+            if worksheet not in self.worksheet_keys:
+                self.worksheet_keys[worksheet] = self.worksheet_count
+                self.worksheet_count += 1
+            return self.worksheet_keys[worksheet]
+
+    def add_event(self, event_type, worksheet_key, time_start, **fields):
+        ''' time_start is when the kernel got the request (time.time()). '''
+
+        event = {'event': event_type, 'worksheet': worksheet_key, 'time': round(time_start - self.time_origin, 6)}
+        event.update(fields)
+        line = json.dumps(event, separators=(',', ':')) + '\n'
+        with self.lock:
+            if not self.enabled: return
+            self.filehandle.write(line)
+            self.filehandle.flush() # a log of a session that crashed is still readable
+
+
+class SessionLog(object):
+    ''' events of a recorded session, by worksheet. '''
+
+    def __init__(self, pathname):
+        self.events = list()
+        with open_session_log(pathname, 'r') as filehandle:
+            for line in filehandle:
+                if line.strip() != '':
+                    self.events.append(json.loads(line))
+        self.events.sort(key=lambda event: event['time'])
+
+    def get_events(self):
+        return self.events
+
+    def get_worksheet_keys(self):
+        ''' in order of first appearance. '''
+
+        keys = list()
+        for event in self.events:
+            if event['worksheet'] not in keys: keys.append(event['worksheet'])
+        return keys
+
+    def get_stream(self, worksheet_key):
+        return SessionStream([event for event in self.events if event['worksheet'] == worksheet_key])
+
+
+class SessionStream(object):
+    ''' the events of one worksheet, consumed in order by the kernels that
+        replay them (one after the other if the kernel is restarted). '''
+
+    def __init__(self, events):
+        self.events = events
+        self.positions = dict() # next event position by type and fields
+
+    def get_next(self, event_type, **fields):
+        ''' next event of event_type with the given fields, None if there are no more. '''
+
+        key = (event_type,) + tuple(sorted(fields.items()))
+        position = self.positions.get(key, 0)
+        while position < len(self.events):
+            event = self.events[position]
+            position += 1
+            if event['event'] == event_type and all(event.get(name) == value for name, value in fields.items()):
+                self.positions[key] = position
+                return event
+        self.positions[key] = position
+        return None
+
+
+session_recorder = SessionRecorder()
+
+def get_session_recorder():
+    ''' the session recorder of this process. recording starts at launch if
+        the environment variable GSNB_RECORD_SESSION names a file to write
+        to, with GSNB_RECORD_CONTENT=1 queries and outputs are logged too. '''
+
+    return session_recorder
+
+if os.environ.get('GSNB_RECORD_SESSION', '') != '':
+    import atexit
+    session_recorder.start(os.environ['GSNB_RECORD_SESSION'], os.environ.get('GSNB_RECORD_CONTENT', '') == '1')
+    atexit.register(session_recorder.stop)
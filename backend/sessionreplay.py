@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (C) 2017, 2018 Robert Griesel
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>
+
+import asyncio
+import os
+import time
+from backend.kernelpexpect import InterfacePexpect
+from backend.sessionlog import SessionLog, SessionStream
+
+
+class ReplayKernelProcess(object):
+    ''' Stub kernel that answers like the recorded one did: it starts and
+        answers queries and side channel requests after the recorded time,
+        with output of the recorded size (or the recorded output if the
+        content was recorded). Files (e.g. plots) aren't replayed. Runs in
+        the backend event loop like KernelProcess. '''
+
+    name = 'replay'
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.state = 'not started'
+        self.interrupted = None
+
+    async def start(self):
+        self.interrupted = asyncio.Event()
+        event = self.stream.get_next('start')
+        if event != None: await asyncio.sleep(event['seconds'])
+        self.state = 'started'
+
+    async def run(self, query_string, sage_mode = True, mode = 'normal', track_memory = False):
+        ''' returns None if stop_computation() was called in the meantime.
+            a query that was interrupted in the recording takes as long as
+            it ran back then and has no output. '''
+
+        timestamps = {'kernel_setup': time.time()}
+        self.interrupted.clear()
+        event = self.stream.get_next('run')
+        if event == None: event = {'setup_seconds': 0, 'seconds': 0, 'output_bytes': 0, 'output_lines': 0}
+        try:
+            await asyncio.wait_for(self.interrupted.wait(), event['setup_seconds'])
+            return None
+        except asyncio.TimeoutError:
+            pass
+        timestamps['sent'] = time.time()
+        try:
+            await asyncio.wait_for(self.interrupted.wait(), event['seconds'])
+            return None
+        except asyncio.TimeoutError:
+            pass
+        timestamps['received'] = time.time()
+        if 'output' in event:
+            text = event['output']
+        else:
+            text = self.get_filler(event['output_bytes'], event['output_lines'])
+        timestamps['kernel_done'] = time.time()
+        return {'text': text, 'files': [], 'path': '', 'usage': None, 'timestamps': timestamps}
+
+    def get_filler(self, size, line_count):
+        ''' size characters in line_count lines. '''
+
+        if size <= 0 or line_count <= 0: return ''
+        line_length = max(1, (size - line_count + 1) // line_count)
+        return '\n'.join(['x' * line_length] * line_count)
+
+    async def request_side_channel(self, request, timeout):
+        event = self.stream.get_next('side_channel', request=request['type'])
+        if event == None: return None
+        await asyncio.sleep(min(event['seconds'], timeout))
+        if event['seconds'] > timeout: return None
+        return event.get('response', None)
+
+    async def get_completions(self, prefix, limit=100, timeout=0.05):
+        response = await self.request_side_channel({'type': 'complete'}, timeout)
+        return response['completions'] if response != None else None
+
+    async def get_introspections(self, names, timeout=2):
+        response = await self.request_side_channel({'type': 'introspect'}, timeout)
+        return response['introspections'] if response != None else None
+
+    async def get_memory_diff(self, first, second, timeout=10):
+        response = await self.request_side_channel({'type': 'memory_diff'}, timeout)
+        return response['diff'] if response != None else None
+
+    async def get_statistics(self):
+        return None
+
+    def get_resource_usage(self):
+        return None
+
+    def stop_computation(self):
+        if self.interrupted != None:
+            self.interrupted.set()
+
+    def kill(self):
+        self.stop_computation()
+        self.state = 'stopped'
+
+
+class ReplayInterface(InterfacePexpect):
+    ''' InterfacePexpect with ReplayKernelProcess kernels. Worksheets get
+        the recorded worksheets in the order they start their kernels,
+        unless they are assigned one. '''
+
+    def __init__(self, session_log):
+        InterfacePexpect.__init__(self)
+        self.session_log = session_log
+        self.streams = dict() # by worksheet
+        self.unassigned_keys = session_log.get_worksheet_keys()
+
+    def assign(self, worksheet, worksheet_key):
+        self.streams[worksheet] = self.session_log.get_stream(worksheet_key)
+        if worksheet_key in self.unassigned_keys:
+            self.unassigned_keys.remove(worksheet_key)
+
+    async def get_process(self, worksheet):
+        if not worksheet in self.sagemath_processes:
+            if worksheet not in self.streams:
+                if len(self.unassigned_keys) > 0:
+                    self.assign(worksheet, self.unassigned_keys[0])
+                else:
+                    self.streams[worksheet] = SessionStream([])
+            process = ReplayKernelProcess(self.streams[worksheet])
+            self.sagemath_processes[worksheet] = process
+            self.start_tasks[worksheet] = asyncio.ensure_future(process.start())
+        process = self.sagemath_processes[worksheet]
+        await asyncio.shield(self.start_tasks[worksheet])
+        return process
+
+
+def create_interface():
+    ''' kernel interface of the compute queue: a ReplayInterface if the
+        environment variable GSNB_REPLAY_SESSION names a session log,
+        InterfacePexpect otherwise. '''
+
+    if os.environ.get('GSNB_REPLAY_SESSION', '') != '':
+        return ReplayInterface(SessionLog(os.environ['GSNB_REPLAY_SESSION']))
+    return InterfacePexpect()
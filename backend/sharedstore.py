@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (C) 2017, 2018 Robert Griesel
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>
+
+import atexit
+import json
+import os
+import os.path
+import re
+import shutil
+import tempfile
+
+
+class SharedStore(object):
+    ''' Directory of named objects kernels of all worksheets can map without
+        copying. Kernels write raw data to <name>.data and a description to
+        <name>.json (see KernelProcess.shared_store), this side lists and
+        removes them. The directory lives as long as the notebook session
+        and is put on tmpfs (/dev/shm) if there is one, so publishing
+        doesn't touch the disk. '''
+
+    name_regex = re.compile(r'^[A-Za-z_][\w.-]*$')
+
+    def __init__(self):
+        base_directory = '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) else None
+        self.remove_stale_directories(base_directory)
+        self.directory = tempfile.mkdtemp(prefix='gsnb-store-' + str(os.getpid()) + '-', dir=base_directory)
+        atexit.register(self.close)
+
+    def remove_stale_directories(self, base_directory):
+        ''' stores of sessions that didn't exit cleanly. '''
+
+        base_directory = base_directory if base_directory != None else tempfile.gettempdir()
+        try:
+            filenames = os.listdir(base_directory)
+        except OSError:
+            return
+        for filename in filenames:
+            match = re.match(r'^gsnb-store-(\d+)-', filename)
+            if match == None: continue
+            try:
+                os.kill(int(match.group(1)), 0)
+            except ProcessLookupError:
+                shutil.rmtree(os.path.join(base_directory, filename), ignore_errors=True)
+            except OSError:
+                pass
+
+    def list_objects(self):
+        ''' descriptions of published objects, sorted by name. each is a dict
+            with 'name', 'kind' ('ndarray' or 'buffer'), 'dtype', 'shape',
+            'nbytes', 'published' (unix time) and 'pid' of the publisher. '''
+
+        objects = list()
+        try:
+            filenames = os.listdir(self.directory)
+        except OSError:
+            return objects
+        for filename in filenames:
+            if not filename.endswith('.json'): continue
+            try:
+                with open(os.path.join(self.directory, filename), 'r') as filehandle:
+                    description = json.load(filehandle)
+            except (IOError, ValueError):
+                continue
+            objects.append(description)
+        return sorted(objects, key=lambda description: description['name'])
+
+    def get_total_size(self):
+        return sum(description['nbytes'] for description in self.list_objects())
+
+    def remove(self, name):
+        ''' kernels that mapped the object keep their mapping. '''
+
+        if self.name_regex.match(name) == None: return
+        for extension in ['.json', '.data']:
+            try:
+                os.unlink(os.path.join(self.directory, name + extension))
+            except OSError:
+                pass
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+shared_store = None
+
+def open_shared_store():
+    ''' creates the store of this notebook session, only the gui does.
+        kernels of batch runs and benchmarks go without one. '''
+
+    global shared_store
+    if shared_store == None:
+        shared_store = SharedStore()
+    return shared_store
+
+def get_shared_store():
+    ''' the store of this notebook session, None if it wasn't opened. '''
+
+    return shared_store
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (C) 2017, 2018 Robert Griesel
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>
+
+''' Evaluate worksheets without the gtk interface, e.g. for nightly reruns:
+
+    python3 batch.py [--jobs N] [--no-save] [--output report.json] PATH [PATH ...]
+
+    PATH is a worksheet folder (containing worksheet.html) or a notebook
+    folder like ~/.sage/gsnb. A JSON report with per worksheet timings and
+    failures is written to stdout or to --output. Exit status is 1 if any
+    worksheet failed. '''
+
+import argparse
+import json
+import sys
+from backend.backendbatch import BatchRunner
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='batch.py', description='Evaluate GSNB worksheets headless.')
+    parser.add_argument('paths', nargs='+', metavar='PATH')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of worksheets evaluated concurrently (default: cpu count)')
+    parser.add_argument('--no-save', action='store_true', help='do not write results back to worksheet.html')
+    parser.add_argument('--backend', default=None, choices=['sage', 'python3'], help='override the kernel set in the worksheets')
+    parser.add_argument('-o', '--output', default=None, help='write JSON report to this file')
+    arguments = parser.parse_args(argv)
+
+    runner = BatchRunner(concurrency=arguments.jobs, save=not arguments.no_save, backend=arguments.backend)
+    report = runner.run(arguments.paths)
+
+    if arguments.output != None:
+        with open(arguments.output, 'w') as filehandle:
+            json.dump(report, filehandle, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    return 1 if report['summary']['failed'] > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (C) 2017, 2018 Robert Griesel
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>
+
+''' Benchmarks for the sagemath backend:
+
+    python3 -m benchmarks.backend_benchmark [--output FILE] [--compare BASELINE]
+
+    Drives BackendControllerSageMath, ComputeQueue, SageMathQuery and
+    InterfacePexpect from the glib main loop, like the gui does, against a
+    real kernel process that is plain python3 standing in for sage (see
+    StandInSageMathProcess). Needs neither sage nor a display. Measures
+
+        per_cell_overhead   evaluation of trivial cells one after another
+        run_all             a worksheet of many cells evaluated at once
+        interrupt_latency   stopping a long cell until the kernel is usable
+        restart_latency     restarting the kernel until it's running again
+        large_output        cells printing outputs of growing size
+
+    and prints the results as JSON. With --compare every timing is checked
+    against a previous result file, exit status is 1 if one got slower by
+    more than the tolerance. '''
+
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+from gi.repository import GLib
+from backend.backendcontroller import BackendControllerSageMath
+from benchmarks.fakekernel import get_stand_in_interface
+from benchmarks.stress_compute_queue import StressWorksheet, StressCell
+
+
+class BenchmarkWorksheet(StressWorksheet):
+
+    def create_cell(self):
+        return BenchmarkCell(self)
+
+
+class BenchmarkCell(StressCell):
+    ''' remembers when its last result arrived. '''
+
+    def __init__(self, worksheet):
+        StressCell.__init__(self, worksheet)
+        self.timestamps = None
+        self.time_result = None
+
+    def evaluate(self):
+        self.timestamps = None
+        self.time_result = None
+        StressCell.evaluate(self)
+
+    def add_evaluation_timestamps(self, timestamps):
+        self.timestamps = timestamps
+
+    def parse_result_blob(self):
+        StressCell.parse_result_blob(self)
+        self.time_result = time.time()
+
+
+class BackendBenchmark(object):
+
+    def __init__(self, arguments):
+        self.arguments = arguments
+        self.controller = BackendControllerSageMath()
+        self.compute_queue = self.controller.compute_queue
+        self.compute_queue.interface = get_stand_in_interface()
+        self.worksheets = list()
+
+    def add_worksheet(self, cell_count):
+        worksheet = BenchmarkWorksheet('worksheet' + str(len(self.worksheets)), cell_count)
+        worksheet.register_observer(self.controller)
+        for cell in worksheet.cells:
+            cell.register_observer(self.controller)
+        self.worksheets.append(worksheet)
+        return worksheet
+
+    def remove_worksheets(self):
+        for worksheet in self.worksheets:
+            self.compute_queue.release_worksheet(worksheet)
+        self.worksheets = list()
+        self.wait(0.2)
+
+    def wait_until(self, condition, timeout=None):
+        ''' run the main loop until condition() is true. '''
+
+        if timeout == None: timeout = self.arguments.timeout
+        context = GLib.MainContext.default()
+        deadline = time.time() + timeout
+        ticker = GLib.timeout_add(5, lambda: True) # so the timeout is noticed
+        try:
+            while not condition():
+                if time.time() > deadline:
+                    raise TimeoutError('backend benchmark: no progress in ' + str(timeout) + ' seconds')
+                context.iteration(True)
+        finally:
+            GLib.source_remove(ticker)
+
+    def wait(self, seconds):
+        time_end = time.time() + seconds
+        self.wait_until(lambda: time.time() >= time_end, seconds + 1)
+
+    def evaluate(self, cell, text):
+        ''' evaluate cell and wait for its result, returns the seconds it took. '''
+
+        cell.text = text
+        time_start = time.time()
+        cell.evaluate()
+        self.wait_until(lambda: cell.time_result != None)
+        return cell.time_result - time_start
+
+    def run(self):
+        report = {'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                                  'kernel': 'StandInSageMathProcess', 'time': time.time()},
+                  'parameters': get_parameters(self.arguments)}
+        for name in ['per_cell_overhead', 'run_all', 'interrupt_latency', 'restart_latency', 'large_output']:
+            report[name] = getattr(self, 'benchmark_' + name)()
+            self.remove_worksheets()
+        return report
+
+    def benchmark_per_cell_overhead(self):
+        ''' cells that do nothing, evaluated one after another. overhead is
+            the time not spent running the cell in the kernel. '''
+
+        worksheet = self.add_worksheet(1)
+        cell = worksheet.cells[0]
+        self.evaluate(cell, 'pass') # kernel start, see restart_latency
+        totals = list()
+        kernel_times = list()
+        for i in range(self.arguments.cells_overhead):
+            totals.append(self.evaluate(cell, 'x = ' + str(i)))
+            kernel_times.append(cell.timestamps['received'] - cell.timestamps['sent'])
+        overheads = [total - kernel_time for total, kernel_time in zip(totals, kernel_times)]
+        return {'cells': len(totals),
+                'median_seconds': statistics.median(totals),
+                'p95_seconds': get_percentile(totals, 0.95),
+                'kernel_median_seconds': statistics.median(kernel_times),
+                'overhead_median_seconds': statistics.median(overheads)}
+
+    def benchmark_run_all(self):
+        ''' all cells of a worksheet queued at once, like evaluate all. '''
+
+        worksheet = self.add_worksheet(self.arguments.cells_run_all)
+        self.evaluate(worksheet.cells[0], 'pass') # kernel start isn't measured here
+        time_start = time.time()
+        for position, cell in enumerate(worksheet.cells):
+            cell.text = 'x_' + str(position) + ' = ' + str(position)
+            cell.evaluate()
+        self.wait_until(lambda: all(cell.time_result != None for cell in worksheet.cells))
+        seconds = max(cell.time_result for cell in worksheet.cells) - time_start
+        first_result = min(cell.time_result for cell in worksheet.cells) - time_start
+        return {'cells': len(worksheet.cells),
+                'seconds': seconds,
+                'first_result_seconds': first_result,
+                'cells_per_second': len(worksheet.cells) / seconds}
+
+    def benchmark_interrupt_latency(self):
+        ''' stop a cell while the kernel runs it. measured until the compute
+            queue is idle and until the next cell has its result. '''
+
+        worksheet = self.add_worksheet(2)
+        long_cell, next_cell = worksheet.cells
+        self.evaluate(next_cell, 'import time')
+        idle_times = list()
+        next_result_times = list()
+        for i in range(self.arguments.repetitions):
+            long_cell.text = 'time.sleep(60)'
+            long_cell.evaluate()
+            self.wait_until(lambda: self.is_running(worksheet, long_cell))
+            self.wait(0.2) # until the kernel is in time.sleep()
+            time_start = time.time()
+            long_cell.stop_evaluation()
+            next_cell.text = 'x = ' + str(i)
+            next_cell.evaluate()
+            self.wait_until(lambda: self.compute_queue.get_active_query(worksheet) == None or self.compute_queue.get_active_query(worksheet).get_cell() != long_cell)
+            idle_times.append(time.time() - time_start)
+            self.wait_until(lambda: next_cell.time_result != None)
+            next_result_times.append(next_cell.time_result - time_start)
+        return {'runs': len(idle_times),
+                'kernel_released_median_seconds': statistics.median(idle_times),
+                'next_result_median_seconds': statistics.median(next_result_times),
+                'next_result_max_seconds': max(next_result_times)}
+
+    def is_running(self, worksheet, cell):
+        query = self.compute_queue.get_active_query(worksheet)
+        return query != None and query.get_cell() == cell
+
+    def benchmark_restart_latency(self):
+        ''' restart the kernel until it's running and has evaluated a cell. '''
+
+        worksheet = self.add_worksheet(1)
+        cell = worksheet.cells[0]
+        self.evaluate(cell, 'pass')
+        running_times = list()
+        first_result_times = list()
+        for i in range(self.arguments.repetitions):
+            time_start = time.time()
+            worksheet.restart_kernel()
+            cell.text = 'pass'
+            cell.evaluate()
+            self.wait_until(lambda: worksheet.kernel_state == 'running')
+            running_times.append(time.time() - time_start)
+            self.wait_until(lambda: cell.time_result != None)
+            first_result_times.append(cell.time_result - time_start)
+        return {'runs': len(running_times),
+                'running_median_seconds': statistics.median(running_times),
+                'first_result_median_seconds': statistics.median(first_result_times),
+                'first_result_max_seconds': max(first_result_times)}
+
+    def benchmark_large_output(self):
+        ''' one cell printing outputs of growing size. '''
+
+        worksheet = self.add_worksheet(1)
+        cell = worksheet.cells[0]
+        self.evaluate(cell, 'pass')
+        transfers = dict()
+        for size in self.arguments.output_sizes:
+            seconds = self.evaluate(cell, 'print("x" * ' + str(size - 1) + ')')
+            if len(cell.result_text) != size - 1:
+                raise RuntimeError('backend benchmark: output of ' + str(size) + ' bytes arrived with ' + str(len(cell.result_text)))
+            transfers[str(size)] = {'seconds': seconds, 'megabytes_per_second': size / seconds / 1000000}
+        return transfers
+
+
+def get_parameters(arguments):
+    ''' what the timings depend on, results are only comparable if these match. '''
+
+    return {'cells_overhead': arguments.cells_overhead, 'cells_run_all': arguments.cells_run_all,
+            'repetitions': arguments.repetitions, 'output_sizes': arguments.output_sizes}
+
+
+def get_percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def get_timings(report, prefix=''):
+    ''' flat dict of all timings in report: 'scenario.key': seconds. '''
+
+    timings = dict()
+    for key, value in report.items():
+        if isinstance(value, dict):
+            timings.update(get_timings(value, prefix + key + '.'))
+        elif key == 'seconds' or key.endswith('_seconds'):
+            timings[prefix + key] = value
+    return timings
+
+
+def compare(report, baseline, tolerance, noise_floor):
+    ''' timings slower than in baseline by more than tolerance (a fraction)
+        and noise_floor (seconds). '''
+
+    regressions = list()
+    baseline_timings = get_timings(baseline)
+    for key, seconds in sorted(get_timings(report).items()):
+        if key.startswith('environment.') or key not in baseline_timings: continue
+        baseline_seconds = baseline_timings[key]
+        if seconds > baseline_seconds * (1 + tolerance) and seconds - baseline_seconds > noise_floor:
+            regressions.append({'timing': key, 'baseline': baseline_seconds, 'current': seconds})
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='backend_benchmark', description='Benchmark the GSNB sagemath backend with a stand-in kernel.')
+    parser.add_argument('--cells-overhead', type=int, default=200, help='cells evaluated one by one')
+    parser.add_argument('--cells-run-all', type=int, default=1000, help='cells in the evaluate all worksheet')
+    parser.add_argument('--repetitions', type=int, default=10, help='interrupts and restarts')
+    parser.add_argument('--output-sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000], help='bytes printed by the large output cells')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds to wait for the backend')
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--compare', help='results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown against --compare, 0.25 = 25%%')
+    parser.add_argument('--noise-floor', type=float, default=0.005, help='slowdowns of fewer seconds are ignored')
+    arguments = parser.parse_args(argv)
+
+    baseline = None
+    if arguments.compare != None:
+        with open(arguments.compare, 'r') as filehandle:
+            baseline = json.load(filehandle)
+        if baseline.get('parameters', None) != get_parameters(arguments):
+            sys.stderr.write('backend_benchmark: ' + arguments.compare + ' was run with different parameters: ' + json.dumps(baseline.get('parameters', None)) + '\n')
+            return 2
+
+    benchmark = BackendBenchmark(arguments)
+    report = benchmark.run()
+    if baseline != None:
+        report['regressions'] = compare(report, baseline, arguments.tolerance, arguments.noise_floor)
+    if arguments.output != None:
+        with open(arguments.output, 'w') as filehandle:
+            json.dump(report, filehandle, indent=2)
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    return 1 if len(report.get('regressions', [])) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (C) 2017, 2018 Robert Griesel
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>
+
+import asyncio
+import os
+import random
+import sys
+import pexpect
+from backend.kernelpexpect import KernelProcess, SageMathProcess, InterfacePexpect
+
+
+class FakeKernel(object):
+    ''' Stands in for a KernelProcess: a query takes a random time between
+        min_duration and max_duration seconds and returns its own text.
+        Like the real kernels it runs in the backend event loop. '''
+
+    def __init__(self, min_duration=0.0, max_duration=0.002, start_duration=0.0):
+        self.min_duration = min_duration
+        self.max_duration = max_duration
+        self.start_duration = start_duration
+        self.interrupted = None
+        self.state = 'not started'
+        self.query_count = 0
+
+    async def start(self):
+        self.interrupted = asyncio.Event()
+        await asyncio.sleep(self.start_duration)
+        self.state = 'started'
+
+    async def run(self, query_string, sage_mode=True, mode='normal', track_memory=False):
+        self.interrupted.clear()
+        self.query_count += 1
+        try:
+            await asyncio.wait_for(self.interrupted.wait(), random.uniform(self.min_duration, self.max_duration))
+        except asyncio.TimeoutError:
+            return {'text': query_string, 'files': [], 'path': ''}
+        return None
+
+    def stop_computation(self):
+        if self.interrupted != None:
+            self.interrupted.set()
+
+    def kill(self):
+        self.stop_computation()
+        self.state = 'stopped'
+
+
+class FakeInterface(object):
+    ''' Drop-in replacement for InterfacePexpect, one FakeKernel per worksheet. '''
+
+    def __init__(self, **kernel_arguments):
+        self.kernel_arguments = kernel_arguments
+        self.processes = dict()
+        self.start_tasks = dict()
+        self.started_count = 0
+
+    async def get_process(self, worksheet):
+        if not worksheet in self.processes:
+            process = FakeKernel(**self.kernel_arguments)
+            self.processes[worksheet] = process
+            self.start_tasks[worksheet] = asyncio.ensure_future(process.start())
+            self.started_count += 1
+        process = self.processes[worksheet]
+        await asyncio.shield(self.start_tasks[worksheet])
+        return process
+
+    def stop_process(self, worksheet):
+        process = self.processes.pop(worksheet, None)
+        self.start_tasks.pop(worksheet, None)
+        if process != None:
+            process.kill()
+
+    async def run(self, query_string, worksheet, sage_mode=True, mode='normal', track_memory=False):
+        process = await self.get_process(worksheet)
+        return await process.run(query_string, sage_mode, mode, track_memory)
+
+    def stop_computation_by_worksheet(self, worksheet):
+        process = self.processes.get(worksheet, None)
+        if process != None:
+            process.stop_computation()
+
+    def stop_computation(self):
+        for process in self.processes.values():
+            process.stop_computation()
+
+
+class StandInSageMathProcess(SageMathProcess):
+    ''' A real kernel process with plain python3 in place of sage --python.
+        Queries take the same way through pexpect, the code cache and the
+        resource meter as with sage, only the preparser does nothing. For
+        benchmarks on machines without sage. '''
+
+    support_stand_in = '''import types
+_support_ = types.SimpleNamespace(preparse_worksheet_cell=lambda source, namespace: source)
+'''
+
+    command = sys.executable + ' -q -i'
+
+    def spawn(self):
+        env = dict(os.environ, TERM='dumb', PYTHON_BASIC_REPL='1')
+        process = pexpect.spawn(self.command, env=env)
+        process.delaybeforesend = None
+        return process
+
+    def get_setup_lines(self):
+        setup_lines = KernelProcess.get_setup_lines(self)
+        setup_lines.append('exec(' + repr(self.support_stand_in) + ')')
+        setup_lines.append('exec(' + repr(self.cell_runner) + ')')
+        return setup_lines
+
+    def get_print_command(self, expression):
+        return 'print(' + expression + ')'
+
+
+def get_stand_in_interface():
+    ''' InterfacePexpect starting StandInSageMathProcess for sage worksheets. '''
+
+    interface = InterfacePexpect()
+    interface.kernel_classes = {'sage': StandInSageMathProcess, 'python3': StandInSageMathProcess}
+    return interface
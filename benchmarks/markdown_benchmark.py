@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (C) 2017, 2018 Robert Griesel
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>
+
+''' Throughput benchmark for markdown cells:
+
+    python3 -m benchmarks.markdown_benchmark [--headless] [--sizes 1 10 100 1000 10000] [--output FILE]
+
+    Feeds documents of growing numbers of paragraphs through every stage
+    of MarkdownQuery.evaluate(), then model.MarkdownResult and
+    MarkdownResultView.compile(). Reports time and peak python memory
+    (tracemalloc) per stage and size, and the exponent of each stage's
+    scaling curve (seconds ~ paragraphs ** exponent). Exit status is 1 if
+    an exponent is above --max-exponent, so a stage that turned quadratic
+    fails CI. --headless leaves out the view, which needs a display. '''
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from backend.backendmarkdown import MarkdownQuery
+from benchmarks.persistence_benchmark import get_exponent
+
+
+class BenchmarkCellView(object):
+    ''' the parts of viewgtk.CellView MarkdownResultView uses. '''
+
+    class LineNumbersRenderer(object):
+        width = 3
+
+    line_numbers_renderer = LineNumbersRenderer()
+
+
+class MarkdownBenchmark(object):
+
+    def __init__(self, arguments):
+        self.arguments = arguments
+        self.random = random.Random(arguments.seed)
+        self.stages = list(MarkdownQuery(None, None).get_stages())
+
+        import model.model as model
+        self.stages.append(('result', model.MarkdownResult))
+        if not arguments.headless:
+            import viewgtk.viewgtk as view
+            self.view = view
+            self.stages.append(('view', self.build_view))
+
+    def build_view(self, result):
+        result_view = self.view.MarkdownResultView(BenchmarkCellView())
+        result_view.set_blocks(result.get_blocks())
+        result_view.compile()
+        self.view.get_markdown_renderer().flush() # labels are built in idle callbacks otherwise
+        return result_view
+
+    def get_document(self, paragraph_count):
+        ''' paragraphs with inline markup and links, a header before every tenth. '''
+
+        words = ['the', 'ring', 'field', '*prime*', 'ideal', '**group**', '`matrix`', 'over', 'of', '[docs](http://doc.sagemath.org)']
+        paragraphs = list()
+        for position in range(paragraph_count):
+            if position % 10 == 0:
+                paragraphs.append('#' * self.random.randint(1, 3) + ' Section ' + str(position // 10 + 1))
+            paragraphs.append(' '.join(self.random.choice(words) for i in range(self.random.randint(20, 60))).capitalize() + '.')
+        return '\n\n'.join(paragraphs)
+
+    def run(self):
+        results = dict()
+        for name, stage in self.stages + [('total', None)]:
+            results[name] = {'sizes': list(), 'seconds': list(), 'peak_bytes': list()}
+        for size in self.arguments.sizes:
+            document = self.get_document(size)
+            timings = self.measure_time(document)
+            memory = self.measure_memory(document)
+            for name, seconds in timings.items():
+                results[name]['sizes'].append(size)
+                results[name]['seconds'].append(seconds)
+                results[name]['peak_bytes'].append(memory[name])
+
+        superlinear = list()
+        for name, result in results.items():
+            fitted = [(size, seconds) for size, seconds in zip(result['sizes'], result['seconds']) if size >= self.arguments.fit_from]
+            result['exponent'] = get_exponent([size for size, seconds in fitted], [seconds for size, seconds in fitted])
+            if result['exponent'] > self.arguments.max_exponent and max(result['seconds']) >= self.arguments.min_seconds:
+                superlinear.append(name)
+        return {'environment': {'python': platform.python_version(), 'platform': platform.platform(), 'time': time.time()},
+                'parameters': {'sizes': self.arguments.sizes, 'repetitions': self.arguments.repetitions, 'headless': self.arguments.headless,
+                               'fit_from': self.arguments.fit_from, 'min_seconds': self.arguments.min_seconds, 'seed': self.arguments.seed},
+                'stages': results,
+                'superlinear': superlinear}
+
+    def measure_time(self, document):
+        ''' fastest of repetitions for every stage, 'total' is their sum.
+            documents that take longer than a second are run only once. '''
+
+        timings = dict()
+        for i in range(self.arguments.repetitions):
+            data = document
+            for name, stage in self.stages:
+                time_start = time.perf_counter()
+                data = stage(data)
+                seconds = time.perf_counter() - time_start
+                timings[name] = min(timings.get(name, seconds), seconds)
+            if sum(timings.values()) > 1: break
+        timings['total'] = sum(timings.values())
+        return timings
+
+    def measure_memory(self, document):
+        ''' peak memory above what the stage's input takes, in a separate
+            run since tracemalloc slows everything down. widgets are only
+            counted as far as python objects are concerned. '''
+
+        memory = dict()
+        tracemalloc.start()
+        try:
+            data = document
+            for name, stage in self.stages:
+                tracemalloc.reset_peak()
+                memory_before = tracemalloc.get_traced_memory()[0]
+                data = stage(data)
+                memory[name] = tracemalloc.get_traced_memory()[1] - memory_before
+        finally:
+            tracemalloc.stop()
+        memory['total'] = max(memory.values())
+        return memory
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='markdown_benchmark', description='Benchmark rendering GSNB markdown cells.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 100, 1000, 10000], help='paragraphs per document')
+    parser.add_argument('--repetitions', type=int, default=3, help='the fastest repetition counts')
+    parser.add_argument('--headless', action='store_true', help='leave out the gtk view')
+    parser.add_argument('--fit-from', type=int, default=100, help='smaller documents are left out of the scaling fit, constant costs dominate them')
+    parser.add_argument('--max-exponent', type=float, default=1.3, help='fail if a stage scales worse than paragraphs ** max_exponent')
+    parser.add_argument('--min-seconds', type=float, default=0.01, help='stages faster than this on the largest document are too noisy to judge')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this file')
+    arguments = parser.parse_args(argv)
+
+    benchmark = MarkdownBenchmark(arguments)
+    report = benchmark.run()
+    if arguments.output != None:
+        with open(arguments.output, 'w') as filehandle:
+            json.dump(report, filehandle, indent=2)
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    return 1 if len(report['superlinear']) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
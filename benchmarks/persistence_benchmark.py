@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (C) 2017, 2018 Robert Griesel
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>
+
+''' Benchmarks for loading and saving worksheets:
+
+    python3 -m benchmarks.persistence_benchmark [--sizes 100 200 400 800] [--output FILE]
+    python3 -m benchmarks.persistence_benchmark --generate DIRECTORY [--worksheets N] [--cells N]
+
+    Generates synthetic worksheets with code cells, large text outputs,
+    images and markdown cells, and times Worksheet.populate_cells (including
+    the idle callbacks that fill in the cells' text), save_to_disk,
+    export_gsnb, Notebook.import_gsnb and Notebook.populate_from_path at
+    growing sizes. For every operation the exponent of its scaling curve is
+    fitted (seconds ~ size ** exponent), exit status is 1 if one of them is
+    above --max-exponent, i.e. the operation got quadratic somewhere.
+
+    Needs Gtk and GtkSource, but no display. Run it from the GSNB folder,
+    worksheets look up their syntax highlighting there. With --generate
+    only a notebook is written, e.g. to try GSNB itself with
+    python3 __main__.py after pointing ~/.sage/gsnb at it. '''
+
+import argparse
+import datetime
+import json
+import math
+import os
+import pickle
+import platform
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from gi.repository import GLib
+
+
+class NotebookGenerator(object):
+    ''' writes worksheets in the format of Worksheet.save_to_disk(). every
+        image_every-th cell has an image as result, every markdown_every-th
+        cell is a markdown cell, the other cells print output_size bytes. '''
+
+    def __init__(self, seed=0, output_size=2000, image_every=10, image_size=(400, 300), markdown_every=5):
+        self.random = random.Random(seed)
+        self.output_size = output_size
+        self.image_every = image_every
+        self.image_size = image_size
+        self.markdown_every = markdown_every
+        self.markdown_query = None
+        self.images = list()
+
+    def write_notebook(self, pathname, worksheet_count, cell_count):
+        for id_number in range(worksheet_count):
+            self.write_worksheet(pathname + '/' + str(id_number), 'Synthetic ' + str(id_number), cell_count, id_number)
+
+    def write_worksheet(self, pathname, name, cell_count, id_number=0):
+        if not os.path.isdir(pathname): os.makedirs(pathname)
+        meta = {'name': name, 'tags': {}, 'id_number': id_number, 'backend': 'sage',
+                'last_change': ('admin', time.time()), 'last_accessed': datetime.datetime.fromtimestamp(0)}
+        with open(pathname + '/worksheet_conf.pickle', 'wb') as filehandle:
+            pickle.dump(meta, filehandle)
+
+        image_count = 0
+        with open(pathname + '/worksheet.html', 'w') as filehandle:
+            for key in range(cell_count):
+                if self.markdown_every > 0 and key % self.markdown_every == self.markdown_every - 1:
+                    text = self.get_markdown_text()
+                    filehandle.write('MD{{{id=' + str(key) + '|\n' + text + '\n///\n' + self.render_markdown(text) + '\n}}}\n')
+                    continue
+                if self.image_every > 0 and key % self.image_every == self.image_every // 2:
+                    filename = 'result' + str(image_count) + '.png'
+                    image_count += 1
+                    with open(pathname + '/' + filename, 'wb') as image_filehandle:
+                        image_filehandle.write(self.get_png(self.image_size[0], self.image_size[1]))
+                    result_string = '<image>' + filename + '</image>'
+                else:
+                    result_string = self.get_output(self.output_size)
+                filehandle.write('{{{id=' + str(key) + '|\n' + self.get_code(key) + '\n///\n' + result_string + '\n}}}\n')
+
+    def get_code(self, key):
+        lines = ['x_' + str(key) + ' = ' + str(self.random.randint(0, 10 ** 6))]
+        for i in range(self.random.randint(0, 8)):
+            lines.append('y = sum(k ** ' + str(i) + ' for k in range(' + str(self.random.randint(1, 1000)) + '))')
+        lines.append('print(x_' + str(key) + ')')
+        return '\n'.join(lines)
+
+    def get_output(self, size):
+        ''' lines of digits, about size bytes. '''
+
+        lines = list()
+        length = 0
+        while length < size:
+            line = ''.join(self.random.choice('0123456789 ') for i in range(min(79, size - length)))
+            lines.append(line.strip() or '0')
+            length += len(line) + 1
+        return '\n'.join(lines)
+
+    def get_markdown_text(self):
+        paragraphs = ['## Section ' + str(self.random.randint(1, 100))]
+        for i in range(self.random.randint(1, 6)):
+            words = [self.random.choice(['the', 'ring', 'field', '*prime*', 'ideal', '**group**', '`matrix`', 'over', 'of']) for j in range(self.random.randint(10, 80))]
+            paragraphs.append(' '.join(words).capitalize() + '.')
+        return '\n\n'.join(paragraphs)
+
+    def render_markdown(self, text):
+        ''' the result string MarkdownResult.get_as_raw_text() saves. '''
+
+        if self.markdown_query == None:
+            from backend.backendmarkdown import MarkdownQuery
+            self.markdown_query = MarkdownQuery(None, None)
+        self.markdown_query.set_query_string(text)
+        return json.dumps(self.markdown_query.evaluate()['result_blob'], ensure_ascii=False)
+
+    def get_png(self, width, height):
+        ''' one of a few images, a gradient with some noise, they compress
+            about like plots. '''
+
+        if len(self.images) < 4:
+            rows = list()
+            for y in range(height):
+                row = bytearray(self.random.getrandbits(8 * 3 * width).to_bytes(3 * width, 'little'))
+                for x in range(width):
+                    row[3 * x] = x * 255 // width
+                    row[3 * x + 1] = y * 255 // height
+                    row[3 * x + 2] = row[3 * x + 2] if x % 8 == 0 else 0
+                rows.append(b'\x00' + bytes(row))
+            def chunk(chunk_type, data):
+                return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff)
+            header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+            self.images.append(b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(b''.join(rows))) + chunk(b'IEND', b''))
+            return self.images[-1]
+        return self.random.choice(self.images)
+
+
+class PersistenceBenchmark(object):
+
+    operations = ['load', 'save', 'export', 'import', 'notebook_load']
+
+    def __init__(self, arguments):
+        import model.model as model
+        self.model = model
+        self.arguments = arguments
+        self.generator = NotebookGenerator(arguments.seed, arguments.output_size, arguments.image_every, (arguments.image_width, arguments.image_height), arguments.markdown_every)
+        self.directory = tempfile.mkdtemp(prefix='gsnb-persistence-')
+
+    def run(self):
+        try:
+            results = dict()
+            for operation in self.operations:
+                results[operation] = {'sizes': list(), 'seconds': list()}
+            disk_usage = list()
+            for size in self.arguments.sizes:
+                timings, bytes_on_disk = self.measure_worksheet(size)
+                disk_usage.append(bytes_on_disk)
+                for operation, seconds in timings.items():
+                    results[operation]['sizes'].append(size)
+                    results[operation]['seconds'].append(seconds)
+                results['notebook_load']['sizes'].append(size)
+                results['notebook_load']['seconds'].append(self.measure_notebook(size))
+        finally:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+        superlinear = list()
+        for operation, result in results.items():
+            result['exponent'] = get_exponent(result['sizes'], result['seconds'])
+            if result['exponent'] > self.arguments.max_exponent:
+                superlinear.append(operation)
+        return {'environment': {'python': platform.python_version(), 'platform': platform.platform(), 'time': time.time()},
+                'parameters': get_parameters(self.arguments),
+                'worksheet_bytes': dict(zip([str(size) for size in self.arguments.sizes], disk_usage)),
+                'operations': results,
+                'superlinear': superlinear}
+
+    def measure_worksheet(self, cell_count):
+        ''' best of repetitions for one worksheet of cell_count cells. '''
+
+        timings = {'load': list(), 'save': list(), 'export': list(), 'import': list()}
+        pathname = self.directory + '/worksheet-' + str(cell_count)
+        self.generator.write_worksheet(pathname, 'Synthetic', cell_count)
+        bytes_on_disk = sum(os.path.getsize(pathname + '/' + filename) for filename in os.listdir(pathname))
+        for i in range(self.arguments.repetitions):
+            notebook_pathname = self.directory + '/notebook-' + str(cell_count) + '-' + str(i)
+            notebook = self.model.Notebook()
+            notebook.populate_from_path(notebook_pathname)
+            worksheet = self.model.NormalWorksheet(notebook)
+            worksheet.set_pathname(pathname)
+            worksheet.populate_meta()
+
+            time_start = time.perf_counter()
+            worksheet.populate_cells()
+            run_idle_callbacks()
+            timings['load'].append(time.perf_counter() - time_start)
+            if worksheet.get_cell_count() < cell_count:
+                raise RuntimeError('persistence benchmark: loaded ' + str(worksheet.get_cell_count()) + ' of ' + str(cell_count) + ' cells')
+
+            time_start = time.perf_counter()
+            worksheet.save_to_disk()
+            run_idle_callbacks()
+            timings['save'].append(time.perf_counter() - time_start)
+
+            export_pathname = notebook_pathname + '.gsnb'
+            time_start = time.perf_counter()
+            worksheet.export_gsnb(export_pathname)
+            timings['export'].append(time.perf_counter() - time_start)
+
+            time_start = time.perf_counter()
+            notebook.import_gsnb(export_pathname)
+            run_idle_callbacks()
+            timings['import'].append(time.perf_counter() - time_start)
+
+            shutil.rmtree(notebook_pathname, ignore_errors=True)
+            os.remove(export_pathname)
+        return (dict((operation, min(seconds)) for operation, seconds in timings.items()), bytes_on_disk)
+
+    def measure_notebook(self, worksheet_count):
+        ''' Notebook.populate_from_path for worksheet_count worksheets. it
+            only reads their meta data, so they are written without images. '''
+
+        pathname = self.directory + '/notebook-' + str(worksheet_count)
+        generator = NotebookGenerator(self.arguments.seed, self.arguments.output_size, 0, markdown_every=self.arguments.markdown_every)
+        generator.write_notebook(pathname, worksheet_count, self.arguments.notebook_cells)
+        timings = list()
+        for i in range(self.arguments.repetitions):
+            notebook = self.model.Notebook()
+            time_start = time.perf_counter()
+            notebook.populate_from_path(pathname)
+            run_idle_callbacks()
+            timings.append(time.perf_counter() - time_start)
+        shutil.rmtree(pathname, ignore_errors=True)
+        return min(timings)
+
+
+def run_idle_callbacks():
+    ''' cells get their text in idle callbacks, they are part of loading. '''
+
+    context = GLib.MainContext.default()
+    while context.pending():
+        context.iteration(False)
+
+
+def get_exponent(sizes, seconds):
+    ''' slope of the least squares line through (log size, log seconds). '''
+
+    points = [(math.log(size), math.log(max(duration, 1e-9))) for size, duration in zip(sizes, seconds)]
+    if len(points) < 2: return 0
+    mean_x = sum(x for x, y in points) / len(points)
+    mean_y = sum(y for x, y in points) / len(points)
+    variance = sum((x - mean_x) ** 2 for x, y in points)
+    if variance == 0: return 0
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
+
+
+def get_parameters(arguments):
+    return {'sizes': arguments.sizes, 'repetitions': arguments.repetitions, 'output_size': arguments.output_size,
+            'image_every': arguments.image_every, 'image_size': [arguments.image_width, arguments.image_height],
+            'markdown_every': arguments.markdown_every, 'notebook_cells': arguments.notebook_cells, 'seed': arguments.seed}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='persistence_benchmark', description='Benchmark loading and saving GSNB worksheets.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 200, 400, 800], help='cells per worksheet, and worksheets per notebook')
+    parser.add_argument('--repetitions', type=int, default=3, help='the fastest repetition counts')
+    parser.add_argument('--output-size', type=int, default=2000, help='bytes of output per code cell')
+    parser.add_argument('--image-every', type=int, default=10, help='every nth cell has an image result, 0 for none')
+    parser.add_argument('--image-width', type=int, default=400)
+    parser.add_argument('--image-height', type=int, default=300)
+    parser.add_argument('--markdown-every', type=int, default=5, help='every nth cell is a markdown cell, 0 for none')
+    parser.add_argument('--notebook-cells', type=int, default=20, help='cells per worksheet when timing whole notebooks')
+    parser.add_argument('--max-exponent', type=float, default=1.3, help='fail if an operation scales worse than size ** max_exponent')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--generate', metavar='DIRECTORY', help='only write a synthetic notebook to DIRECTORY')
+    parser.add_argument('--worksheets', type=int, default=20, help='worksheets written by --generate')
+    parser.add_argument('--cells', type=int, default=200, help='cells per worksheet written by --generate')
+    arguments = parser.parse_args(argv)
+
+    if arguments.generate != None:
+        generator = NotebookGenerator(arguments.seed, arguments.output_size, arguments.image_every, (arguments.image_width, arguments.image_height), arguments.markdown_every)
+        generator.write_notebook(arguments.generate, arguments.worksheets, arguments.cells)
+        return 0
+
+    benchmark = PersistenceBenchmark(arguments)
+    report = benchmark.run()
+    if arguments.output != None:
+        with open(arguments.output, 'w') as filehandle:
+            json.dump(report, filehandle, indent=2)
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    return 1 if len(report['superlinear']) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
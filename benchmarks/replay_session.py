@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (C) 2017, 2018 Robert Griesel
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>
+
+''' Replays a recorded kernel session against the backend:
+
+    python3 -m benchmarks.replay_session SESSION_LOG [--speed S] [--output FILE]
+
+    Session logs are written by GSNB_RECORD_SESSION=session.jsonl.gz
+    python3 __main__.py (see backend/sessionlog.py). The recorded queries,
+    interrupts and kernel restarts are fired at BackendControllerSageMath
+    at their recorded times, ReplayKernelProcess answers them as the
+    kernel did back then. Side channel requests come from the gui and
+    aren't replayed here. Prints how much time GSNB added to every query
+    on top of the recorded kernel time. Run it under the profiler or with
+    GSNB_TRACE set to see where that time goes.
+
+    To replay a session in the gui instead, start GSNB with
+    GSNB_REPLAY_SESSION=session.jsonl.gz python3 __main__.py, its kernels
+    then answer like the recorded ones. '''
+
+import argparse
+import json
+import statistics
+import sys
+import time
+from gi.repository import GLib
+from backend.backendcontroller import BackendControllerSageMath
+from backend.eventloop import get_backend_event_loop
+from backend.sessionlog import SessionLog
+from backend.sessionreplay import ReplayInterface
+from benchmarks.backend_benchmark import BenchmarkWorksheet, get_percentile
+
+
+class SessionReplay(object):
+
+    def __init__(self, session_log, speed, timeout):
+        self.session_log = session_log
+        self.speed = speed
+        self.timeout = timeout
+        self.controller = BackendControllerSageMath()
+        self.compute_queue = self.controller.compute_queue
+        self.compute_queue.interface = ReplayInterface(session_log)
+
+        # one worksheet per recorded worksheet, with a cell per query
+        self.worksheets = dict()
+        self.free_cells = dict()
+        for key in session_log.get_worksheet_keys():
+            run_count = len([event for event in session_log.get_events() if event['worksheet'] == key and event['event'] == 'run'])
+            worksheet = BenchmarkWorksheet('worksheet' + str(key), max(1, run_count))
+            worksheet.register_observer(self.controller)
+            for cell in worksheet.cells:
+                cell.register_observer(self.controller)
+            self.compute_queue.interface.assign(worksheet, key)
+            self.worksheets[key] = worksheet
+            self.free_cells[key] = list(worksheet.cells)
+
+        self.events = self.get_schedule(session_log.get_events())
+        self.runs = list() # (event, cell, time fired)
+        self.restart_count = 0
+
+    def get_schedule(self, events):
+        ''' the events to fire. kernels are started by their first query,
+            so that query is fired when the kernel started in the recording
+            and the start counts as kernel time. '''
+
+        schedule = list()
+        starts = dict() # start event by worksheet, until its first query
+        for event in events:
+            if event['event'] == 'start':
+                starts[event['worksheet']] = event
+            elif event['event'] in ['run', 'interrupt', 'kill']:
+                event = dict(event)
+                event['kernel_seconds'] = event.get('setup_seconds', 0) + event.get('seconds', 0)
+                start = starts.pop(event['worksheet'], None)
+                if event['event'] == 'run' and start != None:
+                    event['time'] = start['time']
+                    event['kernel_seconds'] += start['seconds']
+                schedule.append(event)
+        schedule.sort(key=lambda event: event['time'])
+        return schedule
+
+    def run(self):
+        self.main_loop = GLib.MainLoop()
+        self.time_start = time.time()
+        self.time_origin = self.events[0]['time'] if len(self.events) > 0 else 0
+        self.position = 0
+        GLib.timeout_add(1, self.replay_loop)
+        self.main_loop.run()
+        return self.get_report()
+
+    def replay_loop(self):
+        ''' fire the events that are due. '''
+
+        elapsed = (time.time() - self.time_start) * self.speed
+        while self.position < len(self.events) and self.events[self.position]['time'] - self.time_origin <= elapsed:
+            self.fire(self.events[self.position])
+            self.position += 1
+        if self.position < len(self.events):
+            return True
+        self.time_events_done = time.time()
+        GLib.timeout_add(10, self.quiescence_loop)
+        return False
+
+    def fire(self, event):
+        worksheet = self.worksheets[event['worksheet']]
+        if event['event'] == 'run':
+            cell = self.free_cells[event['worksheet']].pop(0)
+            cell.text = event.get('query', 'query ' + str(len(self.runs)))
+            self.runs.append((event, cell, time.time()))
+            cell.evaluate()
+        elif event['event'] == 'interrupt':
+            active_query = self.compute_queue.get_active_query(worksheet)
+            if active_query != None:
+                active_query.get_cell().stop_evaluation()
+        elif event['event'] == 'kill' and self.has_more_runs(event):
+            worksheet.restart_kernel()
+            self.restart_count += 1
+
+    def has_more_runs(self, event):
+        ''' kernels are killed on restart and when gsnb quits. '''
+
+        for later_event in self.events[self.position + 1:]:
+            if later_event['worksheet'] == event['worksheet'] and later_event['event'] == 'run': return True
+        return False
+
+    def quiescence_loop(self):
+        busy = any(len(worksheet.busy_cells) > 0 for worksheet in self.worksheets.values())
+        if not busy or time.time() - self.time_events_done > self.timeout:
+            self.time_done = time.time()
+            self.main_loop.quit()
+            return False
+        return True
+
+    def get_report(self):
+        ''' gsnb overhead of a query: replayed time from evaluation to
+            result minus the kernel time recorded for it and minus the time
+            it waited for the query before it in the kernel. queries only
+            wait like that when they are fired faster than recorded. '''
+
+        overheads = list()
+        kernel_done = dict() # by worksheet, when the query before was done in the kernel
+        finished_runs = sorted([run for run in self.runs if run[1].time_result != None], key=lambda run: run[1].timestamps['started'])
+        for event, cell, time_fired in finished_runs:
+            queue_wait = max(0, kernel_done.get(event['worksheet'], time_fired) - time_fired)
+            kernel_done[event['worksheet']] = cell.timestamps.get('kernel_done', cell.time_result)
+            latency = cell.time_result - time_fired
+            overheads.append(latency - event['kernel_seconds'] - queue_wait)
+        stopped_count = len(self.runs) - len(finished_runs)
+        report = {'worksheets': len(self.worksheets),
+                  'queries': len(self.runs),
+                  'queries_stopped': stopped_count,
+                  'restarts': self.restart_count,
+                  'session_seconds': (self.events[-1]['time'] - self.time_origin) if len(self.events) > 0 else 0,
+                  'replay_seconds': self.time_done - self.time_start,
+                  'speed': self.speed}
+        if len(overheads) > 0:
+            report.update({'overhead_median_seconds': statistics.median(overheads),
+                           'overhead_p95_seconds': get_percentile(overheads, 0.95),
+                           'overhead_max_seconds': max(overheads)})
+        return report
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='replay_session', description='Replay a recorded GSNB kernel session against the backend.')
+    parser.add_argument('session_log', help='written by GSNB_RECORD_SESSION')
+    parser.add_argument('--speed', type=float, default=1.0, help='2 fires the recorded events twice as fast, kernel times stay as recorded')
+    parser.add_argument('--timeout', type=float, default=600, help='seconds to wait for the last queries')
+    parser.add_argument('--output', help='write the results to this file')
+    arguments = parser.parse_args(argv)
+
+    replay = SessionReplay(SessionLog(arguments.session_log), arguments.speed, arguments.timeout)
+    report = replay.run()
+    get_backend_event_loop().stop()
+    if arguments.output != None:
+        with open(arguments.output, 'w') as filehandle:
+            json.dump(report, filehandle, indent=2)
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
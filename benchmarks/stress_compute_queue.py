@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (C) 2017, 2018 Robert Griesel
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>
+
+''' Concurrency stress test for the sagemath compute queue:
+
+    python3 -m benchmarks.stress_compute_queue [--operations N] [--seed S]
+
+    Fires thousands of random evaluate / stop / stop all / restart kernel
+    operations at BackendControllerSageMath from the glib main loop, like
+    the gui does, with a fake kernel in place of sage. Afterwards every
+    cell has to be idle again, and cells that were not stopped have to
+    show the result of their last evaluation. Prints throughput numbers,
+    exit status is 1 if a cell got stuck or lost its result. '''
+
+import argparse
+import json
+import random
+import sys
+import time
+from gi.repository import GLib
+from backend.backendcontroller import BackendControllerSageMath
+from benchmarks.fakekernel import FakeInterface
+
+
+class StressWorksheet(object):
+    ''' the parts of model.Worksheet the sagemath backend controller uses. '''
+
+    def __init__(self, name, cell_count):
+        self.name = name
+        self.observers = set()
+        self.busy_cells = set()
+        self.kernel_state = None
+        self.cells = [self.create_cell() for i in range(cell_count)]
+        self.active_cell = self.cells[0]
+
+    def create_cell(self):
+        return StressCell(self)
+
+    def add_change_code(self, change_code, parameter):
+        for observer in self.observers:
+            observer.change_notification(change_code, self, parameter)
+
+    def register_observer(self, observer):
+        self.observers.add(observer)
+
+    def get_memory_tracking(self):
+        return False
+
+    def get_backend(self):
+        return 'sage'
+
+    def get_active_cell(self):
+        return self.active_cell
+
+    def add_busy_cell(self, cell):
+        self.busy_cells.add(cell)
+
+    def remove_busy_cell(self, cell):
+        self.busy_cells.discard(cell)
+
+    def set_kernel_state(self, state):
+        self.kernel_state = state
+
+    def restart_kernel(self):
+        self.add_change_code('kernel_to_restart', None)
+
+    def stop_evaluation(self):
+        self.add_change_code('ws_evaluation_to_stop', None)
+
+
+class StressCell(object):
+    ''' the parts of model.CodeCell the sagemath backend controller uses. '''
+
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+        self.observers = set()
+        self.state = 'idle'
+        self.text = ''
+        self.result_blob = None
+        self.result_text = None
+        self.result_count = 0
+
+    def add_change_code(self, change_code, parameter):
+        for observer in self.observers:
+            observer.change_notification(change_code, self, parameter)
+
+    def register_observer(self, observer):
+        self.observers.add(observer)
+
+    def get_worksheet(self):
+        return self.worksheet
+
+    def get_worksheet_position(self):
+        return self.worksheet.cells.index(self)
+
+    def is_active_cell(self):
+        return self.worksheet.get_active_cell() == self
+
+    def get_start_iter(self):
+        return None
+
+    def get_end_iter(self):
+        return None
+
+    def get_text(self, start_iter, end_iter, include_hidden_chars):
+        return self.text
+
+    def get_evaluation_mode(self):
+        return 'normal'
+
+    def add_evaluation_timestamps(self, timestamps):
+        pass
+
+    def evaluate(self):
+        self.result_text = None
+        self.stop_evaluation()
+        self.change_state('ready_for_evaluation')
+
+    def stop_evaluation(self):
+        self.change_state('evaluation_to_stop')
+
+    def change_state(self, state):
+        self.state = state
+        self.add_change_code('cell_state_change', self.state)
+        if self.state != 'idle':
+            self.worksheet.add_busy_cell(self)
+        else:
+            self.worksheet.remove_busy_cell(self)
+
+    def set_result_blob(self, result_blob):
+        self.result_blob = result_blob
+
+    def parse_result_blob(self):
+        self.result_text = self.result_blob['text']
+        self.result_count += 1
+
+    def set_queue_position(self, position, estimated_wait=None):
+        pass
+
+
+class StressTest(object):
+
+    def __init__(self, operations, worksheet_count, cell_count, max_duration, seed, timeout):
+        self.random = random.Random(seed)
+        self.operations_left = operations
+        self.operations = operations
+        self.timeout = timeout
+        self.controller = BackendControllerSageMath()
+        self.compute_queue = self.controller.compute_queue
+        self.compute_queue.interface = FakeInterface(max_duration=max_duration)
+        self.worksheets = [StressWorksheet('worksheet' + str(i), cell_count) for i in range(worksheet_count)]
+        self.expected = dict() # cell: set of acceptable result texts, None if evaluation was stopped
+        self.operation_counts = dict()
+        self.version = 0
+        for worksheet in self.worksheets:
+            worksheet.register_observer(self.controller)
+            for cell in worksheet.cells:
+                cell.register_observer(self.controller)
+                self.expected[cell] = {None}
+
+    def run(self):
+        self.main_loop = GLib.MainLoop()
+        self.time_start = time.time()
+        GLib.timeout_add(1, self.operations_loop)
+        self.main_loop.run()
+        return self.get_report()
+
+    def operations_loop(self):
+        for i in range(min(20, self.operations_left)):
+            self.random_operation()
+            self.operations_left -= 1
+        if self.operations_left > 0:
+            return True
+        self.time_operations_done = time.time()
+        GLib.timeout_add(10, self.quiescence_loop)
+        return False
+
+    def random_operation(self):
+        worksheet = self.random.choice(self.worksheets)
+        cell = self.random.choice(worksheet.cells)
+        operation = self.random.choices(['evaluate', 'activate_and_evaluate', 'stop_cell', 'stop_worksheet', 'restart', 'evaluate_all'], [60, 15, 15, 4, 1, 5])[0]
+        self.operation_counts[operation] = self.operation_counts.get(operation, 0) + 1
+
+        if operation == 'activate_and_evaluate':
+            worksheet.active_cell = cell
+            operation = 'evaluate'
+        if operation == 'evaluate':
+            self.evaluate(cell)
+        elif operation == 'stop_cell':
+            cell.stop_evaluation()
+            self.expected[cell] = {cell.result_text}
+        elif operation == 'stop_worksheet':
+            worksheet.stop_evaluation()
+            self.stopped_worksheet(worksheet)
+        elif operation == 'restart':
+            worksheet.restart_kernel()
+            self.stopped_worksheet(worksheet)
+        elif operation == 'evaluate_all':
+            for cell in worksheet.cells:
+                self.evaluate(cell)
+
+    def evaluate(self, cell):
+        self.version += 1
+        cell.text = 'query ' + str(self.version)
+        cell.evaluate()
+        self.expected[cell] = {cell.text}
+
+    def stopped_worksheet(self, worksheet):
+        ''' stopping keeps results that are already shown. a result that
+            was computed but not yet shown when the worksheet was stopped
+            still shows up. '''
+
+        for cell in worksheet.cells:
+            self.expected[cell] = self.expected[cell] | {cell.result_text}
+
+    def is_quiet(self):
+        with self.compute_queue.lock:
+            if len(self.compute_queue.restarting) > 0: return False
+            for query_queue in self.compute_queue.query_queues.values():
+                if not query_queue.empty(): return False
+            for state in self.compute_queue.states.values():
+                if state != 'idle': return False
+            if self.compute_queue.notifications_pending > 0: return False
+        for worksheet in self.worksheets:
+            if len(worksheet.busy_cells) > 0: return False
+        return True
+
+    def quiescence_loop(self):
+        if self.is_quiet() or time.time() - self.time_operations_done > self.timeout:
+            self.time_done = time.time()
+            self.main_loop.quit()
+            return False
+        return True
+
+    def get_report(self):
+        stuck_cells = list()
+        wrong_results = list()
+        result_count = 0
+        for worksheet in self.worksheets:
+            for cell in worksheet.cells:
+                result_count += cell.result_count
+                name = worksheet.name + ':' + str(cell.get_worksheet_position())
+                if cell.state != 'idle':
+                    stuck_cells.append({'cell': name, 'state': cell.state})
+                elif cell.result_text not in self.expected[cell]:
+                    wrong_results.append({'cell': name, 'expected': list(self.expected[cell]), 'result': cell.result_text})
+        seconds = self.time_done - self.time_start
+        return {'operations': self.operations,
+                'operation_counts': self.operation_counts,
+                'worksheets': len(self.worksheets),
+                'evaluations_finished': result_count,
+                'kernel_starts': self.compute_queue.interface.started_count,
+                'seconds_issuing': round(self.time_operations_done - self.time_start, 3),
+                'seconds_total': round(seconds, 3),
+                'operations_per_second': round(self.operations / seconds, 1),
+                'evaluations_per_second': round(result_count / seconds, 1),
+                'stuck_cells': stuck_cells,
+                'wrong_results': wrong_results}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='stress_compute_queue', description='Stress test the GSNB compute queue with a fake kernel.')
+    parser.add_argument('-n', '--operations', type=int, default=5000)
+    parser.add_argument('-w', '--worksheets', type=int, default=4)
+    parser.add_argument('-c', '--cells', type=int, default=20, help='cells per worksheet')
+    parser.add_argument('--max-duration', type=float, default=0.002, help='longest fake evaluation in seconds')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--timeout', type=float, default=60, help='seconds to wait for all cells to settle')
+    arguments = parser.parse_args(argv)
+
+    test = StressTest(arguments.operations, arguments.worksheets, arguments.cells, arguments.max_duration, arguments.seed, arguments.timeout)
+    report = test.run()
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    return 1 if len(report['stuck_cells']) + len(report['wrong_results']) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
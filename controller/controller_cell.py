@@ -20,6 +20,11 @@ gi.require_version('Gtk', '3.0')
 from gi.repository import GLib
 import viewgtk.viewgtk as view
 import model.model as model
+import os.path
+import time
+from model.tracing import get_tracer
+
+tracer = get_tracer()
 
 
 class CellController(object):
@@ -103,6 +108,22 @@ class CodeCellController(CellController):
         CellController.__init__(self, cell, cell_view, worksheet_controller, main_controller)
 
         self.cell.register_observer(self.main_controller.backend_controller_sagemath)
+        self.cell_view.set_resource_usage(self.cell.get_resource_usage())
+        
+        self.cell_view.completion_popover.list.connect('row-activated', self.on_completion_activated)
+        self.completion_prefix = None
+
+    def on_trial_commit_clicked(self, button):
+        self.cell.evaluate()
+
+    def on_trial_discard_clicked(self, button):
+        self.cell.remove_result()
+
+    def on_completion_activated(self, listbox, row):
+        self.cell_view.hide_completions()
+        if self.cell.get_completion_prefix() == self.completion_prefix:
+            self.cell.insert_completion(self.completion_prefix, row.completion)
+        self.cell_view.get_source_view().grab_focus()
 
     def change_notification(self, change_code, notifying_object, parameter):
 
@@ -123,18 +144,30 @@ class CodeCellController(CellController):
                     self.cell_view.set_reveal_child(True)
                     self.cell_view.text_entry.set_editable(True)
                 else:
-                    if isinstance(result, model.SageMathResultImage):
-                        result_view = view.SageMathResultViewImage(self.cell_view)
-                        result_view.load_image_from_filename(result.get_absolute_path())
-                        revealer.set_result_view(result_view)
-                        revealer.show_all()
-                        GLib.idle_add(lambda: revealer.reveal(parameter['show_animation']))
-                    elif isinstance(result, model.SageMathResultText):
-                        result_view = view.SageMathResultViewText(self.cell_view)
-                        result_view.set_text(result.get_as_raw_text())
+                    with tracer.span('create_result_view', 'view'):
+                        if isinstance(result, model.SageMathResultImage):
+                            result_view = view.SageMathResultViewImage(self.cell_view)
+                            result_view.load_image_from_filename(result.get_absolute_path())
+                        elif isinstance(result, model.SageMathResultText):
+                            result_view = view.SageMathResultViewText(self.cell_view)
+                            result_view.set_text(result.get_as_raw_text())
+                        if result.profile != None:
+                            profile_view = view.ResultProfileView()
+                            profile_view.set_profile(result.profile.get_total_time(), result.profile.get_call_count(), result.profile.get_rows(),
+                                                     result.profile.get_call_tree(), result.profile.get_pathname())
+                            previous = result.profile.get_previous()
+                            if previous != None:
+                                profile_view.set_previous_profile(previous.get_total_time(), previous.get_call_count(), previous.get_pathname())
+                            result_view.show_profile(profile_view)
+                        if result.is_trial:
+                            result_view.show_trial_bar()
+                            result_view.trial_commit_button.connect('clicked', self.on_trial_commit_clicked)
+                            result_view.trial_discard_button.connect('clicked', self.on_trial_discard_clicked)
                         revealer.set_result_view(result_view)
                         revealer.show_all()
-                        GLib.idle_add(lambda: revealer.reveal(parameter['show_animation']))
+                    self.cell.add_evaluation_timestamps({'view_built': time.time()})
+                    GLib.idle_add(lambda: revealer.reveal(parameter['show_animation']))
+                    GLib.idle_add(lambda: self.cell.add_evaluation_timestamps({'rendered': time.time()}))
 
                 # enable auto-scrolling for this cell (not enabled on startup)
                 GLib.idle_add(lambda: revealer.set_autoscroll_on_reveal(True))
@@ -151,6 +184,33 @@ class CodeCellController(CellController):
                 elif parameter == 'queued_for_evaluation': cell_view.state_display.show_spinner()
                 elif parameter == 'ready_for_evaluation': cell_view.state_display.show_spinner()
                 elif parameter == 'evaluation_in_progress': cell_view.state_display.show_spinner()
+                if parameter != 'queued_for_evaluation': cell_view.state_display.set_queue_position(None)
+                
+        if change_code == 'resource_usage_changed':
+            self.cell_view.set_resource_usage(parameter)
+            
+        if change_code == 'queue_position_changed':
+            self.cell_view.state_display.set_queue_position(parameter['position'], parameter['estimated_wait'])
+            
+        if change_code == 'completions_changed':
+            prefix = parameter['prefix']
+            completions = parameter['completions']
+            
+            # user kept typing in the meantime
+            if self.cell.get_completion_prefix() != prefix or not self.cell.is_active_cell(): return
+            
+            # complete as far as all completions agree, list them if there is more than one
+            common_prefix = os.path.commonprefix(completions) if len(completions) > 0 else prefix
+            if len(common_prefix) > len(prefix):
+                self.cell.insert_completion(prefix, common_prefix)
+                prefix = common_prefix
+            if len(completions) > 1:
+                self.completion_prefix = prefix
+                self.cell_view.show_completions(completions, parameter['source'])
+
+        if change_code == 'introspection_changed':
+            if self.cell.get_name_at_cursor() != parameter['name'] or not self.cell.is_active_cell(): return
+            self.cell_view.show_introspection(parameter['name'], parameter['introspection'])
             
 
 class MarkdownCellController(CellController):
@@ -186,11 +246,15 @@ class MarkdownCellController(CellController):
                 elif isinstance(result, model.MarkdownResult):
                     self.cell_view.unreveal(parameter['show_animation'])
                     self.cell_view.text_entry.set_editable(False)
-                    result_view = view.MarkdownResultView(self.cell_view)
-                    result_view.set_buildable(result.get_buildable())
-                    result_view.set_replacements(result.get_replacements())
-                    result_view.compile()
-                    revealer.set_result_view(result_view)
+                    if isinstance(revealer.result_view, view.MarkdownResultView):
+                        with tracer.span('update_markdown_view', 'view'):
+                            revealer.result_view.update_blocks(result.get_blocks())
+                    else:
+                        with tracer.span('create_markdown_view', 'view'):
+                            result_view = view.MarkdownResultView(self.cell_view)
+                            result_view.set_blocks(result.get_blocks())
+                            result_view.compile()
+                            revealer.set_result_view(result_view)
                     if parameter['show_animation'] == False:
                         revealer.reveal(parameter['show_animation'])
                     else:
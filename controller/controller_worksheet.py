@@ -21,6 +21,9 @@ from gi.repository import GLib
 import viewgtk.viewgtk as view
 import model.model as model
 import controller.controller_cell as cellcontroller
+from model.tracing import get_tracer
+
+tracer = get_tracer()
 
 
 class WorksheetController(object):
@@ -44,22 +47,29 @@ class WorksheetController(object):
         if change_code == 'kernel_state_changed':
             self.main_controller.update_subtitle(self.worksheet)
             
+        if change_code == 'kernel_statistics_changed':
+            self.main_controller.update_kernel_statistics_dialog(self.worksheet)
+            
+        if change_code == 'memory_diff_changed':
+            self.main_controller.update_memory_dialog(self.worksheet)
+            
         if change_code == 'new_cell':
             cell = parameter
             worksheet_position = cell.get_worksheet_position()
             view_position = worksheet_position * 2
 
             # create cell view and result view revealer
-            if isinstance(cell, model.MarkdownCell):
-                cell_view = view.CellViewMarkdown(cell)
-                result_view_revealer = view.ResultViewRevealer(cell_view)
-                result_view_revealer.get_style_context().add_class('markdown')
-            elif isinstance(cell, model.CodeCell):
-                cell_view = view.CellViewCode(cell)
-                result_view_revealer = view.ResultViewRevealer(cell_view)
-            
-            self.worksheet_view.add_child_at_position(result_view_revealer, view_position)
-            self.worksheet_view.add_child_at_position(cell_view, view_position)
+            with tracer.span('create_cell_view', 'view'):
+                if isinstance(cell, model.MarkdownCell):
+                    cell_view = view.CellViewMarkdown(cell)
+                    result_view_revealer = view.ResultViewRevealer(cell_view)
+                    result_view_revealer.get_style_context().add_class('markdown')
+                elif isinstance(cell, model.CodeCell):
+                    cell_view = view.CellViewCode(cell)
+                    result_view_revealer = view.ResultViewRevealer(cell_view)
+
+                self.worksheet_view.add_child_at_position(result_view_revealer, view_position)
+                self.worksheet_view.add_child_at_position(cell_view, view_position)
 
             if isinstance(cell, model.MarkdownCell):
                 self.main_controller.cell_controllers[cell] = cellcontroller.MarkdownCellController(cell, cell_view, None, self, self.main_controller)
@@ -74,6 +84,7 @@ class WorksheetController(object):
             child_position = parameter * 2
             
             # remove cell and result revealer from view
+            self.worksheet_view.get_child_by_position(child_position + 1).release_result_view()
             self.worksheet_view.remove_child_by_position(child_position)
             self.worksheet_view.remove_child_by_position(child_position)
             
@@ -93,6 +104,9 @@ class WorksheetController(object):
             result_view_revealer = self.worksheet_view.get_child_by_position(child_position + 1)
             result_view_revealer.get_style_context().add_class('active')
             
+            # look up names of the cell so help for them shows up instantly
+            if isinstance(cell, model.CodeCell): cell.prefetch_introspections()
+            
         if change_code == 'new_inactive_cell':
             cell = parameter
             child_position = cell.get_worksheet_position() * 2
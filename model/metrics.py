@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (C) 2017, 2018 Robert Griesel
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>
+
+import functools
+import os
+import threading
+import time
+
+
+class Counter(object):
+    ''' monotonic value per label combination. '''
+
+    metric_type = 'counter'
+
+    def __init__(self, metrics, name, help_text, label_names):
+        self.metrics = metrics
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.values = dict() # label values: value
+
+    def inc(self, *label_values, amount=1):
+        if not self.metrics.enabled: return
+        with self.metrics.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get_samples(self):
+        return [(self.name, dict(zip(self.label_names, label_values)), value) for label_values, value in self.values.items()]
+
+
+class Histogram(Counter):
+    ''' cumulative buckets, sum and count per label combination. '''
+
+    metric_type = 'histogram'
+
+    def __init__(self, metrics, name, help_text, label_names, buckets):
+        Counter.__init__(self, metrics, name, help_text, label_names)
+        self.buckets = sorted(buckets)
+
+    def observe(self, value, *label_values):
+        if not self.metrics.enabled: return
+        with self.metrics.lock:
+            if label_values not in self.values:
+                self.values[label_values] = [[0] * len(self.buckets), 0, 0]
+            entry = self.values[label_values]
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][position] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def get_samples(self):
+        samples = list()
+        for label_values, (bucket_counts, total, count) in self.values.items():
+            labels = dict(zip(self.label_names, label_values))
+            cumulative_count = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative_count += bucket_count
+                samples.append((self.name + '_bucket', dict(labels, le=repr(float(bound))), cumulative_count))
+            samples.append((self.name + '_bucket', dict(labels, le='+Inf'), count))
+            samples.append((self.name + '_sum', labels, total))
+            samples.append((self.name + '_count', labels, count))
+        return samples
+
+
+class Metrics(object):
+    ''' Session metrics in the Prometheus text format. Counters and
+        histograms are updated where things happen, gauges (queue depths,
+        kernel memory, ...) are read from collectors when the metrics are
+        written. Off by default: updates then return right away. While
+        exporting, the metrics are written to a file every few seconds,
+        e.g. for node_exporter's textfile collector. '''
+
+    latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.metrics = list()
+        self.collectors = list()
+        self.pathname = None
+        self.interval = None
+        self.thread = None
+
+    def counter(self, name, help_text, label_names=()):
+        return self.add_metric(Counter(self, name, help_text, label_names))
+
+    def histogram(self, name, help_text, label_names=(), buckets=latency_buckets):
+        return self.add_metric(Histogram(self, name, help_text, label_names, buckets))
+
+    def add_metric(self, metric):
+        ''' metrics are shared by name, e.g. between modules. '''
+
+        with self.lock:
+            for existing_metric in self.metrics:
+                if existing_metric.name == metric.name: return existing_metric
+            self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        ''' collector() is called from the export thread and returns a list
+            of (name, type, help text, samples) with samples a list of
+            (labels, value). '''
+
+        with self.lock:
+            self.collectors.append(collector)
+
+    def start_export(self, pathname, interval=15):
+        ''' rewrite pathname every interval seconds until stop_export(). '''
+
+        if self.enabled: return
+        self.pathname = pathname
+        self.interval = interval
+        self.enabled = True
+        self.thread = threading.Thread(target=self.export, name='metrics export', daemon=True)
+        self.thread.start()
+
+    def stop_export(self):
+        if not self.enabled: return
+        self.enabled = False
+        self.write()
+
+    def is_enabled(self):
+        return self.enabled
+
+    def export(self):
+        ''' export thread. '''
+
+        while self.enabled:
+            self.write()
+            time.sleep(self.interval)
+
+    def write(self):
+        ''' replace the file atomically, scrapers never see half of it. '''
+
+        temporary_pathname = self.pathname + '.tmp'
+        try:
+            with open(temporary_pathname, 'w') as filehandle:
+                filehandle.write(self.render())
+            os.replace(temporary_pathname, self.pathname)
+        except OSError:
+            pass
+
+    def render(self):
+        lines = list()
+        with self.lock:
+            families = [(metric.name, metric.metric_type, metric.help_text, metric.get_samples()) for metric in self.metrics]
+            collectors = list(self.collectors)
+        collected_families = dict() # collectors may share families, e.g. queue depths
+        for collector in collectors:
+            try:
+                for name, metric_type, help_text, samples in collector():
+                    if name not in collected_families:
+                        collected_families[name] = (name, metric_type, help_text, list())
+                        families.append(collected_families[name])
+                    collected_families[name][3].extend((name, labels, value) for labels, value in samples)
+            except Exception:
+                pass
+        for name, metric_type, help_text, samples in families:
+            lines.append('# HELP ' + name + ' ' + help_text)
+            lines.append('# TYPE ' + name + ' ' + metric_type)
+            for sample_name, labels, value in samples:
+                lines.append(sample_name + self.render_labels(labels) + ' ' + repr(float(value)))
+        return '\n'.join(lines) + '\n'
+
+    def render_labels(self, labels):
+        if len(labels) == 0: return ''
+        escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(name + '="' + escape(value) + '"' for name, value in sorted(labels.items())) + '}'
+
+
+metrics = Metrics()
+
+def timed(histogram):
+    ''' decorator, observes the duration of every call in histogram. '''
+
+    def decorator(function):
+        def timed_function(*args, **kwargs):
+            if not metrics.enabled: return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return functools.wraps(function)(timed_function)
+    return decorator
+
+def get_metrics():
+    ''' the metrics of this process. they are exported at launch if the
+        environment variable GSNB_METRICS_FILE names a file to write to,
+        GSNB_METRICS_INTERVAL sets the seconds between writes. '''
+
+    return metrics
+
+if os.environ.get('GSNB_METRICS_FILE', '') != '':
+    import atexit
+    metrics.start_export(os.environ['GSNB_METRICS_FILE'], float(os.environ.get('GSNB_METRICS_INTERVAL', '15')))
+    atexit.register(metrics.stop_export)
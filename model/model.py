@@ -21,11 +21,26 @@ gi.require_version('GtkSource', '3.0')
 from gi.repository import Gtk, GLib
 from gi.repository import GtkSource
 import pickle
+import json
 import time
 import datetime
+import csv
 import os, os.path
+import keyword
+import re
 import shutil
 import tarfile
+import tempfile
+from model.tracing import get_tracer, traced
+from model.profiling import CellProfile
+from model.metrics import get_metrics, timed
+
+tracer = get_tracer()
+metrics = get_metrics()
+change_code_counter = metrics.counter('gsnb_change_codes_total', 'Change notifications sent to observers.', ('source', 'code'))
+load_histogram = metrics.histogram('gsnb_worksheet_load_seconds', 'Time it took to load a worksheet from disk.')
+save_histogram = metrics.histogram('gsnb_worksheet_save_seconds', 'Time it took to save a worksheet to disk.')
+latency_histogram = metrics.histogram('gsnb_evaluation_latency_seconds', 'Time code cell evaluations spent in each stage, see CodeCell.latency_stages.', ('stage',))
 
 
 class Observable(object):
@@ -41,8 +56,10 @@ class Observable(object):
         ''' Observables call this method to notify observers of
             changes in their states. '''
         
-        for observer in self.observers:
-            observer.change_notification(change_code, self, parameter)
+        change_code_counter.inc('model', change_code)
+        with tracer.span(change_code, 'change_code'):
+            for observer in self.observers:
+                observer.change_notification(change_code, self, parameter)
     
     def register_observer(self, observer):
         ''' Observer call this method to register themselves with observable
@@ -90,6 +107,38 @@ class Notebook(Observable):
                 worksheet.populate_meta()
                 self.add_worksheet(worksheet)
         
+    @traced('file_io')
+    def import_gsnb(self, filename):
+        ''' add the worksheets of a .gsnb file (see Worksheet.export_gsnb())
+            to the notebook, returns them. '''
+        
+        worksheets = list()
+        tar = tarfile.open(filename, 'r:bz2')
+        more_to_import = True
+        count = 0
+        while more_to_import:
+            try: tar.getmember(str(count))
+            except KeyError: more_to_import = False
+            else:
+                td_path = tempfile.mkdtemp()
+                tar.extractall(td_path)
+                worksheet = NormalWorksheet(self)
+                worksheet.set_id(self.find_unused_ws_id())
+                pathname = self.get_pathname() + '/' + str(worksheet.get_id())
+                os.rename(td_path + '/' + str(count), pathname)
+                worksheet.set_pathname(pathname)
+                try: meta_filehandle = open(worksheet.pathname + '/worksheet_conf.pickle', 'rb')
+                except IOError: pass
+                else: 
+                    meta = pickle.load(meta_filehandle)
+                    worksheet.set_name(meta['name'])
+                worksheet.save_meta_to_disk()
+                self.add_worksheet(worksheet)
+                worksheets.append(worksheet)
+                count += 1
+        tar.close()
+        return worksheets
+        
     def add_worksheet(self, worksheet):
         self.worksheets[worksheet.get_id()] = worksheet
         self.add_change_code('new_worksheet', worksheet)
@@ -162,10 +211,13 @@ class Worksheet(Observable):
         self.meta = {'name': 'Untitled', 'tags': {}, 'id_number': 0, 'backend': 'sage', 'last_change': ('admin', time.time()), 'last_accessed': datetime.datetime.fromtimestamp(0)}
         self.last_saved = datetime.datetime.fromtimestamp(0)
         self.cells = []
+        self.cell_positions = None # position by cell, see get_cell_positions()
         self.active_cell = None
         self.busy_cells = set()
         self.modified_cells = set()
         self.kernel_state = None
+        self.kernel_statistics = None
+        self.memory_diff = None # (first cell, second cell, diff), see request_memory_diff()
         
         # set source language for syntax highlighting
         self.source_language_manager = GtkSource.LanguageManager()
@@ -194,6 +246,8 @@ class Worksheet(Observable):
         else:
             self.last_saved = datetime.datetime.fromtimestamp(timestamp)
         
+    @traced('file_io')
+    @timed(load_histogram)
     def populate_cells(self):
         ''' Loads data from a sagenb worksheet path. For this has only been
             tested on Debian. This does not implement to whole sagenb file
@@ -268,6 +322,11 @@ class Worksheet(Observable):
                             blockbuffer += line
                             
                 if activate: self.create_cell(position='last', text='', activate=True)
+                
+                # resource usage of the last evaluations, stored by save_to_disk()
+                for cell, usage in zip(self.cells, self.meta.get('cell_usage', [])):
+                    if isinstance(cell, CodeCell) and usage != None:
+                        cell.set_resource_usage(usage)
                 self.set_save_state('saved')
                 
     def remove_all_cells(self):
@@ -299,15 +358,25 @@ class Worksheet(Observable):
         
         if position == 'last': position = len(self.cells)
         self.cells.insert(position, cell)
+        self.cell_positions = None
         self.add_change_code('new_cell', cell)
         self.set_save_state('modified')
         cell.connect('modified-changed', self.on_modified_changed)
     
+    def get_cell_positions(self):
+        ''' position by cell, built once after cells were added, moved or
+            removed. '''
+        
+        if self.cell_positions == None:
+            self.cell_positions = dict((cell, position) for position, cell in enumerate(self.cells))
+        return self.cell_positions
+    
     def move_cell(self, position, new_position):
         ''' Move cell '''
         
         if len(self.cells) > max(position, new_position):
             self.cells[position], self.cells[new_position] = self.cells[new_position], self.cells[position]
+            self.cell_positions = None
             #self.cells[position].get_worksheet_position()
             #self.cells[new_position].get_worksheet_position()
             self.add_change_code('cell_moved', {'position': position, 'new_position': new_position})
@@ -329,6 +398,8 @@ class Worksheet(Observable):
         else:
             self.cells[index].stop_evaluation()
             del(self.cells[index])
+            self.cell_positions = None
+            cell.add_change_code('cell_removed', None)
             self.add_change_code('deleted_cell', cell.get_worksheet_position())
             self.set_save_state('modified')
             if len(self.cells) == 0:
@@ -375,6 +446,7 @@ class Worksheet(Observable):
     def get_cell_count(self):
         return len(self.cells)
         
+    @traced('file_io')
     def save_meta_to_disk(self):
         try: meta_filehandle = open(self.pathname + '/worksheet_conf.pickle', 'wb')
         except IOError: pass
@@ -382,7 +454,10 @@ class Worksheet(Observable):
             pickle.dump(self.meta, meta_filehandle)
             self.last_saved = datetime.datetime.now()
     
+    @traced('file_io')
+    @timed(save_histogram)
     def save_to_disk(self):
+        self.meta['cell_usage'] = [cell.get_resource_usage() if isinstance(cell, CodeCell) else None for cell in self.cells]
         self.save_meta_to_disk()
         try: content_filehandle = open(self.pathname + '/worksheet.html', 'w+')
         except IOError: pass
@@ -410,6 +485,35 @@ class Worksheet(Observable):
     def get_save_state(self):
         return self.save_state
         
+    def get_latency_report(self):
+        ''' one dict per evaluated code cell: 'cell' (position, from 1),
+            'text' (first line) and seconds per stage of
+            CodeCell.latency_stages plus 'total'. '''
+        
+        report = list()
+        for position, cell in enumerate(self.cells):
+            if not isinstance(cell, CodeCell): continue
+            breakdown = cell.get_latency_breakdown()
+            if breakdown == None: continue
+            row = {'cell': position + 1, 'text': cell.get_text(cell.get_start_iter(), cell.get_end_iter(), False).strip().split('\n')[0]}
+            row.update(breakdown)
+            report.append(row)
+        return report
+        
+    def export_latency_csv(self, pathname):
+        fieldnames = ['cell', 'text'] + [stage for stage, start, end in CodeCell.latency_stages] + ['total']
+        with open(pathname, 'w', newline='') as filehandle:
+            writer = csv.DictWriter(filehandle, fieldnames=fieldnames)
+            writer.writeheader()
+            for row in self.get_latency_report():
+                writer.writerow(row)
+        
+    def get_profile_directory(self):
+        ''' where profiles of this worksheet's cells are saved, None if
+            they aren't saved. '''
+        
+        return self.pathname + '/profiles'
+        
     def export_gsnb(self, pathname):
         if not pathname.endswith('.gsnb'): pathname += '.gsnb'
         tar = tarfile.open(pathname, 'w:bz2')
@@ -439,6 +543,9 @@ class Worksheet(Observable):
     def get_name(self):
         return self.meta['name']
         
+    def get_backend(self):
+        return self.meta.get('backend', 'sage')
+        
     def set_id(self, id):
         self.meta['id_number'] = id
         
@@ -463,10 +570,75 @@ class Worksheet(Observable):
         
     def restart_kernel(self):
         self.add_change_code('kernel_to_restart', None)
+        
+    def request_kernel_statistics(self):
+        self.add_change_code('kernel_statistics_requested', None)
+        
+    def set_kernel_statistics(self, statistics):
+        ''' statistics is a dict from the kernel (see KernelProcess.get_statistics())
+            or None if the kernel isn't running. '''
+        
+        self.kernel_statistics = statistics
+        self.add_change_code('kernel_statistics_changed', statistics)
+        
+    def get_kernel_statistics(self):
+        return self.kernel_statistics
+
+    def get_memory_tracking(self):
+        return self.meta.get('track_memory', False)
+
+    def set_memory_tracking(self, track_memory):
+        ''' with memory tracking on, the kernel takes tracemalloc snapshots
+            around every evaluation, see CodeCell.get_memory_report(). it
+            slows evaluations down, so it's off by default. '''
+        
+        if track_memory != self.get_memory_tracking():
+            self.meta['track_memory'] = track_memory
+            self.add_change_code('memory_tracking_changed', track_memory)
+
+    def get_memory_report(self):
+        ''' (position, first line, report, cell) for code cells with a
+            memory report, see CodeCell.get_memory_report(). '''
+        
+        report = list()
+        for position, cell in enumerate(self.cells):
+            if isinstance(cell, CodeCell) and cell.get_memory_report() != None:
+                report.append((position, cell.get_text(cell.get_start_iter(), cell.get_end_iter(), False).strip().split('\n')[0], cell.get_memory_report(), cell))
+        return report
+
+    def request_memory_diff(self, first_cell, second_cell):
+        ''' compare the kernel's memory after the last evaluations of two
+            cells, set_memory_diff() gets the answer. '''
+        
+        self.memory_diff = (first_cell, second_cell, None)
+        first = first_cell.get_memory_report()['snapshot']
+        second = second_cell.get_memory_report()['snapshot']
+        self.add_change_code('memory_diff_requested', {'first': first, 'second': second})
+
+    def set_memory_diff(self, first, second, diff):
+        ''' diff is a dict like memory reports without 'snapshot', None if
+            the kernel no longer has the snapshots. '''
+        
+        if self.memory_diff == None: return
+        first_cell, second_cell, previous_diff = self.memory_diff
+        if first_cell.get_memory_report() == None or first_cell.get_memory_report()['snapshot'] != first: return
+        if second_cell.get_memory_report() == None or second_cell.get_memory_report()['snapshot'] != second: return
+        self.memory_diff = (first_cell, second_cell, diff)
+        self.add_change_code('memory_diff_changed', self.memory_diff)
+
+    def get_memory_diff(self):
+        return self.memory_diff
 
     def stop_evaluation(self):
         self.add_change_code('ws_evaluation_to_stop', None)
         
+    def evaluate_all(self):
+        ''' queue all code cells top to bottom. '''
+        
+        for cell in self.cells:
+            if isinstance(cell, CodeCell):
+                cell.evaluate()
+        
     def add_busy_cell(self, cell):
         self.busy_cells.add(cell)
         self.add_change_code('busy_cell_count_changed', self.get_busy_cell_count())
@@ -503,12 +675,26 @@ class NormalWorksheet(Worksheet):
         self.meta['name'] = name
         self.add_change_code('worksheet_name_changed', name)
         
+    def set_backend(self, backend):
+        ''' switch kernel, takes effect with the next kernel start. '''
+        
+        if backend != self.get_backend():
+            self.meta['backend'] = backend
+            self.add_change_code('worksheet_backend_changed', backend)
+            self.restart_kernel()
+        
 
 class DocumentationWorksheet(Worksheet):
 
     def __init__(self, notebook):
         Worksheet.__init__(self, notebook)
 
+    def get_profile_directory(self):
+        ''' documentation lives in the installed resources, profiles of it
+            aren't saved. '''
+        
+        return None
+
 
 class Cell(GtkSource.Buffer, Observable):
 
@@ -559,7 +745,7 @@ class Cell(GtkSource.Buffer, Observable):
     
     def get_result_string(self):
         result = self.get_result()
-        if result != None:
+        if result != None and not result.is_trial:
             if isinstance(result, SageMathResultText):
                 result_string = result.get_as_raw_text()
                 return '\n' + result_string if result_string != '' else ''
@@ -576,12 +762,9 @@ class Cell(GtkSource.Buffer, Observable):
         return self.worksheet
 
     def get_worksheet_position(self):
-        cells = self.get_worksheet().cells
-        try: position = cells.index(self)
-        except ValueError: return self.worksheet_position
-        else: 
-            self.worksheet_position = position
-            return position
+        positions = self.get_worksheet().get_cell_positions()
+        if self in positions: self.worksheet_position = positions[self]
+        return self.worksheet_position
         
     def is_active_cell(self):
         return True if self.get_worksheet().get_active_cell() == self else False
@@ -599,6 +782,11 @@ class CodeCell(Cell):
         # possible states: idle, ready_for_evaluation, queued_for_evaluation
         # evaluation_in_progress, evaluation_to_stop
         self.state = 'idle'
+        self.queue_position = None
+        self.evaluation_mode = 'normal' # 'trial' runs in a throwaway fork of the kernel, 'profile' under cProfile
+        self.resource_usage = None # of the last evaluation, see set_resource_usage()
+        self.evaluation_timestamps = dict() # of the last evaluation, see get_latency_breakdown()
+        self.memory_report = None # of the last evaluation with memory tracking on
         
         # syntax highlighting
         self.set_language(self.get_worksheet().get_source_language_code())
@@ -607,9 +795,113 @@ class CodeCell(Cell):
     def evaluate(self):
         self.remove_result()
         self.stop_evaluation()
+        self.evaluation_mode = 'normal'
+        self.evaluation_timestamps = {'requested': time.time()}
         self.change_state('ready_for_evaluation')
 
+    def try_evaluate(self):
+        ''' evaluate in a copy of the kernel, leaving the kernel's state
+            untouched. the result is marked as trial result and not saved,
+            evaluate() commits the cell. '''
+        
+        self.remove_result()
+        self.stop_evaluation()
+        self.evaluation_mode = 'trial'
+        self.evaluation_timestamps = {'requested': time.time()}
+        self.change_state('ready_for_evaluation')
+
+    def evaluate_with_profiler(self):
+        ''' evaluate under cProfile, the result gets the profile attached.
+            profiles are saved to the worksheet's profiles directory, if it
+            has one. '''
+        
+        self.remove_result()
+        self.stop_evaluation()
+        self.evaluation_mode = 'profile'
+        self.evaluation_timestamps = {'requested': time.time()}
+        self.change_state('ready_for_evaluation')
+
+    def get_evaluation_mode(self):
+        return self.evaluation_mode
+
+    def set_resource_usage(self, usage):
+        ''' usage is a dict with 'wall', 'user' and 'sys' time in seconds
+            and 'max_rss_delta' in bytes (growth of the kernel's peak memory)
+            or None. '''
+        
+        if self.resource_usage != usage:
+            self.resource_usage = usage
+            self.add_change_code('resource_usage_changed', usage)
+
+    def get_resource_usage(self):
+        return self.resource_usage
+
+    def set_memory_report(self, report):
+        ''' report is a dict with 'net' (bytes the evaluation left
+            allocated), 'traced' (bytes allocated in the kernel after it),
+            'top' (list of [filename, line, size difference, count
+            difference, size] of the allocation sites that changed most)
+            and 'snapshot' (for Worksheet.request_memory_diff()) or None. '''
+        
+        if self.memory_report != report:
+            self.memory_report = report
+            self.add_change_code('memory_report_changed', report)
+
+    def get_memory_report(self):
+        return self.memory_report
+
+    # (stage, start timestamp, end timestamp), for the stages of an
+    # evaluation from pressing evaluate to the result showing up
+    latency_stages = [('submit', 'requested', 'queued'),
+                      ('queue_wait', 'queued', 'started'),
+                      ('kernel_setup', 'started', 'sent'),
+                      ('execution', 'sent', 'received'),
+                      ('transfer', 'received', 'finished'),
+                      ('gui_dispatch', 'finished', 'dispatched'),
+                      ('parse', 'dispatched', 'parsed'),
+                      ('view', 'parsed', 'view_built'),
+                      ('render', 'view_built', 'rendered')]
+
+    def add_evaluation_timestamps(self, timestamps):
+        ''' with 'rendered' the evaluation is complete, its latencies go
+            into the metrics. '''
+        
+        self.evaluation_timestamps.update(timestamps)
+        if 'rendered' in timestamps: self.add_latency_metrics()
+
+    def add_latency_metrics(self):
+        if not metrics.is_enabled(): return
+        breakdown = self.get_latency_breakdown()
+        if breakdown == None: return
+        for stage, seconds in breakdown.items():
+            if seconds != None: latency_histogram.observe(seconds, stage)
+
+    def get_latency_breakdown(self):
+        ''' seconds spent in each of latency_stages during the last
+            evaluation, None for stages that didn't happen (e.g. no result
+            view for empty output). execution is the time the kernel took
+            to run the cell, pexpect round trips in between count as
+            transfer. None if the cell wasn't evaluated. '''
+        
+        timestamps = self.evaluation_timestamps
+        if 'parsed' not in timestamps: return None
+        breakdown = dict()
+        for stage, start, end in self.latency_stages:
+            if start in timestamps and end in timestamps:
+                breakdown[stage] = timestamps[end] - timestamps[start]
+            else:
+                breakdown[stage] = None
+        if self.resource_usage != None and breakdown['execution'] != None:
+            execution = min(self.resource_usage['wall'], breakdown['execution'])
+            breakdown['transfer'] = (breakdown['transfer'] or 0) + breakdown['execution'] - execution
+            breakdown['execution'] = execution
+        last_timestamp = max(timestamps.values())
+        breakdown['total'] = last_timestamp - timestamps['requested'] if 'requested' in timestamps else None
+        return breakdown
+
     def parse_result_blob(self):
+        self.set_resource_usage(self.result_blob.get('usage', None))
+        if 'memory' in self.result_blob: self.set_memory_report(self.result_blob['memory'])
     
         # look for image files (plots), create image result object if there are any
         files = self.result_blob['files']
@@ -621,15 +913,127 @@ class CodeCell(Cell):
                 tmp_filename = 'sage' + str(count) + '.png'
             tmp_filename = 'sage' + str(count-1) + '.png'
             result = SageMathResultImage(self.result_blob['path'], tmp_filename, self.get_worksheet())
-            self.set_result(result)
         
         # make text result object if no plot image was found
         elif self.result_blob['text'] != '':
             result = SageMathResultText(self.result_blob['text'])
+        else:
+            result = None
+        
+        # profiles are shown even if the cell had no output
+        profile = None
+        if self.result_blob.get('profile', None) != None:
+            profile = CellProfile(self.result_blob['profile'])
+            directory = self.get_worksheet().get_profile_directory()
+            if directory != None:
+                prefix = 'cell' + str(self.get_worksheet_position() + 1) + '-'
+                profile.previous = CellProfile.load_last(directory, prefix)
+                try: profile.save(directory, prefix + time.strftime('%Y%m%d-%H%M%S'), self.result_blob.get('profile_pathname', None))
+                except (IOError, OSError): pass
+            if result == None: result = SageMathResultText('')
+        
+        self.add_evaluation_timestamps({'parsed': time.time()})
+        if result != None:
+            result.is_trial = self.result_blob.get('trial', False)
+            result.profile = profile
             self.set_result(result)
+        else:
+            self.add_latency_metrics()
+
+    # dotted name left of the cursor, e.g. 'matrix', 'M.eigen' or 'M.'
+    completion_prefix_regex = re.compile(r'(?:[A-Za-z_]\w*\.)*(?:[A-Za-z_]\w*)?$')
+
+    def get_completion_prefix(self):
+        ''' name left of the cursor, '' if there is none. '''
+        
+        cursor_iter = self.get_iter_at_mark(self.get_insert())
+        line_start_iter = cursor_iter.copy()
+        line_start_iter.set_line_offset(0)
+        text = self.get_text(line_start_iter, cursor_iter, False)
+        match = self.completion_prefix_regex.search(text)
+        return match.group(0) if match != None else ''
+        
+    def request_completions(self):
+        ''' ask the kernel for completions of the name left of the cursor,
+            False if there is nothing to complete. '''
+        
+        if self.get_has_selection(): return False
+        prefix = self.get_completion_prefix()
+        if prefix == '': return False
+        self.add_change_code('completions_requested', prefix)
+        return True
+        
+    def set_completions(self, prefix, completions, source):
+        ''' source is 'kernel' or 'static' (kernel busy or not running). '''
+        
+        self.add_change_code('completions_changed', {'prefix': prefix, 'completions': completions, 'source': source})
+        
+    def insert_completion(self, prefix, completion):
+        if completion.startswith(prefix):
+            self.insert_at_cursor(completion[len(prefix):])
+
+    # dotted names in the cell, not preceded by a digit or attribute access
+    name_regex = re.compile(r'(?<![\w.])(?:[A-Za-z_]\w*\.)*[A-Za-z_]\w*')
+    call_regex = re.compile(r'((?:[A-Za-z_]\w*\.)*[A-Za-z_]\w*)\([^()]*$')
+
+    def get_name_at_cursor(self):
+        ''' dotted name under the cursor, or the function called in the
+            enclosing parenthesis. '' if there is none. '''
+        
+        cursor_iter = self.get_iter_at_mark(self.get_insert())
+        line_start_iter = cursor_iter.copy()
+        line_start_iter.set_line_offset(0)
+        line_end_iter = cursor_iter.copy()
+        if not line_end_iter.ends_line(): line_end_iter.forward_to_line_end()
+        text_before = self.get_text(line_start_iter, cursor_iter, False)
+        text_after = self.get_text(cursor_iter, line_end_iter, False)
+        name = self.completion_prefix_regex.search(text_before).group(0) + re.match(r'\w*', text_after).group(0)
+        if name.rstrip('.') == '':
+            match = self.call_regex.search(text_before)
+            return match.group(1) if match != None else ''
+        return name.rstrip('.')
+    
+    def get_visible_names(self, limit=50):
+        ''' names appearing in the cell, in order, without keywords. '''
+        
+        names = list()
+        for name in self.name_regex.findall(self.get_text(self.get_start_iter(), self.get_end_iter(), False)):
+            if name not in names and not keyword.iskeyword(name):
+                names.append(name)
+                if len(names) >= limit: break
+        return names
+        
+    def request_introspection(self):
+        ''' ask the kernel for signature and docs of the name at the cursor,
+            False if there is none. '''
+        
+        name = self.get_name_at_cursor()
+        if name == '': return False
+        self.add_change_code('introspection_requested', name)
+        return True
+        
+    def prefetch_introspections(self):
+        ''' let the backend look up all names of the cell ahead of time. '''
+        
+        self.add_change_code('introspection_prefetch_requested', self.get_visible_names())
+        
+    def set_introspection(self, name, introspection):
+        ''' introspection is a dict with 'signature', 'docstring', 'file',
+            'line' and 'type' or None if name is unknown to the kernel. '''
+        
+        self.add_change_code('introspection_changed', {'name': name, 'introspection': introspection})
+
+    def set_queue_position(self, position, estimated_wait=None):
+        ''' position in the worksheet's compute queue while queued, estimated_wait in seconds. '''
+        
+        if self.queue_position != (position, estimated_wait):
+            self.queue_position = (position, estimated_wait)
+            self.add_change_code('queue_position_changed', {'position': position, 'estimated_wait': estimated_wait})
 
     def change_state(self, state):
         self.state = state
+        if self.state != 'queued_for_evaluation':
+            self.queue_position = None
         self.add_change_code('cell_state_change', self.state)
         
         # promote info to associated worksheet
@@ -675,44 +1079,47 @@ class MarkdownCell(Cell):
 class Result():
 
     def __init__(self):
-        pass
+        self.is_trial = False # computed in a fork of the kernel, not saved
+        self.profile = None # CellProfile of the evaluation, if it was profiled
 
 
 class MarkdownResult(Result):
+    ''' [style class, pango markup] for each paragraph and header, see
+        backendmarkdown.MarkdownQuery. saved as json, worksheets saved by
+        older versions have the gtkbuilder xml the view was built from. '''
 
     def __init__(self, result_blob):
         Result.__init__(self)
-        self.buildable = ''
-        self.replacements = list()
-        result_blob = result_blob.split('SPLITMARKER')
-
-        for part in result_blob:
-            if part.startswith('<interface>'):
-                self.buildable += part
-            elif part.startswith('<child>'):
-                self.buildable += part + 'PLACEHOLDER'
-            elif part.endswith('</child>'):
-                self.buildable += part
-            elif part.endswith('</interface>'):
-                self.buildable += part
-            elif len(part.strip()) > 0:
-                self.replacements.append(part)
-                
-    def get_buildable(self):
-        return self.buildable
+        if isinstance(result_blob, str):
+            result_blob = self.parse_result_string(result_blob)
+        self.blocks = result_blob
+        
+    def parse_result_string(self, result_string):
+        if result_string.startswith('<interface>'):
+            return self.parse_buildable(result_string)
+        try:
+            blocks = json.loads(result_string)
+        except ValueError:
+            return list()
+        return [block for block in blocks if isinstance(block, list) and len(block) == 2]
+    
+    def parse_buildable(self, buildable):
+        ''' labels are separated by SPLITMARKER, their markup is the part
+            before the end of their <child> element. '''
+        
+        blocks = list()
+        parts = buildable.split('SPLITMARKER')
+        for position, part in enumerate(parts):
+            if position > 0 and part.endswith('</child>'):
+                style_class = re.search('<class name="([^"]*)"/>', part)
+                blocks.append([style_class.group(1) if style_class != None else 'p', parts[position - 1]])
+        return blocks
     
-    def get_replacements(self):
-        return self.replacements
+    def get_blocks(self):
+        return self.blocks
         
     def get_as_raw_text(self):
-        buildable = self.buildable
-        replacements = self.replacements
-        buildable = buildable.replace('<child>', 'SPLITMARKER<child>', 1)
-        buildable = buildable.replace('</child>', '</child>SPLITMARKER')
-        
-        for value in replacements:
-            buildable = buildable.replace('PLACEHOLDER', 'SPLITMARKER' + value + 'SPLITMARKER', 1)
-        return buildable
+        return json.dumps(self.blocks, ensure_ascii=False)
 
 
 class SageMathResultText(Result):
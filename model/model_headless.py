@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (C) 2017, 2018 Robert Griesel
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>
+
+import pickle
+import os, os.path
+import shutil
+
+
+class HeadlessWorksheet(object):
+    ''' Gtk-free counterpart of model.Worksheet. Reads and writes the
+        same worksheet.html / worksheet_conf.pickle files, but holds cells
+        as plain text so worksheets can be evaluated without a display. '''
+
+    def __init__(self, pathname):
+        self.pathname = pathname
+        self.meta = {'name': os.path.basename(os.path.normpath(pathname)), 'backend': 'sage'}
+        self.cells = []
+
+    def populate_meta(self):
+        ''' load metadata from worksheet path. '''
+
+        try: meta_filehandle = open(self.pathname + '/worksheet_conf.pickle', 'rb')
+        except IOError: pass
+        else:
+            try: self.meta = pickle.load(meta_filehandle)
+            except EOFError: pass
+            meta_filehandle.close()
+
+    def populate_cells(self):
+        self.populate_cells_from_pathname(self.pathname)
+
+    def populate_cells_from_pathname(self, pathname):
+        ''' Loads cells from a sagenb worksheet path, same format as
+            model.Worksheet.populate_cells_from_pathname. '''
+
+        try:
+            html_filehandle = open(pathname + '/worksheet.html')
+        except IOError:
+            return
+
+        mode = 'html'
+        blockbuffer = ''
+        for line in html_filehandle:
+            if mode == 'html':
+                if line.startswith('{{{'):
+                    blockbuffer = ''
+                    mode = 'codecell'
+                elif line.startswith('MD{{{'):
+                    blockbuffer = ''
+                    mode = 'markdowncell'
+            elif line.startswith('}}}'):
+                data = blockbuffer.split('\n///')
+                cell_type = 'code' if mode == 'codecell' else 'markdown'
+                self.cells.append(HeadlessCell(self, cell_type, data[0], data[1].strip()))
+                blockbuffer = ''
+                mode = 'html'
+            else:
+                blockbuffer += line
+        html_filehandle.close()
+
+    def save_to_disk(self):
+        try: content_filehandle = open(self.pathname + '/worksheet.html', 'w+')
+        except IOError: return False
+        else:
+            for key, cell in enumerate(self.cells):
+                markdown_prefix = 'MD' if cell.get_type() == 'markdown' else ''
+                content_filehandle.write(markdown_prefix + '{{{id=' + str(key) + '|\n' + cell.get_text() + '\n///' + cell.get_result_string() + '\n}}}\n')
+            content_filehandle.close()
+            return True
+
+    def get_code_cells(self):
+        return [cell for cell in self.cells if cell.get_type() == 'code']
+
+    def get_pathname(self):
+        return self.pathname
+
+    def get_name(self):
+        return self.meta.get('name', '')
+
+    def get_backend(self):
+        return self.meta.get('backend', 'sage')
+
+    def find_unused_filename(self):
+        count = 0
+        while os.path.isfile(self.pathname + '/result' + str(count) + '.png'):
+            count += 1
+        return 'result' + str(count) + '.png'
+
+
+class HeadlessCell(object):
+    ''' A worksheet cell as text and raw result string
+        (the part after "///" in worksheet.html). '''
+
+    def __init__(self, worksheet, cell_type, text, result_string=''):
+        self.worksheet = worksheet
+        self.cell_type = cell_type
+        self.text = text
+        self.result_string = result_string
+
+    def get_type(self):
+        return self.cell_type
+
+    def get_text(self):
+        return self.text
+
+    def get_result_string(self):
+        return '\n' + self.result_string if self.result_string != '' else ''
+
+    def remove_result(self):
+        ''' remove result including it's image asset. '''
+
+        if self.result_string.startswith('<image>'):
+            filename = self.result_string[7:].split('<')[0]
+            try: os.remove(self.worksheet.get_pathname() + '/' + filename)
+            except FileNotFoundError: pass
+        self.result_string = ''
+
+    def set_result_from_blob(self, result_blob):
+        ''' same rules as CodeCell.parse_result_blob: last plot image wins,
+            text otherwise. '''
+
+        self.remove_result()
+        if result_blob == None: return
+        files = result_blob['files']
+        if 'sage0.png' in files:
+            count = 0
+            while ('sage' + str(count) + '.png') in files:
+                count += 1
+            tmp_filename = 'sage' + str(count-1) + '.png'
+            filename = self.worksheet.find_unused_filename()
+            shutil.copyfile(result_blob['path'] + tmp_filename, self.worksheet.get_pathname() + '/' + filename)
+            shutil.rmtree(result_blob['path'])
+            self.result_string = '<image>' + filename + '</image>'
+        elif result_blob['text'] != '':
+            self.result_string = result_blob['text'].rstrip()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (C) 2017, 2018 Robert Griesel
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>
+
+import json
+import os
+import shutil
+import time
+
+
+class CellProfile(object):
+    ''' cProfile statistics of one evaluation, as sent by the kernel (see
+        KernelProcess.read_profile()). '''
+
+    def __init__(self, data):
+        self.functions = data['functions']
+        self.calls = data['calls']
+        self.roots = sorted(data['roots'], key=lambda root: root[1], reverse=True)
+        self.pathname = None # of the saved profile, see save()
+        self.previous = None # profile of the cell's run before, see load_last()
+
+        self.callees = dict()
+        for caller, callee, cumulative_time in self.calls:
+            if caller == callee: continue
+            self.callees.setdefault(caller, list()).append((callee, cumulative_time))
+        for callees in self.callees.values():
+            callees.sort(key=lambda callee: callee[1], reverse=True)
+        self.total_time = sum(root_time for position, root_time in self.roots)
+
+    def get_total_time(self):
+        return self.total_time
+
+    def get_call_count(self):
+        return sum(row[4] for row in self.functions)
+
+    def get_function_label(self, position):
+        filename, line, name = self.functions[position][:3]
+        if filename == '~': return name
+        if filename == '<cell>': return name + ' (cell, line ' + str(line) + ')'
+        return name + ' (' + os.path.basename(filename) + ':' + str(line) + ')'
+
+    def get_rows(self):
+        ''' one dict per function: 'function', 'location', 'calls' (as
+            text, 'total/primitive' for recursive functions), 'call_count',
+            'own' and 'cumulative' time in seconds. '''
+
+        rows = list()
+        for filename, line, name, primitive_calls, total_calls, own_time, cumulative_time in self.functions:
+            location = '' if filename == '~' else ('cell' if filename == '<cell>' else filename) + ':' + str(line)
+            calls = str(total_calls) if total_calls == primitive_calls else str(total_calls) + '/' + str(primitive_calls)
+            rows.append({'function': name, 'location': location, 'calls': calls, 'call_count': total_calls,
+                         'own': own_time, 'cumulative': cumulative_time})
+        return rows
+
+    def get_call_tree(self, min_fraction=0.005, max_depth=24):
+        ''' flame graph of the profile: nodes are dicts with 'label', 'time'
+            and 'children'. cProfile only knows caller -> callee totals, so
+            a function's time is split between its callers as cProfile
+            reports it, not by actual call path, as in gprof. branches
+            below min_fraction of the total are left out. '''
+
+        min_time = self.total_time * min_fraction
+
+        def get_node(position, time_spent, path, depth):
+            node = {'label': self.get_function_label(position), 'time': time_spent, 'children': list()}
+            if depth >= max_depth: return node
+            cumulative_time = self.functions[position][6]
+            scale = time_spent / cumulative_time if cumulative_time > 0 else 0
+            for callee, callee_time in self.callees.get(position, []):
+                callee_time = callee_time * scale
+                if callee_time < min_time or callee in path: continue
+                node['children'].append(get_node(callee, callee_time, path | {callee}, depth + 1))
+            return node
+
+        return [get_node(position, root_time, {position}, 1) for position, root_time in self.roots if root_time >= min_time]
+
+    def save(self, directory, basename, stats_pathname=None):
+        ''' write the profile to directory/basename.json, copy the kernel's
+            raw stats file (for pstats or snakeviz) to basename.prof. '''
+
+        if not os.path.isdir(directory): os.makedirs(directory)
+        self.pathname = os.path.join(directory, basename + '.json')
+        with open(self.pathname, 'w') as filehandle:
+            json.dump({'functions': self.functions, 'calls': self.calls, 'roots': self.roots, 'saved': time.time()}, filehandle)
+        if stats_pathname != None and os.path.isfile(stats_pathname):
+            shutil.copyfile(stats_pathname, os.path.join(directory, basename + '.prof'))
+
+    def get_pathname(self):
+        return self.pathname
+
+    def get_previous(self):
+        return self.previous
+
+    @classmethod
+    def load(cls, pathname):
+        with open(pathname, 'r') as filehandle:
+            profile = cls(json.load(filehandle))
+        profile.pathname = pathname
+        return profile
+
+    @classmethod
+    def load_last(cls, directory, prefix):
+        ''' the profile saved last in directory with a basename starting
+            with prefix, None if there is none or it can't be read.
+            basenames end with the time they were saved, see save(). '''
+
+        try:
+            filenames = [filename for filename in os.listdir(directory) if filename.startswith(prefix) and filename.endswith('.json')]
+        except OSError:
+            return None
+        if len(filenames) == 0: return None
+        try:
+            return cls.load(os.path.join(directory, max(filenames)))
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (C) 2017, 2018 Robert Griesel
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>
+
+import gi
+from gi.repository import GLib
+import os
+import sys
+import threading
+import time
+import traceback
+from model.tracing import get_tracer
+from model.metrics import get_metrics
+
+tracer = get_tracer()
+
+
+class StallDetector(object):
+    ''' Watches the gtk main loop for stalls. A heartbeat callback in the
+        main loop stamps the time every interval seconds, a watchdog thread
+        checks the stamp. If the heartbeat is late by more than threshold
+        seconds the watchdog samples the main thread's python stack until
+        the loop runs again. Every stall is charged to the innermost GSNB
+        frame of its samples, so the report points at our code rather than
+        at gtk. '''
+
+    source_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    def __init__(self, threshold=0.1, interval=0.02):
+        self.threshold = threshold
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+        self.heartbeat_source = None
+        self.main_thread_id = None
+        self.last_heartbeat = time.perf_counter()
+        self.reset()
+
+    def start(self):
+        ''' call in the gtk thread. '''
+
+        if self.running: return
+        self.running = True
+        self.main_thread_id = threading.get_ident()
+        self.last_heartbeat = time.perf_counter()
+        self.heartbeat_source = GLib.timeout_add(int(self.interval * 1000), self.heartbeat)
+        self.thread = threading.Thread(target=self.watch, name='stall detector', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        ''' call in the gtk thread. '''
+
+        if not self.running: return
+        self.running = False
+        GLib.source_remove(self.heartbeat_source)
+        self.heartbeat_source = None
+        self.thread.join()
+        self.thread = None
+
+    def is_running(self):
+        return self.running
+
+    def reset(self):
+        with self.lock:
+            self.stall_count = 0
+            self.stall_seconds = 0
+            self.longest_stall = 0
+            self.call_sites = dict()
+
+    def heartbeat(self):
+        self.last_heartbeat = time.perf_counter()
+        return True
+
+    def watch(self):
+        ''' watchdog, runs in its own thread. '''
+
+        stall_start = None
+        samples = list()
+        while self.running:
+            time.sleep(self.interval / 2)
+            last_heartbeat = self.last_heartbeat
+            now = time.perf_counter()
+            if now - last_heartbeat - self.interval > self.threshold:
+                if stall_start == None:
+                    stall_start = last_heartbeat + self.interval
+                    samples = list()
+                stack = self.sample_main_thread()
+                if stack != None: samples.append(stack)
+            elif stall_start != None:
+                self.add_stall(stall_start, last_heartbeat - stall_start, samples)
+                stall_start = None
+
+    def sample_main_thread(self):
+        frame = sys._current_frames().get(self.main_thread_id)
+        if frame == None: return None
+        return [(frame_summary.filename, frame_summary.lineno, frame_summary.name) for frame_summary in traceback.extract_stack(frame)]
+
+    def get_call_site(self, stack):
+        ''' innermost frame in GSNB's sources, innermost frame if there is none. '''
+
+        for filename, lineno, name in reversed(stack):
+            if filename.startswith(self.source_directory) and filename != __file__:
+                return (os.path.relpath(filename, self.source_directory), lineno, name)
+        filename, lineno, name = stack[-1]
+        return (filename, lineno, name)
+
+    def add_stall(self, start, duration, samples):
+        ''' samples split the stall's duration evenly between their call sites. '''
+
+        if len(samples) == 0: return
+        with self.lock:
+            self.stall_count += 1
+            self.stall_seconds += duration
+            self.longest_stall = max(self.longest_stall, duration)
+            charged_sites = set()
+            for stack in samples:
+                call_site = self.get_call_site(stack)
+                if call_site not in self.call_sites:
+                    self.call_sites[call_site] = {'stalls': 0, 'seconds': 0, 'longest': 0, 'stack': stack}
+                site = self.call_sites[call_site]
+                site['seconds'] += duration / len(samples)
+                if call_site not in charged_sites:
+                    charged_sites.add(call_site)
+                    site['stalls'] += 1
+                    if duration > site['longest']:
+                        site['longest'] = duration
+                        site['stack'] = stack
+        if tracer.is_enabled():
+            tracer.add_event({'ph': 'X', 'name': 'main loop stall', 'cat': 'stall', 'ts': tracer.get_microseconds(start),
+                              'dur': duration * 1000000, 'pid': tracer.pid, 'tid': self.main_thread_id,
+                              'args': {'call_site': '{}:{} {}'.format(*self.get_call_site(samples[0]))}})
+
+    def get_statistics(self):
+        with self.lock:
+            return {'stalls': self.stall_count, 'seconds': self.stall_seconds, 'longest': self.longest_stall}
+
+    def get_metric_samples(self):
+        ''' for Metrics.add_collector(). '''
+        
+        statistics = self.get_statistics()
+        return [('gsnb_main_loop_stalls_total', 'counter', 'Times the gtk main loop was blocked longer than the stall threshold.', [({}, statistics['stalls'])]),
+                ('gsnb_main_loop_stall_seconds_total', 'counter', 'Time the gtk main loop spent in stalls.', [({}, statistics['seconds'])]),
+                ('gsnb_main_loop_stall_detector_running', 'gauge', '1 while the stall detector watches the main loop.', [({}, 1 if self.running else 0)])]
+
+    def get_report(self, max_entries=50):
+        ''' call sites, the one that stalled the main loop longest in total first. '''
+
+        with self.lock:
+            report = list()
+            for (filename, lineno, name), site in self.call_sites.items():
+                report.append({'filename': filename, 'lineno': lineno, 'function': name, 'stalls': site['stalls'],
+                               'seconds': site['seconds'], 'longest': site['longest'], 'stack': list(site['stack'])})
+        report.sort(key=lambda entry: entry['seconds'], reverse=True)
+        return report[:max_entries]
+
+
+stall_detector = StallDetector()
+get_metrics().add_collector(stall_detector.get_metric_samples)
+
+def get_stall_detector():
+    ''' the stall detector of this process. it's started at launch if the
+        environment variable GSNB_DETECT_STALLS is set. '''
+
+    return stall_detector
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (C) 2017, 2018 Robert Griesel
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>
+
+import asyncio
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+
+
+class NoSpan(object):
+    ''' what span() returns while tracing is off, does nothing. '''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class Span(object):
+    ''' complete event ('X'), for code that runs without interruption in one thread. '''
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter()
+        event = {'ph': 'X', 'name': self.name, 'cat': self.category, 'ts': self.tracer.get_microseconds(self.start),
+                 'dur': (end - self.start) * 1000000, 'pid': self.tracer.pid, 'tid': threading.get_ident()}
+        if self.args != None: event['args'] = self.args
+        self.tracer.add_event(event)
+        return False
+
+
+class AsyncSpan(Span):
+    ''' begin/end pair ('b'/'e') for coroutines, which interleave in the
+        backend thread and so can't be nested like complete events. '''
+
+    def __enter__(self):
+        self.id = next(self.tracer.async_ids)
+        self.add_async_event('b', self.args)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.add_async_event('e', None)
+        return False
+
+    def add_async_event(self, phase, args):
+        event = {'ph': phase, 'name': self.name, 'cat': self.category, 'id': self.id,
+                 'ts': self.tracer.get_microseconds(time.perf_counter()), 'pid': self.tracer.pid, 'tid': threading.get_ident()}
+        if args != None: event['args'] = args
+        self.tracer.add_event(event)
+
+
+class Tracer(object):
+    ''' Records spans as Chrome trace events, the JSON loads in Perfetto
+        (ui.perfetto.dev) and chrome://tracing. Off by default: span() then
+        costs one attribute lookup and returns a shared no-op object.
+        Spans may be recorded from any thread. '''
+
+    no_span = NoSpan()
+
+    def __init__(self):
+        self.enabled = False
+        self.events = list()
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.async_ids = itertools.count()
+        self.time_origin = time.perf_counter()
+        self.pathname = None
+
+    def start(self, pathname):
+        ''' record until stop(), which writes the trace to pathname. '''
+
+        with self.lock:
+            self.events = list()
+            self.pathname = pathname
+            self.time_origin = time.perf_counter()
+            self.enabled = True
+
+    def stop(self):
+        ''' write the trace, returns its pathname (None if not tracing). '''
+
+        with self.lock:
+            if not self.enabled: return None
+            self.enabled = False
+            events, self.events = self.events, list()
+        thread_names = [{'ph': 'M', 'name': 'thread_name', 'pid': self.pid, 'tid': thread.ident, 'args': {'name': thread.name}} for thread in threading.enumerate()]
+        process_name = {'ph': 'M', 'name': 'process_name', 'pid': self.pid, 'args': {'name': 'GSNB'}}
+        with open(self.pathname, 'w') as filehandle:
+            json.dump({'traceEvents': [process_name] + thread_names + events, 'displayTimeUnit': 'ms'}, filehandle)
+        return self.pathname
+
+    def is_enabled(self):
+        return self.enabled
+
+    def span(self, name, category, args=None):
+        if not self.enabled: return self.no_span
+        return Span(self, name, category, args)
+
+    def async_span(self, name, category, args=None):
+        if not self.enabled: return self.no_span
+        return AsyncSpan(self, name, category, args)
+
+    def instant(self, name, category, args=None):
+        if not self.enabled: return
+        event = {'ph': 'i', 's': 't', 'name': name, 'cat': category, 'ts': self.get_microseconds(time.perf_counter()), 'pid': self.pid, 'tid': threading.get_ident()}
+        if args != None: event['args'] = args
+        self.add_event(event)
+
+    def add_event(self, event):
+        with self.lock:
+            if self.enabled: self.events.append(event)
+
+    def get_microseconds(self, timestamp):
+        return (timestamp - self.time_origin) * 1000000
+
+
+tracer = Tracer()
+
+def traced(category):
+    ''' decorator, records a span named like the function for every call.
+        coroutine functions get async spans. '''
+
+    def decorator(function):
+        name = function.__qualname__
+        if asyncio.iscoroutinefunction(function):
+            async def traced_coroutine(*args, **kwargs):
+                if not tracer.enabled: return await function(*args, **kwargs)
+                with AsyncSpan(tracer, name, category, None):
+                    return await function(*args, **kwargs)
+            return functools.wraps(function)(traced_coroutine)
+        else:
+            def traced_function(*args, **kwargs):
+                if not tracer.enabled: return function(*args, **kwargs)
+                with Span(tracer, name, category, None):
+                    return function(*args, **kwargs)
+            return functools.wraps(function)(traced_function)
+    return decorator
+
+def get_tracer():
+    ''' the tracer of this process. tracing starts at launch if the
+        environment variable GSNB_TRACE names a file to write to. '''
+
+    return tracer
+
+if os.environ.get('GSNB_TRACE', '') != '':
+    import atexit
+    tracer.start(os.environ['GSNB_TRACE'])
+    atexit.register(tracer.stop)
@@ -23,7 +23,9 @@ from gi.repository import GtkSource
 from gi.repository import Gdk
 from gi.repository import GLib, GObject
 from gi.repository import Gio
+import collections
 import os
+import time
 
 import viewgtk.viewgtk_dialogs as dialogs
 from viewgtk.viewgtk_headerbars import *
@@ -219,6 +221,14 @@ class CellViewStateDisplay(Gtk.DrawingArea):
         if self.state != 'nothing':
             self.state = 'nothing'
 
+    def set_queue_position(self, position, estimated_wait=None):
+        if position == None:
+            self.set_tooltip_text(None)
+        elif estimated_wait == None:
+            self.set_tooltip_text('Queued, position ' + str(position) + '.')
+        else:
+            self.set_tooltip_text('Queued, position ' + str(position) + ', about ' + str(int(round(estimated_wait))) + ' s to go.')
+
 
 class CellViewCodeLineNumbersRenderer(GtkSource.GutterRendererText):
 
@@ -348,7 +358,164 @@ class CellViewCode(CellView):
         self.set_hexpand(False)
         self.set_can_focus(True)
 
+        self.completion_popover = CellViewCompletionPopover(self.text_entry)
+        self.introspection_popover = CellViewIntrospectionPopover(self.text_entry)
+
+        # time the last evaluation took, details in the tooltip
+        self.usage_label = Gtk.Label()
+        self.usage_label.set_valign(Gtk.Align.START)
+        self.usage_label.set_margin_top(15)
+        self.usage_label.set_margin_end(9)
+        self.usage_label.get_style_context().add_class('dim-label')
+        self.usage_label.set_no_show_all(True)
+        self.box.pack_end(self.usage_label, False, False, 0)
+
         self.show_all()
+        
+    def set_resource_usage(self, usage):
+        if usage == None:
+            self.usage_label.hide()
+        else:
+            self.usage_label.set_text(dialogs.format_seconds(usage['wall']))
+            self.usage_label.set_tooltip_text(format_resource_usage(usage))
+            self.usage_label.show()
+        
+    def show_completions(self, completions, source):
+        ''' list completions in a popover at the cursor. '''
+        
+        self.completion_popover.set_completions(completions, source)
+        self.completion_popover.set_pointing_to(self.get_cursor_rectangle())
+        self.completion_popover.popup()
+        self.completion_popover.focus_first_row()
+        
+    def hide_completions(self):
+        self.completion_popover.popdown()
+        
+    def is_showing_completions(self):
+        return self.completion_popover.get_visible()
+        
+    def show_introspection(self, name, introspection):
+        ''' signature and docstring of name in a popover at the cursor. '''
+        
+        self.introspection_popover.set_introspection(name, introspection)
+        self.introspection_popover.set_pointing_to(self.get_cursor_rectangle())
+        self.introspection_popover.popup()
+
+    def get_cursor_rectangle(self):
+        cell = self.get_cell()
+        location = self.text_entry.get_iter_location(cell.get_iter_at_mark(cell.get_insert()))
+        x, y = self.text_entry.buffer_to_window_coords(Gtk.TextWindowType.WIDGET, location.x, location.y)
+        rectangle = Gdk.Rectangle()
+        rectangle.x, rectangle.y, rectangle.width, rectangle.height = x, y, 1, location.height
+        return rectangle
+
+
+def format_resource_usage(usage):
+    return 'Wall time ' + dialogs.format_seconds(usage['wall']) + ', CPU ' + dialogs.format_seconds(usage['user']) + ' user, ' + dialogs.format_seconds(usage['sys']) + ' system, peak memory +' + dialogs.format_size(max(usage['max_rss_delta'], 0))
+
+
+class CellViewCompletionPopover(Gtk.Popover):
+    ''' completion list for code cells, rows carry the completion in row.completion. '''
+
+    def __init__(self, relative_to):
+        Gtk.Popover.__init__(self)
+        self.set_relative_to(relative_to)
+        self.set_position(Gtk.PositionType.BOTTOM)
+
+        self.box = Gtk.VBox()
+        self.scrolled_window = Gtk.ScrolledWindow()
+        self.scrolled_window.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.AUTOMATIC)
+        self.scrolled_window.set_propagate_natural_height(True)
+        self.scrolled_window.set_max_content_height(240)
+        self.list = Gtk.ListBox()
+        self.list.set_selection_mode(Gtk.SelectionMode.BROWSE)
+        self.list.set_activate_on_single_click(True)
+        self.scrolled_window.add(self.list)
+        self.box.pack_start(self.scrolled_window, True, True, 0)
+        self.source_label = Gtk.Label()
+        self.source_label.set_xalign(0)
+        self.source_label.get_style_context().add_class('dim-label')
+        self.box.pack_start(self.source_label, False, False, 3)
+        self.add(self.box)
+
+    def set_completions(self, completions, source):
+        for row in self.list.get_children():
+            self.list.remove(row)
+        for completion in completions:
+            label = Gtk.Label(completion)
+            label.set_xalign(0)
+            row = Gtk.ListBoxRow()
+            row.completion = completion
+            row.add(label)
+            self.list.add(row)
+        if source == 'static':
+            self.source_label.set_text(' Kernel busy, showing known names only.')
+            self.source_label.set_no_show_all(False)
+        else:
+            self.source_label.set_no_show_all(True)
+            self.source_label.hide()
+        self.box.show_all()
+
+    def focus_first_row(self):
+        first_row = self.list.get_row_at_index(0)
+        if first_row != None:
+            self.list.select_row(first_row)
+            first_row.grab_focus()
+
+
+class CellViewIntrospectionPopover(Gtk.Popover):
+    ''' signature, source location and docstring of a name in a code cell. '''
+
+    def __init__(self, relative_to):
+        Gtk.Popover.__init__(self)
+        self.set_relative_to(relative_to)
+        self.set_position(Gtk.PositionType.BOTTOM)
+        self.set_modal(False)
+
+        self.box = Gtk.VBox()
+        self.signature_label = Gtk.Label()
+        self.signature_label.set_xalign(0)
+        self.signature_label.set_line_wrap(True)
+        self.signature_label.set_selectable(True)
+        self.box.pack_start(self.signature_label, False, False, 3)
+        self.location_label = Gtk.Label()
+        self.location_label.set_xalign(0)
+        self.location_label.set_selectable(True)
+        self.location_label.get_style_context().add_class('dim-label')
+        self.box.pack_start(self.location_label, False, False, 3)
+        self.scrolled_window = Gtk.ScrolledWindow()
+        self.scrolled_window.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.AUTOMATIC)
+        self.scrolled_window.set_propagate_natural_height(True)
+        self.scrolled_window.set_max_content_height(300)
+        self.docstring_label = Gtk.Label()
+        self.docstring_label.set_xalign(0)
+        self.docstring_label.set_yalign(0)
+        self.docstring_label.set_line_wrap(True)
+        self.docstring_label.set_max_width_chars(80)
+        self.docstring_label.set_selectable(True)
+        self.scrolled_window.add(self.docstring_label)
+        self.box.pack_start(self.scrolled_window, True, True, 3)
+        self.box.set_border_width(6)
+        self.add(self.box)
+
+    def set_introspection(self, name, introspection):
+        escaped_name = GLib.markup_escape_text(name)
+        if introspection == None:
+            self.signature_label.set_markup('<tt>' + escaped_name + '</tt>: no help available.')
+            self.location_label.set_text('')
+            self.docstring_label.set_text('')
+        else:
+            signature = introspection['signature'] if introspection['signature'] != None else ''
+            self.signature_label.set_markup('<tt><b>' + escaped_name + '</b>' + GLib.markup_escape_text(signature) + '</tt>  ' + GLib.markup_escape_text(introspection['type']))
+            if introspection['file'] != None and introspection['line'] != None:
+                self.location_label.set_text(introspection['file'] + ':' + str(introspection['line']))
+            else:
+                self.location_label.set_text(introspection['file'] if introspection['file'] != None else '')
+            self.docstring_label.set_text(introspection['docstring'] if introspection['docstring'] != None else '')
+        self.box.show_all()
+        for label in [self.location_label, self.docstring_label]:
+            if label.get_text() == '': label.hide()
+        if self.docstring_label.get_text() == '': self.scrolled_window.hide()
 
 
 class CellViewMarkdown(CellView):
@@ -476,9 +643,14 @@ class ResultViewRevealer(Gtk.EventBox):
     def set_result_view(self, result_view):
         if self.result_view != None:
             self.box.remove(self.result_view)
+            self.result_view.release()
         
         self.result_view = result_view
         self.box.pack_start(self.result_view, True, True, 0)
+        
+    def release_result_view(self):
+        if self.result_view != None:
+            self.result_view.release()
     
     def reveal(self, show_animation=True, duration=250):
         self.revealer.set_transition_duration(duration)
@@ -509,6 +681,83 @@ class ResultView(Gtk.HBox):
         Gtk.HBox.__init__(self)
         
         self.cell_view = cell_view
+        
+    def release(self):
+        ''' called when the view is replaced or its cell is deleted. '''
+        
+        pass
+
+
+class MarkdownRenderer(object):
+    ''' Fills markdown result views with their labels in idle callbacks,
+        at most budget seconds per main loop iteration, so worksheets with
+        long markdown cells open without blocking the ui. Views are filled
+        in the order they were compiled. Labels of released views are kept
+        for reuse. '''
+
+    def __init__(self, budget=0.008, pool_size=500):
+        self.budget = budget
+        self.pool_size = pool_size
+        self.views = collections.deque()
+        self.label_pool = list()
+        self.idle_source = None
+        
+    def add_view(self, view):
+        self.views.append(view)
+        if self.idle_source == None:
+            self.idle_source = GLib.idle_add(self.render)
+
+    def render(self, budget=None):
+        ''' idle callback, renders everything that is pending if budget is 0. '''
+    
+        deadline = time.perf_counter() + (self.budget if budget == None else budget)
+        while len(self.views) > 0:
+            view = self.views[0]
+            while view.has_pending_blocks():
+                view.add_next_label()
+                if budget != 0 and time.perf_counter() > deadline: return True
+            self.views.popleft()
+        self.idle_source = None
+        return False
+        
+    def flush(self):
+        if self.idle_source != None:
+            GLib.source_remove(self.idle_source)
+            self.render(0)
+        
+    def get_label(self, style_class, markup):
+        if len(self.label_pool) > 0:
+            label = self.label_pool.pop()
+        else:
+            label = Gtk.Label()
+            label.set_can_focus(False)
+            label.set_track_visited_links(False)
+            label.set_line_wrap(True)
+            label.set_line_wrap_mode(2) # Pango.WrapMode.WORD_CHAR
+            label.set_xalign(0)
+            label.set_single_line_mode(False)
+        self.set_label_block(label, style_class, markup)
+        return label
+        
+    def set_label_block(self, label, style_class, markup):
+        label.set_markup('<span rise="0">' + markup + '</span>')
+        if getattr(label, 'style_class', None) != style_class:
+            if getattr(label, 'style_class', None) != None:
+                label.get_style_context().remove_class(label.style_class)
+            label.get_style_context().add_class(style_class)
+            label.style_class = style_class
+    
+    def release_label(self, label):
+        ''' label has to be removed from its parent before. '''
+        
+        if len(self.label_pool) < self.pool_size:
+            self.label_pool.append(label)
+        
+
+markdown_renderer = MarkdownRenderer()
+
+def get_markdown_renderer():
+    return markdown_renderer
 
 
 class MarkdownResultView(ResultView):
@@ -533,40 +782,92 @@ class MarkdownResultView(ResultView):
 
         self.set_hexpand(True)
         
-        self.buildable = ''
-        self.replacements = list()
+        self.blocks = list()
+        self.labels = list()
+        self.renderer = get_markdown_renderer()
 
-    def set_buildable(self, buildable):
-        self.buildable = buildable
-        
-    def set_replacements(self, replacements):
-        self.replacements = replacements
+    def set_blocks(self, blocks):
+        self.blocks = blocks
         
     def allocation_hack(self, content, allocation):
         self.contentwrap.set_size_request(-1, allocation.height)
 
     def compile(self):
-        self.builder = Gtk.Builder()
-        self.builder.add_from_string(self.buildable)
-        self.content = self.builder.get_object('buildablewrap')
+        ''' labels are added later by the markdown renderer. '''
+    
+        self.content = Gtk.VBox()
         self.content.connect('size-allocate', self.allocation_hack)
         
         self.centerbox = Gtk.VBox()
         self.centerbox.pack_start(self.top_padding, False, False, 0)
-        self.labels = list()
-
-        for key, value in enumerate(self.replacements):
-            label = self.builder.get_object('label-' + str(key))
-            label.set_markup('<span rise="0">' + (value) + '</span>')
-            label.set_single_line_mode(False)
-            self.labels.append(label)
-            
         self.centerbox.pack_end(self.bottom_padding, False, False, 0)
         self.contentwrap = Gtk.VBox()
         self.contentwrap.pack_start(self.content, False, False, 0)
         self.centerbox.set_center_widget(self.contentwrap)
         self.pack_start(self.centerbox, True, True, 0)
         self.show_all()
+        self.renderer.add_view(self)
+        
+    def has_pending_blocks(self):
+        return len(self.labels) < len(self.blocks)
+        
+    def add_next_label(self):
+        style_class, markup = self.blocks[len(self.labels)]
+        label = self.renderer.get_label(style_class, markup)
+        is_paragraph = (style_class == 'p')
+        self.content.pack_start(label, is_paragraph, is_paragraph, 0)
+        label.show()
+        self.labels.append(label)
+        
+    def update_blocks(self, blocks):
+        ''' show blocks of a new evaluation: the labels of blocks that
+            stayed the same at the start and end are kept, the labels in
+            between are changed in place, added or removed. '''
+        
+        if self.has_pending_blocks(): # still queued in the renderer
+            self.release()
+            self.blocks = blocks
+            return
+        
+        old_blocks = self.blocks
+        common_length = min(len(old_blocks), len(blocks))
+        start = 0
+        while start < common_length and old_blocks[start] == blocks[start]:
+            start += 1
+        end = 0
+        while end < common_length - start and old_blocks[len(old_blocks) - end - 1] == blocks[len(blocks) - end - 1]:
+            end += 1
+        
+        labels = self.labels[start:len(old_blocks) - end]
+        changed_blocks = blocks[start:len(blocks) - end]
+        for label in labels[len(changed_blocks):]:
+            self.content.remove(label)
+            self.renderer.release_label(label)
+        new_labels = list()
+        for position, (style_class, markup) in enumerate(changed_blocks):
+            is_paragraph = (style_class == 'p')
+            if position < len(labels):
+                label = labels[position]
+                self.renderer.set_label_block(label, style_class, markup)
+                self.content.child_set_property(label, 'expand', is_paragraph)
+                self.content.child_set_property(label, 'fill', is_paragraph)
+            else:
+                label = self.renderer.get_label(style_class, markup)
+                self.content.pack_start(label, is_paragraph, is_paragraph, 0)
+                self.content.reorder_child(label, start + position)
+                label.show()
+            new_labels.append(label)
+        self.labels = self.labels[:start] + new_labels + self.labels[len(old_blocks) - end:]
+        self.blocks = blocks
+        
+    def release(self):
+        ''' give labels back to the renderer, the view is not shown anymore. '''
+        
+        for label in self.labels:
+            self.content.remove(label)
+            self.renderer.release_label(label)
+        self.labels = list()
+        self.blocks = list()
 
 
 class SageMathResultView(ResultView):
@@ -594,6 +895,31 @@ class SageMathResultView(ResultView):
         self.set_center_widget(self.centerbox)
         self.set_hexpand(True)
         
+        # shown for results of trial evaluations
+        self.trial_bar = Gtk.HBox()
+        self.trial_label = Gtk.Label('Trial run in a copy of the kernel, the kernel is unchanged.')
+        self.trial_label.set_xalign(0)
+        self.trial_label.get_style_context().add_class('dim-label')
+        self.trial_bar.pack_start(self.trial_label, True, True, 0)
+        self.trial_commit_button = Gtk.Button.new_with_label('Commit')
+        self.trial_commit_button.set_tooltip_text('Evaluate the cell in the kernel')
+        self.trial_commit_button.set_can_focus(False)
+        self.trial_bar.pack_end(self.trial_commit_button, False, False, 0)
+        self.trial_discard_button = Gtk.Button.new_with_label('Discard')
+        self.trial_discard_button.set_can_focus(False)
+        self.trial_bar.pack_end(self.trial_discard_button, False, False, 6)
+
+    def show_trial_bar(self):
+        self.centerbox.pack_start(self.trial_bar, False, False, 6)
+        self.centerbox.reorder_child(self.trial_bar, 1)
+        self.trial_bar.show_all()
+
+    def show_profile(self, profile_view):
+        ''' profile_view goes below the output. '''
+        
+        self.centerbox.pack_start(profile_view, False, False, 6)
+        profile_view.show_all()
+        
 
 class SageMathResultViewText(SageMathResultView):
 
@@ -649,6 +975,144 @@ class SageMathResultViewImage(SageMathResultView):
         self.show_all()
         
 
+class ProfileFlameGraph(Gtk.DrawingArea):
+    ''' icicle style flame graph: callers on top, callees below them, the
+        width of a box is the time spent in the function. '''
+
+    row_height = 18
+
+    def __init__(self):
+        Gtk.DrawingArea.__init__(self)
+        self.call_tree = list()
+        self.total_time = 0
+        self.boxes = list() # (x, y, width, node), for tooltips
+        self.set_has_tooltip(True)
+        self.connect('draw', self.draw)
+        self.connect('query-tooltip', self.on_query_tooltip)
+
+    def set_call_tree(self, call_tree, total_time):
+        ''' call_tree as returned by CellProfile.get_call_tree(). '''
+        
+        self.call_tree = call_tree
+        self.total_time = total_time
+        
+        def get_depth(nodes):
+            return max([1 + get_depth(node['children']) for node in nodes] + [0])
+        self.set_size_request(-1, get_depth(call_tree) * self.row_height)
+        self.queue_draw()
+
+    def get_color(self, label):
+        ''' warm colors, stable per function. '''
+        
+        value = sum(ord(char) for char in label) % 100 / 100
+        return (0.9 + 0.1 * value, 0.45 + 0.35 * value, 0.2 + 0.1 * value)
+
+    def draw(self, widget, cr, data = None):
+        width = self.get_allocated_width()
+        self.boxes = list()
+        if self.total_time <= 0: return False
+        cr.set_font_size(11)
+        
+        def draw_nodes(nodes, x, y):
+            for node in nodes:
+                box_width = node['time'] / self.total_time * width
+                if box_width >= 1:
+                    cr.set_source_rgb(*self.get_color(node['label']))
+                    cr.rectangle(x, y, box_width - 1, self.row_height - 1)
+                    cr.fill()
+                    if box_width > 30:
+                        cr.save()
+                        cr.rectangle(x, y, box_width - 4, self.row_height)
+                        cr.clip()
+                        cr.set_source_rgb(0.1, 0.1, 0.1)
+                        cr.move_to(x + 3, y + self.row_height - 5)
+                        cr.show_text(node['label'])
+                        cr.restore()
+                    self.boxes.append((x, y, box_width, node))
+                    draw_nodes(node['children'], x, y + self.row_height)
+                x += box_width
+
+        draw_nodes(self.call_tree, 0, 0)
+        return False
+
+    def on_query_tooltip(self, widget, x, y, keyboard_mode, tooltip):
+        for box_x, box_y, box_width, node in self.boxes:
+            if box_x <= x < box_x + box_width and box_y <= y < box_y + self.row_height:
+                share = node['time'] / self.total_time * 100
+                tooltip.set_text(node['label'] + '\n' + '{:.1f} ms, {:.1f} %'.format(node['time'] * 1000, share))
+                return True
+        return False
+
+
+class ResultProfileView(Gtk.VBox):
+    ''' profile of an evaluation: summary, flame graph and a sortable table
+        of all functions. '''
+
+    def __init__(self):
+        Gtk.VBox.__init__(self)
+        self.set_spacing(6)
+        self.total_time = 0
+        
+        self.summary_label = Gtk.Label()
+        self.summary_label.set_xalign(0)
+        self.summary_label.set_line_wrap(True)
+        self.summary_label.set_selectable(True)
+        self.summary_label.set_can_focus(False)
+        self.summary_label.get_style_context().add_class('dim-label')
+        self.pack_start(self.summary_label, False, False, 0)
+
+        self.flame_graph = ProfileFlameGraph()
+        self.pack_start(self.flame_graph, False, False, 0)
+
+        # function, location, calls as text, calls, own time, cumulative time
+        self.list_store = Gtk.ListStore(str, str, str, GObject.TYPE_INT64, float, float)
+        self.list_store.set_sort_column_id(5, Gtk.SortType.DESCENDING)
+        self.tree_view = Gtk.TreeView(model=self.list_store)
+        self.tree_view.set_can_focus(False)
+        columns = [('Function', 0, 0), ('Location', 1, 1), ('Calls', 2, 3), ('Own time', 4, 4), ('Cumulative', 5, 5)]
+        for title, column_number, sort_column_number in columns:
+            renderer = Gtk.CellRendererText()
+            column = Gtk.TreeViewColumn(title, renderer, text=column_number)
+            if column_number >= 4:
+                column.set_cell_data_func(renderer, self.format_time, column_number)
+            if column_number >= 2:
+                renderer.set_property('xalign', 1)
+            else:
+                renderer.set_property('ellipsize', 1 if column_number == 1 else 3) # Pango.EllipsizeMode.START / END
+                column.set_expand(True)
+            column.set_sort_column_id(sort_column_number)
+            column.set_resizable(True)
+            self.tree_view.append_column(column)
+        scrolled_window = Gtk.ScrolledWindow()
+        scrolled_window.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.AUTOMATIC)
+        scrolled_window.set_size_request(-1, 220)
+        scrolled_window.add(self.tree_view)
+        self.pack_start(scrolled_window, False, False, 0)
+
+    def format_time(self, column, renderer, model, tree_iter, column_number):
+        renderer.set_property('text', '{:.2f} ms'.format(model[tree_iter][column_number] * 1000))
+
+    def set_profile(self, total_time, call_count, rows, call_tree, pathname):
+        ''' rows and call_tree as returned by CellProfile.get_rows() and
+            CellProfile.get_call_tree(). '''
+        
+        summary = 'Profile: ' + dialogs.format_seconds(total_time) + ', ' + str(call_count) + ' function calls.'
+        if pathname != None: summary += ' Saved to ' + pathname + '.'
+        self.summary_label.set_text(summary)
+        self.total_time = total_time
+        self.flame_graph.set_call_tree(call_tree, total_time)
+        self.list_store.clear()
+        for row in rows:
+            self.list_store.append([row['function'], row['location'], row['calls'], row['call_count'], row['own'], row['cumulative']])
+
+    def set_previous_profile(self, total_time, call_count, pathname):
+        ''' the run before, see CellProfile.load_last(), call after set_profile(). '''
+        
+        summary = self.summary_label.get_text() + '\nRun before: ' + dialogs.format_seconds(total_time) + ', ' + str(call_count) + ' function calls'
+        if total_time > 0: summary += ' ({:+.0f} %)'.format((self.total_time - total_time) / total_time * 100)
+        self.summary_label.set_text(summary + ', ' + pathname + '.')
+
+
 class MainWindow(Gtk.ApplicationWindow):
 
     def __init__(self, app):
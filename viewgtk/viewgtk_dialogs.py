@@ -17,7 +17,7 @@
 
 import gi
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk
+from gi.repository import Gtk, GObject, GLib
 
 
 class ImportWorksheet(Gtk.FileChooserDialog):
@@ -176,3 +176,447 @@ class CloseConfirmation(Gtk.MessageDialog):
         self.set_default_response(Gtk.ResponseType.YES)
         
 
+
+
+class KernelStatistics(Gtk.Dialog):
+    ''' Shows statistics of a worksheet's kernel, e.g. hits of the code cache. '''
+
+    def __init__(self, main_window, worksheet):
+        Gtk.Dialog.__init__(self, 'Kernel Statistics', main_window, 0)
+        self.worksheet = worksheet
+        self.set_default_size(360, -1)
+        self.refresh_button = self.add_button('_Refresh', Gtk.ResponseType.APPLY)
+        self.add_button('_Close', Gtk.ResponseType.CLOSE)
+
+        self.grid = Gtk.Grid()
+        self.grid.set_row_spacing(6)
+        self.grid.set_column_spacing(18)
+        self.grid.set_border_width(18)
+        self.get_content_area().pack_start(self.grid, True, True, 0)
+        self.set_message('Waiting for kernel ...')
+
+    def set_message(self, message):
+        for child in self.grid.get_children():
+            self.grid.remove(child)
+        label = Gtk.Label(message)
+        label.set_xalign(0)
+        self.grid.attach(label, 0, 0, 2, 1)
+        self.grid.show_all()
+
+    def set_statistics(self, statistics):
+        if statistics == None:
+            self.set_message('The kernel of »' + self.worksheet.get_name() + '« is not running.')
+            return
+
+        for child in self.grid.get_children():
+            self.grid.remove(child)
+        rows = list()
+        code_cache = statistics.get('code_cache', None)
+        if code_cache != None:
+            lookups = code_cache['hits'] + code_cache['misses']
+            hit_rate = str(round(100 * code_cache['hits'] / lookups)) + ' %' if lookups > 0 else '–'
+            rows.append(('<b>Compiled cell cache</b>', ''))
+            rows.append(('Hits', str(code_cache['hits']) + ' (' + hit_rate + ')'))
+            rows.append(('Misses', str(code_cache['misses'])))
+            rows.append(('Entries', str(code_cache['entries']) + ' of ' + str(code_cache['max_entries'])))
+            rows.append(('Evictions', str(code_cache['evictions'])))
+            rows.append(('Time spent preparsing', '{:.3f} s'.format(code_cache['compile_seconds'])))
+        introspection = statistics.get('introspection', None)
+        if introspection != None:
+            lookups = introspection['hits'] + introspection['misses']
+            hit_rate = str(round(100 * introspection['hits'] / lookups)) + ' %' if lookups > 0 else '–'
+            rows.append(('<b>Introspection cache</b>', ''))
+            rows.append(('Hits', str(introspection['hits']) + ' (' + hit_rate + ')'))
+            rows.append(('Misses', str(introspection['misses'])))
+            rows.append(('Entries', str(introspection['entries']) + ' of ' + str(introspection['max_entries'])))
+        for row_number, row in enumerate(rows):
+            for column_number, text in enumerate(row):
+                label = Gtk.Label()
+                label.set_markup(text)
+                label.set_xalign(0)
+                self.grid.attach(label, column_number, row_number, 1, 1)
+        self.grid.show_all()
+
+
+class SharedObjects(Gtk.Dialog):
+    ''' Lists objects kernels published with shared_store.publish(name, obj). '''
+
+    def __init__(self, main_window):
+        Gtk.Dialog.__init__(self, 'Shared Objects', main_window, 0)
+        self.set_default_size(480, 320)
+        self.remove_button = self.add_button('_Remove', Gtk.ResponseType.REJECT)
+        self.add_button('_Refresh', Gtk.ResponseType.APPLY)
+        self.add_button('_Close', Gtk.ResponseType.CLOSE)
+
+        # name, description, size as text, size in bytes (for sorting)
+        self.list_store = Gtk.ListStore(str, str, str, GObject.TYPE_INT64)
+        self.tree_view = Gtk.TreeView(model=self.list_store)
+        for column_number, title in enumerate(['Name', 'Type', 'Size']):
+            renderer = Gtk.CellRendererText()
+            column = Gtk.TreeViewColumn(title, renderer, text=column_number)
+            column.set_sort_column_id(column_number if column_number < 2 else 3)
+            column.set_resizable(True)
+            self.tree_view.append_column(column)
+        self.tree_view.get_selection().connect('changed', self.on_selection_changed)
+        scrolled_window = Gtk.ScrolledWindow()
+        scrolled_window.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.AUTOMATIC)
+        scrolled_window.add(self.tree_view)
+        self.get_content_area().pack_start(scrolled_window, True, True, 0)
+
+        self.summary_label = Gtk.Label()
+        self.summary_label.set_xalign(0)
+        self.summary_label.set_line_wrap(True)
+        self.summary_label.set_margin_top(6)
+        self.summary_label.set_margin_start(6)
+        self.summary_label.get_style_context().add_class('dim-label')
+        self.get_content_area().pack_start(self.summary_label, False, False, 0)
+        self.remove_button.set_sensitive(False)
+
+    def set_objects(self, objects):
+        self.list_store.clear()
+        for description in objects:
+            if description['kind'] == 'ndarray':
+                kind = 'array ' + ' × '.join(str(length) for length in description['shape']) + ', ' + description['dtype']
+            else:
+                kind = 'buffer'
+            self.list_store.append([description['name'], kind, format_size(description['nbytes']), description['nbytes']])
+        if len(objects) == 0:
+            self.summary_label.set_text('Nothing published. In a cell, shared_store.publish(\'name\', array) shares a numpy array or buffer with all worksheets, shared_store[\'name\'] maps it without copying.')
+        else:
+            self.summary_label.set_text(str(len(objects)) + ' objects, ' + format_size(sum(description['nbytes'] for description in objects)) + ' in total.')
+
+    def get_selected_name(self):
+        model, tree_iter = self.tree_view.get_selection().get_selected()
+        return model[tree_iter][0] if tree_iter != None else None
+
+    def on_selection_changed(self, selection):
+        self.remove_button.set_sensitive(self.get_selected_name() != None)
+
+
+def format_size(nbytes):
+    for unit in ['bytes', 'KB', 'MB', 'GB']:
+        if nbytes < 1024 or unit == 'GB':
+            return str(nbytes) + ' ' + unit if unit == 'bytes' else '{:.1f} {}'.format(nbytes, unit)
+        nbytes /= 1024
+
+
+def format_size_change(nbytes):
+    return ('+' if nbytes >= 0 else '−') + format_size(abs(nbytes))
+
+
+class MemoryByCell(Gtk.Dialog):
+    ''' Memory each code cell left allocated in the kernel, with the
+        allocation sites behind it. Two selected cells can be compared.
+        Cell rows carry the cell in column 4. '''
+
+    def __init__(self, main_window, worksheet):
+        Gtk.Dialog.__init__(self, 'Memory by Cell', main_window, 0)
+        self.worksheet = worksheet
+        self.set_default_size(640, 520)
+        self.compare_button = self.add_button('C_ompare', Gtk.ResponseType.ACCEPT)
+        self.add_button('_Refresh', Gtk.ResponseType.APPLY)
+        self.add_button('_Close', Gtk.ResponseType.CLOSE)
+        self.compare_button.set_sensitive(False)
+        self.compare_button.set_tooltip_text('Select two cells to see what changed between their evaluations')
+
+        # position, first line, net retained, traced after evaluation, cell
+        self.cell_store = Gtk.ListStore(int, str, GObject.TYPE_INT64, GObject.TYPE_INT64, object)
+        self.cell_view = Gtk.TreeView(model=self.cell_store)
+        self.cell_view.get_selection().set_mode(Gtk.SelectionMode.MULTIPLE)
+        self.cell_view.get_selection().connect('changed', self.on_selection_changed)
+        self.add_columns(self.cell_view, [('#', 0, None), ('Cell', 1, None), ('Retained', 2, format_size_change), ('Traced', 3, format_size)], 1)
+        self.pack_scrolled(self.cell_view)
+
+        self.sites_label = Gtk.Label()
+        self.sites_label.set_xalign(0)
+        self.sites_label.set_line_wrap(True)
+        self.sites_label.set_margin_top(12)
+        self.sites_label.set_margin_bottom(6)
+        self.get_content_area().pack_start(self.sites_label, False, False, 0)
+
+        # location, size change, count change, size
+        self.site_store = Gtk.ListStore(str, GObject.TYPE_INT64, GObject.TYPE_INT64, GObject.TYPE_INT64)
+        self.site_view = Gtk.TreeView(model=self.site_store)
+        self.add_columns(self.site_view, [('Allocated at', 0, None), ('Change', 1, format_size_change), ('Blocks', 2, str), ('Size', 3, format_size)], 0)
+        self.pack_scrolled(self.site_view)
+        self.show_sites(None, None)
+
+    def add_columns(self, tree_view, columns, expanding_column):
+        for title, column_number, formatter in columns:
+            renderer = Gtk.CellRendererText()
+            column = Gtk.TreeViewColumn(title, renderer, text=column_number)
+            if formatter != None:
+                column.set_cell_data_func(renderer, self.format_cell, (column_number, formatter))
+            if column_number == expanding_column:
+                column.set_expand(True)
+                renderer.set_property('ellipsize', 1 if expanding_column == 0 else 3) # Pango.EllipsizeMode.START / END
+            column.set_sort_column_id(column_number)
+            column.set_resizable(True)
+            tree_view.append_column(column)
+
+    def pack_scrolled(self, tree_view):
+        scrolled_window = Gtk.ScrolledWindow()
+        scrolled_window.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.AUTOMATIC)
+        scrolled_window.add(tree_view)
+        self.get_content_area().pack_start(scrolled_window, True, True, 0)
+
+    def format_cell(self, column, renderer, model, tree_iter, data):
+        column_number, formatter = data
+        renderer.set_property('text', formatter(model[tree_iter][column_number]))
+
+    def set_cells(self, cells):
+        ''' cells: list of (position, first line, memory report, cell). '''
+
+        self.cell_store.clear()
+        for position, first_line, report, cell in cells:
+            self.cell_store.append([position + 1, first_line, report['net'], report['traced'], cell])
+        if len(cells) == 0:
+            if self.worksheet.get_memory_tracking():
+                self.sites_label.set_text('No cell has been evaluated since memory tracking was turned on.')
+            else:
+                self.sites_label.set_text('Memory tracking is off. Turn it on in the worksheet menu (Kernel → Track Memory) and evaluate some cells.')
+
+    def get_selected_cells(self):
+        model, paths = self.cell_view.get_selection().get_selected_rows()
+        return [(model[path][0], model[path][4]) for path in paths]
+
+    def on_selection_changed(self, selection):
+        selected = self.get_selected_cells()
+        self.compare_button.set_sensitive(len(selected) == 2)
+        if len(selected) == 1:
+            position, cell = selected[0]
+            self.show_sites('Allocation sites that changed most while cell ' + str(position) + ' was evaluated:', cell.get_memory_report())
+        elif len(selected) == 2:
+            self.show_sites('Press Compare to see what changed between cell ' + str(selected[0][0]) + ' and cell ' + str(selected[1][0]) + '.', None)
+        elif len(self.cell_store) > 0:
+            self.show_sites('Select a cell to see where its memory was allocated.', None)
+
+    def show_sites(self, message, report):
+        self.site_store.clear()
+        if message != None: self.sites_label.set_text(message)
+        if report == None: return
+        for filename, line, size_change, count_change, size in report['top']:
+            self.site_store.append([('cell' if filename == '<cell>' else filename) + ':' + str(line), size_change, count_change, size])
+
+    def set_diff(self, memory_diff):
+        ''' memory_diff as returned by Worksheet.get_memory_diff(). '''
+
+        first_cell, second_cell, diff = memory_diff
+        first = str(first_cell.get_worksheet_position() + 1)
+        second = str(second_cell.get_worksheet_position() + 1)
+        if diff == None:
+            self.show_sites('The kernel no longer has the memory snapshots of cell ' + first + ' and ' + second + '. It keeps the last few, evaluate the cells again to compare them.', None)
+        else:
+            self.show_sites('From cell ' + first + ' to cell ' + second + ' the kernel\'s memory changed by ' + format_size_change(diff['net']) + ':', diff)
+
+
+class SlowestCells(Gtk.Dialog):
+    ''' Code cells of a worksheet with the resources their last evaluation
+        used, slowest first. Rows carry the cell in column 6. '''
+
+    def __init__(self, main_window, worksheet):
+        Gtk.Dialog.__init__(self, 'Slowest Cells', main_window, 0)
+        self.worksheet = worksheet
+        self.set_default_size(640, 400)
+        self.add_button('_Refresh', Gtk.ResponseType.APPLY)
+        self.add_button('_Close', Gtk.ResponseType.CLOSE)
+
+        # position, first line, wall, user, sys, peak memory growth, cell
+        self.list_store = Gtk.ListStore(int, str, float, float, float, GObject.TYPE_INT64, object)
+        self.list_store.set_sort_column_id(2, Gtk.SortType.DESCENDING)
+        self.tree_view = Gtk.TreeView(model=self.list_store)
+        columns = [('#', 0, str), ('Cell', 1, None), ('Wall', 2, format_seconds), ('User', 3, format_seconds), ('System', 4, format_seconds), ('Peak memory', 5, format_size)]
+        for title, column_number, formatter in columns:
+            renderer = Gtk.CellRendererText()
+            column = Gtk.TreeViewColumn(title, renderer, text=column_number)
+            if formatter != None:
+                column.set_cell_data_func(renderer, self.format_cell, (column_number, formatter))
+            if column_number == 1:
+                column.set_expand(True)
+                renderer.set_property('ellipsize', 3) # Pango.EllipsizeMode.END
+                renderer.set_property('family', 'monospace')
+            column.set_sort_column_id(column_number)
+            column.set_resizable(True)
+            self.tree_view.append_column(column)
+        scrolled_window = Gtk.ScrolledWindow()
+        scrolled_window.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.AUTOMATIC)
+        scrolled_window.add(self.tree_view)
+        self.get_content_area().pack_start(scrolled_window, True, True, 0)
+
+        self.summary_label = Gtk.Label()
+        self.summary_label.set_xalign(0)
+        self.summary_label.set_margin_top(6)
+        self.summary_label.set_margin_start(6)
+        self.summary_label.get_style_context().add_class('dim-label')
+        self.get_content_area().pack_start(self.summary_label, False, False, 0)
+
+    def format_cell(self, column, renderer, model, tree_iter, data):
+        column_number, formatter = data
+        renderer.set_property('text', formatter(model[tree_iter][column_number]))
+
+    def set_cells(self, cells):
+        ''' cells: list of (position, text, usage, cell) for evaluated code cells. '''
+
+        self.list_store.clear()
+        for position, text, usage, cell in cells:
+            first_line = text.strip().split('\n')[0]
+            self.list_store.append([position + 1, first_line, usage['wall'], usage['user'], usage['sys'], max(usage['max_rss_delta'], 0), cell])
+        if len(cells) == 0:
+            self.summary_label.set_text('No cell of this worksheet has been evaluated yet.')
+        else:
+            self.summary_label.set_text(str(len(cells)) + ' cells, ' + format_seconds(sum(usage['wall'] for position, text, usage, cell in cells)) + ' in total. Double click a row to go to the cell.')
+
+
+def format_seconds(seconds):
+    if seconds < 1: return str(int(round(seconds * 1000))) + ' ms'
+    if seconds < 60: return '{:.1f} s'.format(seconds)
+    return str(int(seconds // 60)) + ' min ' + str(int(round(seconds % 60))) + ' s'
+
+
+class EvaluationLatency(Gtk.Dialog):
+    ''' Debug panel: where the time between pressing evaluate and seeing
+        the result went, for every evaluated code cell of a worksheet. '''
+
+    stage_titles = [('submit', 'Submit'), ('queue_wait', 'Queue'), ('kernel_setup', 'Kernel setup'),
+                    ('execution', 'Execution'), ('transfer', 'Transfer'), ('gui_dispatch', 'Dispatch'),
+                    ('parse', 'Parse'), ('view', 'View'), ('render', 'Render'), ('total', 'Total')]
+
+    def __init__(self, main_window, worksheet):
+        Gtk.Dialog.__init__(self, 'Evaluation Latency', main_window, 0)
+        self.worksheet = worksheet
+        self.set_default_size(900, 400)
+        self.export_button = self.add_button('_Export CSV ...', Gtk.ResponseType.ACCEPT)
+        self.add_button('_Refresh', Gtk.ResponseType.APPLY)
+        self.add_button('_Close', Gtk.ResponseType.CLOSE)
+
+        # cell position, first line, then seconds per stage (-1 if the stage didn't happen)
+        self.list_store = Gtk.ListStore(*([int, str] + [float] * len(self.stage_titles)))
+        self.tree_view = Gtk.TreeView(model=self.list_store)
+        columns = [('#', None), ('Cell', None)] + self.stage_titles
+        for column_number, (stage, title) in enumerate(columns):
+            renderer = Gtk.CellRendererText()
+            column = Gtk.TreeViewColumn(title, renderer, text=column_number)
+            if column_number >= 2:
+                column.set_cell_data_func(renderer, self.format_cell, column_number)
+                renderer.set_property('xalign', 1)
+            if column_number == 1:
+                column.set_expand(True)
+                renderer.set_property('ellipsize', 3) # Pango.EllipsizeMode.END
+                renderer.set_property('family', 'monospace')
+            column.set_sort_column_id(column_number)
+            column.set_resizable(True)
+            self.tree_view.append_column(column)
+        scrolled_window = Gtk.ScrolledWindow()
+        scrolled_window.add(self.tree_view)
+        self.get_content_area().pack_start(scrolled_window, True, True, 0)
+
+        self.summary_label = Gtk.Label()
+        self.summary_label.set_xalign(0)
+        self.summary_label.set_line_wrap(True)
+        self.summary_label.set_margin_top(6)
+        self.summary_label.set_margin_start(6)
+        self.summary_label.get_style_context().add_class('dim-label')
+        self.get_content_area().pack_start(self.summary_label, False, False, 0)
+
+    def format_cell(self, column, renderer, model, tree_iter, column_number):
+        seconds = model[tree_iter][column_number]
+        renderer.set_property('text', '{:.1f} ms'.format(seconds * 1000) if seconds >= 0 else '–')
+
+    def set_report(self, report):
+        ''' report as returned by Worksheet.get_latency_report(). '''
+
+        self.list_store.clear()
+        for row in report:
+            values = [row['cell'], row['text']]
+            for stage, title in self.stage_titles:
+                values.append(row[stage] if row[stage] != None else -1)
+            self.list_store.append(values)
+        if len(report) == 0:
+            self.summary_label.set_text('No cell has been evaluated since the worksheet was opened.')
+        else:
+            averages = list()
+            for stage, title in self.stage_titles[:-1]:
+                values = [row[stage] for row in report if row[stage] != None]
+                if len(values) > 0:
+                    averages.append(title + ' ' + '{:.1f} ms'.format(1000 * sum(values) / len(values)))
+            self.summary_label.set_text('Averages: ' + ', '.join(averages) + '.')
+        self.export_button.set_sensitive(len(report) > 0)
+
+
+class MainLoopStalls(Gtk.Dialog):
+    ''' Debug panel: call sites that kept the gtk main loop from running,
+        as reported by the stall detector. '''
+
+    def __init__(self, main_window, threshold):
+        Gtk.Dialog.__init__(self, 'Main Loop Stalls', main_window, 0)
+        self.threshold = threshold
+        self.set_default_size(720, 400)
+        self.add_button('_Reset', Gtk.ResponseType.REJECT)
+        self.add_button('_Refresh', Gtk.ResponseType.APPLY)
+        self.add_button('_Close', Gtk.ResponseType.CLOSE)
+
+        switch_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=12)
+        switch_box.set_margin_bottom(6)
+        switch_label = Gtk.Label('Report stalls longer than ' + format_seconds(threshold))
+        switch_label.set_xalign(0)
+        self.switch = Gtk.Switch()
+        switch_box.pack_start(switch_label, True, True, 0)
+        switch_box.pack_end(self.switch, False, False, 0)
+        self.get_content_area().pack_start(switch_box, False, False, 0)
+
+        # call site, function, stalls, seconds in total, longest stall, stack (tooltip)
+        self.list_store = Gtk.ListStore(str, str, int, float, float, str)
+        self.list_store.set_sort_column_id(3, Gtk.SortType.DESCENDING)
+        self.tree_view = Gtk.TreeView(model=self.list_store)
+        self.tree_view.set_tooltip_column(5)
+        columns = [('Call site', 0, None), ('Function', 1, None), ('Stalls', 2, None), ('Total', 3, format_seconds), ('Longest', 4, format_seconds)]
+        for title, column_number, formatter in columns:
+            renderer = Gtk.CellRendererText()
+            column = Gtk.TreeViewColumn(title, renderer, text=column_number)
+            if formatter != None:
+                column.set_cell_data_func(renderer, self.format_cell, (column_number, formatter))
+            if column_number == 0:
+                column.set_expand(True)
+                renderer.set_property('ellipsize', 1) # Pango.EllipsizeMode.START
+            column.set_sort_column_id(column_number)
+            column.set_resizable(True)
+            self.tree_view.append_column(column)
+        scrolled_window = Gtk.ScrolledWindow()
+        scrolled_window.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.AUTOMATIC)
+        scrolled_window.add(self.tree_view)
+        self.get_content_area().pack_start(scrolled_window, True, True, 0)
+
+        self.summary_label = Gtk.Label()
+        self.summary_label.set_xalign(0)
+        self.summary_label.set_line_wrap(True)
+        self.summary_label.set_margin_top(6)
+        self.summary_label.set_margin_start(6)
+        self.summary_label.get_style_context().add_class('dim-label')
+        self.get_content_area().pack_start(self.summary_label, False, False, 0)
+
+    def format_cell(self, column, renderer, model, tree_iter, data):
+        column_number, formatter = data
+        renderer.set_property('text', formatter(model[tree_iter][column_number]))
+
+    def set_report(self, statistics, report):
+        ''' statistics and report as returned by the StallDetector methods. '''
+
+        self.list_store.clear()
+        for entry in report:
+            stack = GLib.markup_escape_text('\n'.join('{}:{} {}'.format(filename, lineno, name) for filename, lineno, name in entry['stack'][-12:]))
+            self.list_store.append([entry['filename'] + ':' + str(entry['lineno']), entry['function'], entry['stalls'], entry['seconds'], entry['longest'], stack])
+        if statistics['stalls'] == 0:
+            self.summary_label.set_text('No stalls recorded. Turn the detector on and use GSNB as usual, then refresh.')
+        else:
+            self.summary_label.set_text(str(statistics['stalls']) + ' stalls, ' + format_seconds(statistics['seconds']) + ' in total, the longest took ' + format_seconds(statistics['longest']) + '. Hover over a row to see the stack.')
+
+
+class ExportLatencyCSV(Gtk.FileChooserDialog):
+    ''' File chooser for exporting evaluation latencies '''
+
+    def __init__(self, main_window):
+        self.action = Gtk.FileChooserAction.SAVE
+        self.buttons = ('_Cancel', Gtk.ResponseType.CANCEL, '_Export', Gtk.ResponseType.OK)
+        Gtk.FileChooserDialog.__init__(self, 'Export evaluation latencies', main_window, self.action, self.buttons)
+        self.set_do_overwrite_confirmation(True)
+        self.set_current_name('latency.csv')